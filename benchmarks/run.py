@@ -0,0 +1,256 @@
+#!/usr/bin/python3
+# seine - Slim Embedded Images Now Easy
+# SPDX-License-Identifier Apache-2.0
+
+import datetime
+import getopt
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+path_to_self    = os.path.realpath(__file__)
+path_to_sources = os.path.join(os.path.dirname(path_to_self), "..")
+sys.path.insert(0, path_to_sources)
+sys.path.insert(0, os.path.dirname(path_to_self))
+
+from seine.build     import BuildCmd
+from seine.imager    import Imager
+from seine.partition import PartitionHandler
+from synthetic       import Synthetic
+
+# Benchmarks of the pure-Python hot paths of seine. Each benchmark has a setup
+# function (not measured) returning the arguments of the measured function.
+# The measured function is run --repeat times and the best time is kept, its
+# peak memory usage (tracemalloc) is measured by an additional run.
+class Benchmark:
+    def __init__(self, name, setup, run, params):
+        self.name = name
+        self.setup = setup
+        self.run = run
+        self.params = params
+
+    def _once(self, trace):
+        args = self.setup(**self.params)
+        gc.collect()
+        if trace:
+            tracemalloc.start()
+        start = time.perf_counter()
+        self.run(*args)
+        elapsed = time.perf_counter() - start
+        peak = None
+        if trace:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return elapsed, peak
+
+    def measure(self, repeat):
+        times = [self._once(False)[0] for i in range(repeat)]
+        elapsed, peak = self._once(True)
+        return { "name": self.name, "params": self.params, "seconds": min(times),
+                 "runs": times, "peak_bytes": peak }
+
+class Fixtures:
+    workdir = None
+    _manifests = {}
+
+    def manifest(files):
+        # synthetic manifests are shared by benchmarks (and runs)
+        if files not in Fixtures._manifests:
+            tarball = os.path.join(Fixtures.workdir, "rootfs-%d.tar" % files)
+            Fixtures._manifests[files] = (Synthetic(files).manifest(tarball), tarball)
+        return Fixtures._manifests[files]
+
+    def handler(volumes=0):
+        image = {
+            "filename": "benchmark.img",
+            "partitions": [
+                { "label": "efi", "type": "vfat", "where": "/boot/efi", "flags": [ "boot" ] },
+                { "label": "root", "where": "/" },
+                { "label": "usr", "where": "/usr" },
+                { "label": "data", "where": "/srv/data" },
+            ],
+            "volumes": [
+                { "label": "var", "group": "vg", "where": "/var" },
+                { "label": "log", "group": "vg", "where": "/var/log" },
+            ]
+        }
+        if volumes:
+            image["partitions"].append({ "label": "pv", "group": "vg", "size": "%dMiB" % (volumes * 8), "flags": [ "lvm" ] })
+            for volume in range(volumes):
+                image["volumes"].append({ "label": "lv%d" % volume, "group": "vg", "where": "/srv/lv%d" % volume })
+        else:
+            image["partitions"].append({ "label": "pv", "group": "vg", "size": "64MiB", "flags": [ "lvm" ] })
+        handler = PartitionHandler()
+        handler.parse({ "image": image })
+        return handler
+
+def setup_merge(depth, width):
+    path = tempfile.mkdtemp(dir=Fixtures.workdir)
+    top, count = Synthetic(0).specs(path, depth, width)
+    return (top,)
+
+def run_merge(top):
+    BuildCmd().load(top)
+
+def setup_distribute(files):
+    manifest, tarball = Fixtures.manifest(files)
+    return (Fixtures.handler(), manifest)
+
+def run_distribute(handler, manifest):
+    for f in manifest:
+        handler.distribute(f)
+    handler.compute_sizes()
+
+def run_distribute_many(handler, manifest):
+    handler.distribute_many(manifest.paths(), manifest.sizes, manifest.types, manifest.linklens())
+    handler.compute_sizes()
+
+def setup_script(volumes):
+    handler = Fixtures.handler(volumes)
+    handler.compute_sizes()
+    return (handler,)
+
+def run_script(handler):
+    handler.script("${disk}", Imager.TARGET_DIR)
+
+def setup_xattrs(files):
+    manifest, tarball = Fixtures.manifest(files)
+    output_dir = tempfile.mkdtemp(dir=Fixtures.workdir)
+    source = types.SimpleNamespace(manifest=manifest, _tarball=tarball)
+    return (types.SimpleNamespace(source=source), output_dir)
+
+def run_xattrs(imager, output_dir):
+    Imager._process_xattrs(imager, output_dir)
+
+def benchmarks(files, depth, width, volumes):
+    return [
+        Benchmark("merge", setup_merge, run_merge, { "depth": depth, "width": width }),
+        Benchmark("distribute", setup_distribute, run_distribute, { "files": files }),
+        Benchmark("distribute_many", setup_distribute, run_distribute_many, { "files": files }),
+        Benchmark("script", setup_script, run_script, { "volumes": volumes }),
+        Benchmark("xattrs", setup_xattrs, run_xattrs, { "files": files }),
+    ]
+
+def from_human_count(count):
+    suffixes = { "k": 1000, "m": 1000 * 1000 }
+    count = count.lower()
+    if count[-1] in suffixes:
+        return int(count[:-1]) * suffixes[count[-1]]
+    return int(count)
+
+def compare(results, previous):
+    # print the change of each benchmark against a previous run
+    before = {}
+    for result in previous["results"]:
+        before[(result["name"], json.dumps(result["params"], sort_keys=True))] = result
+    print("\n%-16s %10s %10s %8s %10s" % ("benchmark", "before", "after", "change", "peak"))
+    for result in results:
+        old = before.get((result["name"], json.dumps(result["params"], sort_keys=True)))
+        if old is None:
+            continue
+        change = (result["seconds"] - old["seconds"]) * 100 / old["seconds"]
+        peak = (result["peak_bytes"] - old["peak_bytes"]) * 100 / max(old["peak_bytes"], 1)
+        print("%-16s %9.3fs %9.3fs %+7.1f%% %+9.1f%%" % (result["name"], old["seconds"],
+              result["seconds"], change, peak))
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "h", [ "compare=", "depth=", "files=", "help",
+            "only=", "output=", "repeat=", "volumes=", "width=" ])
+    except getopt.GetoptError as err:
+        sys.stderr.write("%s\n" % err)
+        sys.stderr.write(USAGE)
+        sys.exit(1)
+
+    files, depth, width, volumes = [10000], 4, 3, 300
+    only, output, previous, repeat = None, None, None, 3
+    for o, a in opts:
+        if o in ("--compare"):
+            with open(a) as f:
+                previous = json.load(f)
+        elif o in ("--depth"):
+            depth = int(a)
+        elif o in ("--files"):
+            files = [from_human_count(n) for n in a.split(",")]
+        elif o in ("-h", "--help"):
+            print(USAGE)
+            sys.exit()
+        elif o in ("--only"):
+            only = a.split(",")
+        elif o in ("--output"):
+            output = a
+        elif o in ("--repeat"):
+            repeat = int(a)
+        elif o in ("--volumes"):
+            volumes = int(a)
+        elif o in ("--width"):
+            width = int(a)
+        else:
+            assert False, "unhandled option"
+
+    suite = []
+    for count in files:
+        for benchmark in benchmarks(count, depth, width, volumes):
+            if only is not None and benchmark.name not in only:
+                continue
+            if [b for b in suite if b.name == benchmark.name and b.params == benchmark.params]:
+                continue
+            suite.append(benchmark)
+
+    Fixtures.workdir = tempfile.mkdtemp(prefix="seine-benchmarks-")
+    results = []
+    try:
+        for benchmark in suite:
+            result = benchmark.measure(repeat)
+            results.append(result)
+            print("%-16s %-28s %9.3fs %10.1f MiB" % (result["name"],
+                  ",".join(["%s=%s" % kv for kv in sorted(result["params"].items())]),
+                  result["seconds"], result["peak_bytes"] / (1024 * 1024)))
+    finally:
+        shutil.rmtree(Fixtures.workdir)
+
+    report = {
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    if previous is not None:
+        compare(results, previous)
+
+USAGE = """
+Run the seine micro-benchmarks
+
+Usage:
+  benchmarks/run.py [options]
+
+Examples:
+  benchmarks/run.py --output=baseline.json
+  benchmarks/run.py --files=10k,1M --compare=baseline.json
+
+Flags:
+  --compare=FILE   compare results with those of a previous run
+  --depth=N        depth of the tree of required specifications (merge, default: 4)
+  --files=N[,N]    number of files in the synthetic root file-systems (e.g. 10k, 5M)
+  -h, --help       print this message
+  --only=NAME[,N]  only run the named benchmarks (merge, distribute, distribute_many,
+                   script, xattrs)
+  --output=FILE    save results to FILE (JSON)
+  --repeat=N       number of timed runs of each benchmark (default: 3)
+  --volumes=N      number of logical volumes (script, default: 300)
+  --width=N        number of specifications required by each specification (merge, default: 3)
+"""
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
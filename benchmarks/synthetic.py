@@ -0,0 +1,128 @@
+# seine - Slim Embedded Images Now Easy
+# SPDX-License-Identifier Apache-2.0
+
+import io
+import os
+import random
+import tarfile
+import yaml
+
+from seine.manifest import Manifest
+
+# Synthetic root file-systems: a deterministic tree of directories, files,
+# symbolic and hard links spread over typical mount points. Manifests are
+# built directly (without a tarball) so that millions of files may be used,
+# only the rootfs.xattr member is written to an actual tarball.
+class Synthetic:
+    TOP_DIRS   = [ "etc", "home/user", "opt", "srv/data", "usr/bin", "usr/lib",
+                   "usr/share", "var/cache", "var/lib", "var/log" ]
+    FANOUT     = 32
+    MAX_SIZE   = 64 * 1024 * 1024
+    XATTR_PCT  = 20
+
+    def __init__(self, files, seed=0):
+        self.files = files
+        self.seed = seed
+
+    def entries(self):
+        # yield (name, type, size, linkname) tuples, parents before children
+        rng = random.Random(self.seed)
+        dirs = []
+        for top in Synthetic.TOP_DIRS:
+            parts = top.split("/")
+            for depth in range(len(parts)):
+                name = "/".join(parts[:depth + 1])
+                if name not in dirs:
+                    dirs.append(name)
+                    yield (name, tarfile.DIRTYPE, 0, "")
+        leaves = list(Synthetic.TOP_DIRS)
+        regular = []
+        count = len(dirs)
+        while count < self.files:
+            parent = rng.choice(leaves)
+            kind = rng.random()
+            name = "%s/f%d" % (parent, count)
+            if kind < 1.0 / Synthetic.FANOUT:
+                leaves.append(name)
+                yield (name, tarfile.DIRTYPE, 0, "")
+            elif kind < 0.10 and regular:
+                yield (name, tarfile.SYMTYPE, 0, rng.choice(regular))
+            elif kind < 0.13 and regular:
+                yield (name, tarfile.LNKTYPE, 0, rng.choice(regular))
+            else:
+                size = min(int(rng.lognormvariate(8.5, 2.0)), Synthetic.MAX_SIZE)
+                if len(regular) < 4096:
+                    regular.append(name)
+                yield (name, tarfile.REGTYPE, size, "")
+            count = count + 1
+
+    def xattrs(self):
+        # getfattr dump of some of the files (and of a few that were removed)
+        rng = random.Random(self.seed + 1)
+        lines = []
+        for name, type, size, linkname in self.entries():
+            if type == tarfile.REGTYPE and rng.randrange(100) < Synthetic.XATTR_PCT:
+                lines.append("# file: %s" % name)
+                lines.append("security.selinux=\"system_u:object_r:usr_t:s0\"")
+                lines.append("")
+                if rng.randrange(100) < 5:
+                    lines.append("# file: %s.removed" % name)
+                    lines.append("user.comment=\"gone\"")
+                    lines.append("")
+        return "\n".join(lines).encode()
+
+    def manifest(self, tarball=None):
+        # manifest of the synthetic tree, rootfs.xattr is written to tarball
+        # (if provided) and listed first
+        if tarball is not None:
+            data = self.xattrs()
+            with tarfile.open(tarball, "w") as tar:
+                info = tarfile.TarInfo("rootfs.xattr")
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+            manifest = Manifest.build(tarball)
+        else:
+            manifest = Manifest()
+        info = tarfile.TarInfo()
+        info.mode = 0o644
+        for name, type, size, linkname in self.entries():
+            info.name = name
+            info.type = type
+            info.size = size
+            info.linkname = linkname
+            manifest._append(info)
+        return manifest
+
+    def specs(self, path, depth, width):
+        # tree of specifications: each requires width others, depth levels deep
+        # and redefines partitions, volumes and playbooks of its children
+        names = []
+        def write(name, level):
+            requires = []
+            if level < depth:
+                for child in range(width):
+                    requires.append(write("%s-%d" % (name, child), level + 1))
+            spec = {
+                "distribution": { "source": "debian", "release": "bookworm", "level-%d" % level: name },
+                "playbook": [ { "name": name, "tasks": [ { "debug": { "msg": name } } ] } ],
+                "image": {
+                    "filename": "%s.img" % name,
+                    "partitions": [
+                        { "label": "efi", "type": "vfat", "where": "/boot/efi", "flags": [ "boot", "~lvm" ] },
+                        { "label": "lvm", "group": "vg", "size": "%dMiB" % (100 + level), "flags": [ "lvm" ] },
+                        { "label": "p-%s" % name, "where": "/srv/%s" % name },
+                    ],
+                    "volumes": [
+                        { "label": "root", "group": "vg", "where": "/" },
+                        { "label": "v-%s" % name, "group": "vg", "where": "/var/%s" % name },
+                    ],
+                },
+            }
+            if requires:
+                spec["requires"] = requires
+            with open(os.path.join(path, "%s.yaml" % name), "w") as f:
+                yaml.dump(spec, f)
+            names.append(name)
+            return name
+        top = write("spec", 0)
+        return os.path.join(path, "%s.yaml" % top), len(names)
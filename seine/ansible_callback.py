@@ -0,0 +1,116 @@
+# seine - Slim Embedded Images Now Easy
+# SPDX-License-Identifier Apache-2.0
+
+# Ansible callback plugin shipped with the seine-ansible package (installed as
+# "seine_profile"): the wall time, CPU time and changed status of every task
+# and playbook are written to stdout as JSON lines picked out of the output of
+# "podman build" by seine (see seine/profile.py). Changes to this file shall
+# come with a new HostBootstrap.VERSION for host bootstraps to be rebuilt.
+
+import json
+import os
+import sys
+import time
+
+try:
+    from ansible.plugins.callback import CallbackBase
+except ImportError:
+    CallbackBase = object
+
+MARKER = "SEINE-PROFILE "
+
+# CPU time (in seconds) of the container: it includes processes that are not
+# children of Ansible (such as modules run through chroot or qemu-user) and
+# falls back to the CPU time of Ansible and its children
+def cpu_time():
+    try:
+        with open("/sys/fs/cgroup/cpu.stat") as f:
+            for line in f:
+                key, value = line.split()
+                if key == "usage_usec":
+                    return int(value) / 1e6
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpuacct/cpuacct.usage") as f:
+            return int(f.read()) / 1e9
+    except (OSError, ValueError):
+        pass
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = "aggregate"
+    CALLBACK_NAME = "seine_profile"
+    # loaded without being enabled in ansible.cfg
+    CALLBACK_NEEDS_ENABLED = False
+    CALLBACK_NEEDS_WHITELIST = False
+
+    def __init__(self, output=None):
+        super().__init__()
+        self._output = output or sys.stdout
+        self._play = None
+        self._task = None
+
+    def _emit(self, record):
+        self._output.write(MARKER + json.dumps(record) + "\n")
+        self._output.flush()
+
+    def _start(self, name):
+        return { "name": name, "start": time.time(), "cpu": cpu_time(), "changed": False }
+
+    def _finish(self, kind, record):
+        record["wall"] = round(time.time() - record["start"], 3)
+        record["cpu"] = round(cpu_time() - record["cpu"], 3)
+        record["kind"] = kind
+        del record["start"]
+        self._emit(record)
+
+    def _finish_task(self):
+        if self._task is not None:
+            self._finish("task", self._task)
+            self._task = None
+
+    def _finish_play(self):
+        self._finish_task()
+        if self._play is not None:
+            self._finish("playbook", self._play)
+            self._play = None
+
+    def v2_playbook_on_play_start(self, play):
+        self._finish_play()
+        self._play = self._start(play.get_name().strip() or "unnamed")
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._finish_task()
+        self._task = self._start(task.get_name().strip())
+        if self._play is not None:
+            self._task["playbook"] = self._play["name"]
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self.v2_playbook_on_task_start(task, False)
+
+    def _result(self, result, status):
+        if self._task is None:
+            return
+        self._task["status"] = status
+        if result._result.get("changed", False):
+            self._task["changed"] = True
+            if self._play is not None:
+                self._play["changed"] = True
+
+    def v2_runner_on_ok(self, result):
+        self._result(result, "ok")
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._result(result, "ignored" if ignore_errors else "failed")
+
+    def v2_runner_on_skipped(self, result):
+        self._result(result, "skipped")
+
+    def v2_runner_on_unreachable(self, result):
+        self._result(result, "unreachable")
+
+    def v2_playbook_on_stats(self, stats):
+        self._finish_play()
@@ -0,0 +1,291 @@
+# seine - Slim Embedded Images Now Easy
+# SPDX-License-Identifier Apache-2.0
+
+import base64
+import io
+import os
+import re
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import uuid
+
+from seine.estimate import Estimator
+from seine.table    import PartitionTable
+from seine.trace    import Trace
+
+# Assemble the disk image on the host without booting the imager: each mount
+# gets its own tarball split from the root file-system, file-systems are then
+# created and populated straight into the disk image at the offset of their
+# partition (mke2fs -d for ext2/3/4, mtools for vfat) and the partition table
+# and bootlets are written in place. Layouts using LVM, file-systems other than
+# ext2/3/4 and vfat or root file-systems needing grub or SELinux labels to be
+# set up from within the target are left to the imager.
+class HostAssembler:
+    FILE_SYSTEMS = [ "ext2", "ext3", "ext4", "vfat" ]
+    MKE2FS_TARBALL = (1, 47, 1)
+    NEEDS_IMAGER = [
+        "usr/sbin/grub-install",
+        "etc/selinux/config",
+    ]
+
+    def __init__(self, source):
+        self.source = source
+        self.keep = source.options["keep"]
+        self.partitionHandler = source.partitionHandler
+        self.verbose = source.options["verbose"]
+
+    def _mke2fs_version():
+        try:
+            proc = subprocess.run(["mke2fs", "-V"], stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT, check=False)
+        except OSError:
+            return None
+        version = re.search(r"mke2fs (\d+)\.(\d+)(?:\.(\d+))?", proc.stdout.decode())
+        if version is None:
+            return None
+        return tuple([int(v) if v else 0 for v in version.groups()])
+
+    def _mke2fs_tarball():
+        version = HostAssembler._mke2fs_version()
+        return version is not None and version >= HostAssembler.MKE2FS_TARBALL
+
+    def unsupported(source):
+        # reason why the image may not be assembled on the host (None if it can)
+        handler = source.partitionHandler
+        if source.options.get("imager", False):
+            return "imager requested"
+        if handler.volumes or handler.groups:
+            return "logical volumes"
+        try:
+            PartitionTable.get(handler._table).check(handler.partitions)
+        except ValueError as e:
+            return str(e)
+        types = set([part["type"] for part in handler.mounts])
+        for part in handler.partitions:
+            if part["_lvm"] or part["type"] not in HostAssembler.FILE_SYSTEMS:
+                return "'%s' partitions" % part["type"]
+        if [t for t in types if t.startswith("ext")]:
+            if shutil.which("mke2fs") is None:
+                return "mke2fs not found"
+            if HostAssembler._mke2fs_tarball() is False and os.geteuid() != 0:
+                return "mke2fs cannot populate file-systems from tarballs"
+        if "vfat" in types:
+            for tool in ["mkfs.fat", "mcopy"]:
+                if shutil.which(tool) is None:
+                    return "%s not found" % tool
+        # the root file-system may not be known yet
+        if source.manifest is not None:
+            for name in HostAssembler.NEEDS_IMAGER:
+                if source.manifest.find(name) is not None:
+                    return "/%s found in the root file-system" % name
+        return None
+
+    def _normalize(self, name):
+        while name.startswith("./"):
+            name = name[2:]
+        return "/" + name.strip("/")
+
+    def _parse_xattrs(self, content):
+        # parse the output of getfattr --dump into a dictionary of extended
+        # attributes per file
+        xattrs = {}
+        current = None
+        for line in content.splitlines():
+            line = line.decode("utf-8", "surrogateescape").strip()
+            if line.startswith("# file: "):
+                path = self._unescape(line[8:]).decode("utf-8", "surrogateescape")
+                current = xattrs.setdefault(self._normalize(path), {})
+            elif current is not None and "=" in line and line.startswith("#") is False:
+                name, value = line.split("=", 1)
+                current[name] = self._decode_xattr(value)
+        return xattrs
+
+    def _unescape(self, text):
+        # getfattr escapes special characters as octal sequences (e.g. \\012)
+        return re.sub(rb"\\([0-7]{3})", lambda m: bytes([int(m.group(1), 8)]),
+                      text.encode("utf-8", "surrogateescape"))
+
+    def _decode_xattr(self, value):
+        if value.startswith("0x"):
+            return bytes.fromhex(value[2:])
+        if value.startswith("0s"):
+            return base64.b64decode(value[2:])
+        if value.startswith('"') and value.endswith('"'):
+            return self._unescape(value[1:-1])
+        return value.encode("utf-8", "surrogateescape")
+
+    def fstab(self):
+        lines = []
+        for mount in reversed(self.partitionHandler.mounts):
+            options, passno = self.partitionHandler.fstab_options(mount)
+            lines.append("UUID=%s %s %s %s 0 %d" % (mount["_uuid"], mount["_prefix"],
+                         mount["type"], options, passno))
+        return ("\n".join(lines) + "\n").encode()
+
+    def _member(self, info, name, data=None):
+        info.name = name
+        if data is not None:
+            info.type = tarfile.REGTYPE
+            info.linkname = ""
+            info.size = len(data)
+        return info
+
+    def split(self, output_dir):
+        # write the files of each mount (with extended attributes and the
+        # generated fstab) to their own tarball, in a single pass
+        handler = self.partitionHandler
+        manifest = self.source.manifest
+        tarball = self.source._tarball
+        xattrs = {}
+        if manifest.find("rootfs.xattr") is not None:
+            xattrs = self._parse_xattrs(manifest.read(tarball, "rootfs.xattr"))
+
+        tarballs = {}
+        for mount in handler.mounts:
+            path = os.path.join(output_dir, "%s.tar" % mount["label"])
+            mount["_tarball"] = path
+            tarballs[mount["_prefix"]] = tarfile.open(path, "w", format=tarfile.PAX_FORMAT)
+
+        dirs = set()
+        fstab = None
+        try:
+            with tarfile.open(tarball, "r:") as tar:
+                for info in tar:
+                    tar.members = []
+                    name = self._normalize(info.name)
+                    if name == "/" or name == "/rootfs.xattr":
+                        continue
+                    mount = handler._lookup_mount(name)
+                    if mount is None:
+                        continue
+                    out = tarballs[mount["_prefix"]]
+                    rel = name[len(mount["_prefix"]):]
+                    if info.isdir():
+                        dirs.add(name + "/")
+                    if name in xattrs:
+                        for key, value in xattrs[name].items():
+                            info.pax_headers["SCHILY.xattr." + key] = value.decode("utf-8", "surrogateescape")
+                    data = None
+                    if name == "/etc/fstab":
+                        fstab = mount
+                        data = self.fstab()
+                    elif info.islnk():
+                        target = self._normalize(info.linkname)
+                        if handler._lookup_mount(target) is mount:
+                            info.linkname = target[len(mount["_prefix"]):]
+                        else:
+                            # hard links may not cross file-systems
+                            data = manifest.read(tarball, target[1:])
+                    info = self._member(info, rel, data)
+                    if data is not None:
+                        out.addfile(info, io.BytesIO(data))
+                    elif info.isreg():
+                        out.addfile(info, tar.extractfile(info))
+                    else:
+                        out.addfile(info)
+
+            # mount points missing from the root file-system and fstab
+            for mount in handler.mounts:
+                parent = handler._lookup_mount(mount["_prefix"].rstrip("/"))
+                if parent is None or mount["_prefix"] in dirs:
+                    continue
+                info = tarfile.TarInfo(mount["_prefix"][len(parent["_prefix"]):].rstrip("/"))
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                tarballs[parent["_prefix"]].addfile(info)
+            root = handler._mount_index.get("/")
+            if fstab is None and root is not None:
+                data = self.fstab()
+                info = self._member(tarfile.TarInfo(), "etc/fstab", data)
+                info.mode = 0o644
+                tarballs["/"].addfile(info, io.BytesIO(data))
+        finally:
+            for out in tarballs.values():
+                out.close()
+
+    def _run(self, cmd, **kwargs):
+        if self.verbose:
+            print(" ".join(cmd))
+        subprocess.run(cmd, check=True, **kwargs)
+
+    def _mkfs_ext(self, mount, output_dir):
+        source = mount["_tarball"]
+        if HostAssembler._mke2fs_tarball() is False:
+            # older releases of mke2fs may only copy files from a directory
+            source = os.path.join(output_dir, mount["label"])
+            os.mkdir(source)
+            self._run(["tar", "--numeric-owner", "--xattrs", "--xattrs-include=*",
+                       "--warning=no-unknown-keyword", "-xpf", mount["_tarball"], "-C", source])
+        options = Estimator.get(mount["type"]).options(mount).split()
+        self._run(["mke2fs", "-q", "-F", "-t", mount["type"], *options,
+                   "-L", mount["label"], "-U", mount["_uuid"],
+                   "-E", "offset=%d,root_owner=0:0" % mount["_offset"],
+                   "-d", source, self.source._image, "%dk" % (mount["_size"] // 1024)])
+
+    def _mkfs_vfat(self, mount, output_dir):
+        sector = PartitionTable.SECTOR_SIZE
+        options = Estimator.get(mount["type"]).options(mount).split()
+        self._run(["mkfs.fat", *options, "-n", mount["label"],
+                   "-i", mount["_uuid"].replace("-", ""),
+                   "--offset=%d" % (mount["_offset"] // sector),
+                   self.source._image, "%d" % (mount["_size"] // 1024)],
+                  stdout=subprocess.DEVNULL)
+        files = os.path.join(output_dir, mount["label"])
+        os.mkdir(files)
+        self._run(["tar", "--no-same-owner", "--no-same-permissions",
+                   "--warning=no-unknown-keyword", "-xf", mount["_tarball"], "-C", files])
+        entries = [os.path.join(files, f) for f in sorted(os.listdir(files))]
+        if entries:
+            env = dict(os.environ, MTOOLS_SKIP_CHECK="1")
+            self._run(["mcopy", "-i", "%s@@%d" % (self.source._image, mount["_offset"]),
+                       "-s", "-p", "-m", "-Q", *entries, "::/"], env=env)
+
+    def copy_bootlets(self):
+        manifest = self.source.manifest
+        fd = os.open(self.source._image, os.O_WRONLY)
+        try:
+            for bootlet in self.partitionHandler.bootlets:
+                data = manifest.read(self.source._tarball, bootlet["file"].lstrip("/"))
+                os.pwrite(fd, data, bootlet["_seek"] * 1024)
+        finally:
+            os.close(fd)
+
+    @Trace.stage("host assembly")
+    def create(self):
+        handler = self.partitionHandler
+        output_dir = None
+        try:
+            output_dir = tempfile.mkdtemp(dir=os.getcwd())
+            for mount in handler.mounts:
+                if mount["type"] == "vfat":
+                    mount["_uuid"] = "%04X-%04X" % tuple(divmod(uuid.uuid4().int & 0xffffffff, 0x10000))
+                else:
+                    mount["_uuid"] = str(uuid.uuid4())
+
+            print("# Splitting rootfs")
+            with Trace.span("split"):
+                self.split(output_dir)
+
+            print("# Creating partitions")
+            with Trace.span("partitions"):
+                PartitionTable.get(handler._table).write(self.source._image,
+                    handler.disk_size(), handler.partitions)
+
+            for mount in handler.mounts:
+                print("# Creating %s file-system for %s" % (mount["type"], mount["_prefix"]))
+                with Trace.span("mkfs", args={ "mount": mount["_prefix"], "type": mount["type"] }):
+                    if mount["type"] == "vfat":
+                        self._mkfs_vfat(mount, output_dir)
+                    else:
+                        self._mkfs_ext(mount, output_dir)
+
+            self.copy_bootlets()
+            print("Done.")
+        finally:
+            if output_dir:
+                if self.keep:
+                    print("keeping '%s' (file-systems contents) as requested" % output_dir)
+                else:
+                    shutil.rmtree(output_dir)
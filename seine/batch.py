@@ -0,0 +1,183 @@
+# seine - Slim Embedded Images Now Easy
+# SPDX-License-Identifier Apache-2.0
+
+import contextlib
+import os
+import shutil
+import sys
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from seine.assembler import HostAssembler
+from seine.bootstrap import AnsibleToolchain, HostBootstrap, TargetBootstrap
+from seine.imager    import Imager
+from seine.output    import FramedFormat
+from seine.qemu      import Qemu
+from seine.utils     import ContainerEngine
+
+# CPU, memory (MiB) and I/O budgets shared by the stages of a batch: a stage
+# waits until its demands fit in what is left (a stage asking for more than
+# the budget runs once nothing else does)
+class Budget:
+    RESOURCES = [ "cpu", "memory", "io" ]
+
+    def __init__(self, cpu, memory, io):
+        self.limits = { "cpu": cpu, "memory": memory, "io": io }
+        self.used = dict.fromkeys(Budget.RESOURCES, 0)
+        self._cond = threading.Condition()
+
+    def _idle(self):
+        return all([v == 0 for v in self.used.values()])
+
+    def _fits(self, demand):
+        if self._idle():
+            return True
+        for r in Budget.RESOURCES:
+            if self.used[r] + demand.get(r, 0) > self.limits[r]:
+                return False
+        return True
+
+    @contextlib.contextmanager
+    def reserve(self, demand):
+        with self._cond:
+            self._cond.wait_for(lambda: self._fits(demand))
+            for r in Budget.RESOURCES:
+                self.used[r] = self.used[r] + demand.get(r, 0)
+        try:
+            yield
+        finally:
+            with self._cond:
+                for r in Budget.RESOURCES:
+                    self.used[r] = self.used[r] - demand.get(r, 0)
+                self._cond.notify_all()
+
+# Build independent specifications concurrently. Images shared by several
+# builds (host and target bootstraps, imager and qemu) are stages of their own
+# run once per name, the stages of each image (rootfs, export, assembly and
+# output) then run in order as soon as the budget permits.
+class Batch:
+    STAGES = {
+        "bootstrap": { "cpu": 1, "memory": 512, "io": 1 },
+        "rootfs":    { "cpu": 1, "memory": 512 },
+        "export":    { "cpu": 1, "memory": 256, "io": 1 },
+        "host":      { "cpu": 1, "memory": 256, "io": 1 },
+        "imager":    { "cpu": 1, "memory": 128, "io": 1 },
+        "output":    { "cpu": 1, "memory": 256, "io": 1 },
+    }
+
+    def __init__(self, builds, budget):
+        self.budget = budget
+        self.builds = builds
+        self._lock = threading.Lock()
+        self._shared = {}
+
+    def _demand(self, stage, cpu=None):
+        demand = dict(Batch.STAGES[stage])
+        if cpu is not None:
+            demand["cpu"] = min(cpu, self.budget.limits["cpu"])
+        return demand
+
+    def once(self, key, fn):
+        # run fn for the first build asking for key, others wait for it
+        with self._lock:
+            future = self._shared.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._shared[key] = future
+        if owner:
+            try:
+                with self.budget.reserve(self._demand("bootstrap")):
+                    future.set_result(fn())
+            except BaseException as e:
+                future.set_exception(e)
+        return future.result()
+
+    def _ensure(self, name, create):
+        if ContainerEngine.cachedImage(name) is False:
+            create()
+
+    def _bootstrap(self, image):
+        host = image.hostBootstrap
+        self.once(("image", host.name), lambda: self._ensure(host.name, host.create))
+        if image._from is None:
+            target = image.targetBootstrap.refresh()
+            self.once(("image", target.name),
+                lambda: self._ensure(target.name, lambda: target.create(host)))
+        if image._host_ansible():
+            toolchain = image.toolchain = AnsibleToolchain(image.spec["distribution"], image.options)
+            self.once(("image", toolchain.name),
+                lambda: self._ensure(toolchain.name, lambda: toolchain.create(host)))
+
+    def _qemu(self, image):
+        qemu = Qemu(image)
+        self.once(("image", qemu.name), qemu.create)
+
+    def _assemble(self, image):
+        if HostAssembler.unsupported(image) is None:
+            demand = self._demand("host")
+        else:
+            imager = Imager(image)
+            self.once(("image", imager.name), imager.prepare)
+            if Imager.kvm() is False:
+                self._qemu(image)
+            memory, cpus = imager.resources()
+            demand = self._demand("imager", cpus)
+            demand["memory"] = demand["memory"] + memory
+        with self.budget.reserve(demand):
+            image.assemble()
+
+    def _write(self, image):
+        cpu = None
+        if isinstance(image._format, FramedFormat):
+            cpu = image._format.jobs
+        elif image._format.name == "qcow2" and shutil.which("qemu-img") is None:
+            self._qemu(image)
+        with self.budget.reserve(self._demand("output", cpu)):
+            image.write()
+
+    def _build(self, spec, build):
+        image = build.image
+        start = time.monotonic()
+        # name the lane of the build in traces
+        threading.current_thread().name = spec
+        build_id = ContainerEngine.begin()
+        try:
+            distro = build.spec["distribution"]
+            image.hostBootstrap = HostBootstrap(distro, image.options)
+            image.targetBootstrap = TargetBootstrap(distro, image.options)
+            self._bootstrap(image)
+            with self.budget.reserve(self._demand("rootfs")):
+                image.rootfs()
+            with self.budget.reserve(self._demand("export")):
+                image.build_tarball()
+            self._assemble(image)
+            self._write(image)
+            if image.options.get("sbom", False):
+                with self.budget.reserve(self._demand("export")):
+                    image.sbom()
+            return (spec, None, time.monotonic() - start)
+        except Exception as e:
+            if image._image is not None:
+                os.unlink(image._image)
+                image._image = None
+            return (spec, e, time.monotonic() - start)
+        finally:
+            ContainerEngine.cleanup(build_id)
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers=len(self.builds)) as pool:
+            futures = [pool.submit(self._build, spec, build) for spec, build in self.builds]
+            results = [f.result() for f in futures]
+
+        failed = 0
+        print("\nbatch results:")
+        for spec, error, duration in results:
+            if error is None:
+                print("%s\tok\t%ds" % (spec, duration))
+            else:
+                print("%s\tfailed\t%ds\t%s" % (spec, duration, error))
+                failed = failed + 1
+        return 4 if failed else 0
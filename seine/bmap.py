@@ -0,0 +1,159 @@
+# seine - Slim Embedded Images Now Easy
+# SPDX-License-Identifier Apache-2.0
+
+import errno
+import hashlib
+import os
+import re
+
+from xml.etree import ElementTree
+
+# Block map of a sparse image in the format used by bmaptool (version 2.0):
+# only ranges of blocks holding data need to be copied to the target media
+class BlockMap:
+    BLOCK_SIZE = 4096
+    CHUNK_SIZE = 1024 * 1024
+    CHECKSUM   = "sha256"
+    VERSION    = "2.0"
+
+    def __init__(self, image_size=0, ranges=None, checksums=None):
+        self.image_size = image_size
+        self.ranges = ranges if ranges is not None else []
+        self.checksums = checksums if checksums is not None else []
+
+    def _scan(fd, size):
+        # extents holding data as reported by the file-system, the whole file
+        # is considered mapped if holes cannot be detected
+        extents = []
+        offset = 0
+        try:
+            while offset < size:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+                end = os.lseek(fd, start, os.SEEK_HOLE)
+                extents.append((start, end))
+                offset = end
+        except OSError as e:
+            if e.errno != errno.ENXIO: # no more data
+                return [(0, size)] if size > 0 else []
+        return extents
+
+    def _blocks(extents, size):
+        # convert byte extents to (first, last) block ranges, merging ranges
+        # sharing a block
+        bs = BlockMap.BLOCK_SIZE
+        ranges = []
+        for start, end in extents:
+            first = start // bs
+            last = (min(end, size) - 1) // bs
+            if ranges and ranges[-1][1] >= first - 1:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], last))
+            else:
+                ranges.append((first, last))
+        return ranges
+
+    def _read(self, fd, first, last, chunk=None):
+        bs = BlockMap.BLOCK_SIZE
+        offset = first * bs
+        end = min((last + 1) * bs, self.image_size)
+        chunk = chunk or BlockMap.CHUNK_SIZE
+        while offset < end:
+            data = os.pread(fd, min(chunk, end - offset), offset)
+            if not data:
+                raise IOError("unexpected end of image at offset %d!" % offset)
+            yield offset, data
+            offset = offset + len(data)
+
+    def generate(image):
+        fd = os.open(image, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            bmap = BlockMap(size, BlockMap._blocks(BlockMap._scan(fd, size), size))
+            for first, last in bmap.ranges:
+                digest = hashlib.new(BlockMap.CHECKSUM)
+                for offset, data in bmap._read(fd, first, last):
+                    digest.update(data)
+                bmap.checksums.append(digest.hexdigest())
+            return bmap
+        finally:
+            os.close(fd)
+
+    def blocks_count(self):
+        return (self.image_size + BlockMap.BLOCK_SIZE - 1) // BlockMap.BLOCK_SIZE
+
+    def mapped_blocks_count(self):
+        return sum([last - first + 1 for first, last in self.ranges])
+
+    def _xml(self, checksum):
+        lines = [
+            '<?xml version="1.0" ?>',
+            '<bmap version="%s">' % BlockMap.VERSION,
+            '    <ImageSize> %d </ImageSize>' % self.image_size,
+            '    <BlockSize> %d </BlockSize>' % BlockMap.BLOCK_SIZE,
+            '    <BlocksCount> %d </BlocksCount>' % self.blocks_count(),
+            '    <MappedBlocksCount> %d </MappedBlocksCount>' % self.mapped_blocks_count(),
+            '    <ChecksumType> %s </ChecksumType>' % BlockMap.CHECKSUM,
+            '    <BmapFileChecksum> %s </BmapFileChecksum>' % checksum,
+            '    <BlockMap>'
+        ]
+        for (first, last), chksum in zip(self.ranges, self.checksums):
+            blocks = "%d" % first if first == last else "%d-%d" % (first, last)
+            lines.append('        <Range chksum="%s"> %s </Range>' % (chksum, blocks))
+        lines.append('    </BlockMap>')
+        lines.append('</bmap>')
+        return "\n".join(lines) + "\n"
+
+    def dumps(self):
+        # the checksum of the bmap file is computed with its own field zeroed
+        zeroes = "0" * len(hashlib.new(BlockMap.CHECKSUM).hexdigest())
+        checksum = hashlib.new(BlockMap.CHECKSUM, self._xml(zeroes).encode()).hexdigest()
+        return self._xml(checksum)
+
+    def save(self, path):
+        with open(path, "w") as f:
+            f.write(self.dumps())
+        return path
+
+    def load(path):
+        root = ElementTree.parse(path).getroot()
+        if root.get("version", "").split(".")[0] != BlockMap.VERSION.split(".")[0]:
+            raise ValueError("%s: unsupported bmap version '%s'!" % (path, root.get("version")))
+        if root.findtext("ChecksumType").strip() != BlockMap.CHECKSUM:
+            raise ValueError("%s: unsupported checksum type!" % path)
+        if int(root.findtext("BlockSize")) != BlockMap.BLOCK_SIZE:
+            raise ValueError("%s: unsupported block size!" % path)
+        bmap = BlockMap(int(root.findtext("ImageSize")))
+        for r in root.find("BlockMap").findall("Range"):
+            blocks = re.match(r"^\s*(\d+)(?:-(\d+))?\s*$", r.text)
+            first = int(blocks.group(1))
+            last = int(blocks.group(2)) if blocks.group(2) else first
+            bmap.ranges.append((first, last))
+            bmap.checksums.append(r.get("chksum"))
+        return bmap
+
+    def copy(self, image, target, verify=True, progress=None):
+        # copy mapped ranges only: a regular file target is kept sparse and
+        # a block device only gets written where the image has data
+        src = os.open(image, os.O_RDONLY)
+        dst = os.open(target, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            if os.path.isfile(target):
+                # data of an existing file would be left in unmapped ranges
+                os.ftruncate(dst, 0)
+                os.ftruncate(dst, self.image_size)
+            copied = 0
+            total = self.mapped_blocks_count() * BlockMap.BLOCK_SIZE
+            for (first, last), chksum in zip(self.ranges, self.checksums):
+                digest = hashlib.new(BlockMap.CHECKSUM)
+                for offset, data in self._read(src, first, last):
+                    if verify:
+                        digest.update(data)
+                    os.pwrite(dst, data, offset)
+                    copied = copied + len(data)
+                    if progress is not None:
+                        progress(copied, total)
+                if verify and digest.hexdigest() != chksum:
+                    raise IOError("checksum mismatch for blocks %d-%d of %s!" % (first, last, image))
+            os.fsync(dst)
+        finally:
+            os.close(dst)
+            os.close(src)
@@ -3,10 +3,20 @@
 
 from abc import ABC, abstractmethod
 
+import glob
+import hashlib
+import json
 import os
+import shutil
 import subprocess
 import tempfile
+import time
+import urllib.request
 
+from seine       import ansible_callback
+from seine.trace import Trace
+from seine.utils import Cache
+from seine.utils import CacheUsage
 from seine.utils import ContainerEngine
 
 class Bootstrap(ABC):
@@ -35,66 +45,236 @@ class Bootstrap(ABC):
     name = property(getName, setName)
 
 class HostBootstrap(Bootstrap):
+    # version of the contents of the host bootstrap (such as the seine-ansible
+    # package and its callback plugin): bootstraps of previous versions are
+    # not reused
+    VERSION = 2
+
+    @Trace.stage("host bootstrap")
     def create(self):
+        # the callback plugin of Ansible profiling playbooks is shipped with
+        # the seine-ansible package (it shall keep its name)
+        plugindir = tempfile.mkdtemp()
+        plugin = os.path.join(plugindir, "seine_profile.py")
+        shutil.copyfile(ansible_callback.__file__, plugin)
+        os.chmod(plugindir, 0o755)
+
         equivsfile = tempfile.NamedTemporaryFile(mode="w", delete=False)
-        equivsfile.write(EQUIVS_CONTROL_FILE)
+        equivsfile.write(EQUIVS_CONTROL_FILE.format(
+            os.path.join("/host-tmp", os.path.basename(plugindir), "seine_profile.py")))
         equivsfile.close()
 
         dockerfile = tempfile.NamedTemporaryFile(mode="w", delete=False)
-        dockerfile.write(HOST_BOOTSTRAP_SCRIPT.format(
+        dockerfile.write(ContainerEngine.dockerfile(HOST_BOOTSTRAP_SCRIPT.format(
             self.distro["source"],
             self.distro["release"],
-            os.path.basename(equivsfile.name)))
+            os.path.basename(equivsfile.name))))
         dockerfile.close()
 
         try:
             ContainerEngine.run([
                 "build", "--rm", "--squash",
+                *ContainerEngine.labels("host-bootstrap"),
                 "-t", self.name, "-f", dockerfile.name,
                 "-v", "/tmp:/host-tmp:ro"],
                 check=True)
         except subprocess.CalledProcessError:
             raise
         finally:
-            ContainerEngine.run(["image", "prune", "-f"])
             os.unlink(dockerfile.name)
             os.unlink(equivsfile.name)
+            shutil.rmtree(plugindir)
+        return self
+
+    def defaultName(self):
+        return os.path.join("bootstrap", self.distro["source"], self.distro["release"],
+                            "all-v%d" % HostBootstrap.VERSION)
+
+# Toolchain running Ansible natively against root file-systems of the target
+# (with a chroot connection) rather than installing it in them: it is built
+# from the host bootstrap
+class AnsibleToolchain(Bootstrap):
+    @Trace.stage("ansible toolchain")
+    def create(self, hostBootstrap):
+        dockerfile = tempfile.NamedTemporaryFile(mode="w", delete=False)
+        dockerfile.write(ContainerEngine.dockerfile(ANSIBLE_TOOLCHAIN_SCRIPT.format(hostBootstrap.name)))
+        dockerfile.close()
+
+        try:
+            ContainerEngine.run([
+                "build", "--rm", "--squash",
+                *ContainerEngine.labels("ansible-toolchain"),
+                "-t", self.name, "-f", dockerfile.name],
+                check=True)
+        finally:
+            os.unlink(dockerfile.name)
         return self
 
     def defaultName(self):
-        return os.path.join("bootstrap", self.distro["source"], self.distro["release"], "all")
+        return os.path.join("toolchain", self.distro["source"], self.distro["release"], "ansible")
 
+# Bootstraps of the target distribution are named after (and saved as tarballs
+# keyed by) the settings of the distribution and the Release file of its
+# mirror: a change of mirror or a new point release is a new bootstrap while
+# unchanged ones are loaded from their tarball rather than bootstrapped again.
+# The Release file is only checked once a week (or with --refresh) so that
+# frequently updated distributions (testing, sid) do not get a new bootstrap
+# (and new layers) for every build.
 class TargetBootstrap(Bootstrap):
+    RELEASE_FILES = [ "InRelease", "Release" ]
+    RELEASE_TIMEOUT = 15
+    RELEASE_TTL = 7 * 24 * 3600
+
+    def __init__(self, distro, options):
+        self._key = None
+        super().__init__(distro, options)
+
+    def _distro_digest(self):
+        return hashlib.sha256(json.dumps(self.distro, sort_keys=True).encode()).hexdigest()[:16]
+
+    def _release_digest(self):
+        # hash of the Release file of the mirror (None if it cannot be reached)
+        handlers = []
+        if ContainerEngine.proxy is not None:
+            handlers.append(urllib.request.ProxyHandler({ "http": ContainerEngine.proxy }))
+        opener = urllib.request.build_opener(*handlers)
+        for name in TargetBootstrap.RELEASE_FILES:
+            url = "%s/dists/%s/%s" % (self.distro["uri"].rstrip("/"), self.distro["release"], name)
+            try:
+                with opener.open(url, timeout=TargetBootstrap.RELEASE_TIMEOUT) as response:
+                    return hashlib.sha256(response.read()).hexdigest()[:16]
+            except OSError:
+                continue
+        return None
+
+    def _release_file(self):
+        return Cache.path("bootstrap", "%s.json" % self._distro_digest())
+
+    def _release(self):
+        # digest of the Release file when it was last checked (and when)
+        try:
+            with open(self._release_file()) as f:
+                data = json.load(f)
+            return data["release"], data["checked"]
+        except (OSError, ValueError, KeyError):
+            return None, 0
+
+    def refresh(self):
+        # check the Release file of the mirror if it was not checked recently
+        # (or if requested): the name of the bootstrap only changes here
+        release, checked = self._release()
+        if release is not None and self.options.get("refresh", False) is False \
+                and time.time() - checked < TargetBootstrap.RELEASE_TTL:
+            return self
+        digest = self._release_digest()
+        if digest is None:
+            if release is not None or self.tarballs():
+                print("warning: %s could not be reached, using the last bootstrap of %s" % (
+                      self.distro["uri"], self.distro["release"]))
+            return self
+        os.makedirs(os.path.dirname(self._release_file()), exist_ok=True)
+        temp = self._release_file() + ".part"
+        with open(temp, "w") as f:
+            json.dump({ "release": digest, "checked": int(time.time()) }, f)
+        os.replace(temp, self._release_file())
+        self._key = None
+        self._name = None
+        return self
+
+    def tarballs(self):
+        # cached bootstraps of this distribution, most recent first
+        pattern = Cache.path("bootstrap", "%s-*.tar" % self._distro_digest())
+        return sorted(glob.glob(pattern), key=os.path.getmtime, reverse=True)
+
+    def key(self):
+        # no request is made to the mirror (see refresh)
+        if self._key is None:
+            release, checked = self._release()
+            if release is not None:
+                self._key = "%s-%s" % (self._distro_digest(), release)
+            else:
+                # the Release file was never fetched: use the last bootstrap
+                tarballs = self.tarballs()
+                if tarballs:
+                    self._key = os.path.basename(tarballs[0])[:-len(".tar")]
+        return self._key
+
+    def tarball(self):
+        return Cache.path("bootstrap", "%s.tar" % self.key())
+
+    def _load(self):
+        if self.key() is None or os.path.exists(self.tarball()) is False:
+            return False
+        print("Loading bootstrap of %s from %s..." % (self.distro["release"], self.tarball()))
+        CacheUsage.record(CacheUsage.file(self.tarball()), True)
+        result = ContainerEngine.run(["load", "-q", "-i", self.tarball()], check=False)
+        if result.returncode != 0 or ContainerEngine.hasImage(self.name) is False:
+            return False
+        self._evict()
+        return True
+
+    def _evict(self):
+        # bootstraps (tarballs and images) of previous releases are stale
+        for tarball in self.tarballs():
+            if tarball != self.tarball():
+                ContainerEngine.removeImage("%s:%s" % (self._base(), os.path.basename(tarball)[:-len(".tar")]))
+                os.unlink(tarball)
+
+    def _save(self):
+        if self.key() is None:
+            return
+        os.makedirs(os.path.dirname(self.tarball()), exist_ok=True)
+        temp = self.tarball() + ".part"
+        try:
+            ContainerEngine.run(["save", "-q", "-o", temp, self.name], check=True)
+            os.replace(temp, self.tarball())
+            CacheUsage.record(CacheUsage.file(self.tarball()))
+        except subprocess.CalledProcessError:
+            if os.path.exists(temp):
+                os.unlink(temp)
+            return
+        self._evict()
+
+    @Trace.stage("target bootstrap")
     def create(self, hostBootstrap):
+        if self._load():
+            return self
         self.hostBootstrap = hostBootstrap
         dockerfile = tempfile.NamedTemporaryFile(mode="w", delete=False)
-        dockerfile.write(TARGET_BOOTSTRAP_SCRIPT.format(
+        dockerfile.write(ContainerEngine.dockerfile(TARGET_BOOTSTRAP_SCRIPT.format(
             self.hostBootstrap.name,
             self.distro["architecture"],
             self.distro["release"],
             self.distro["uri"]
-        ))
+        )))
         dockerfile.close()
 
         try:
             ContainerEngine.run([
                 "build", "--rm",
+                *ContainerEngine.labels("target-bootstrap"),
                 "-t", self.name,
                 "-f", dockerfile.name], check=True)
+            self._save()
         except subprocess.CalledProcessError:
             raise
         finally:
-            ContainerEngine.run(["image", "prune", "-f"])
             os.unlink(dockerfile.name)
         return self
 
-    def defaultName(self):
+    def _base(self):
         return os.path.join(
                 "bootstrap",
                 self.distro["source"],
                 self.distro["release"],
                 self.distro["architecture"])
 
+    def defaultName(self):
+        name = self._base()
+        if self.key() is not None:
+            name = "%s:%s" % (name, self.key())
+        return name
+
 HOST_BOOTSTRAP_SCRIPT = """
 FROM {0}:{1} AS base
 RUN                                               \
@@ -112,6 +292,16 @@ RUN rm -rf /usr/share/doc                        \
            /usr/share/man
 """
 
+ANSIBLE_TOOLCHAIN_SCRIPT = """
+FROM {0}
+RUN                                               \
+     apt-get update -qqy &&                       \
+     apt-get install -qqy --no-install-recommends \
+         /opt/seine/seine-ansible*.deb &&         \
+     apt-get clean -qqy &&                        \
+     rm -rf /var/lib/apt/lists/*
+"""
+
 TARGET_BOOTSTRAP_SCRIPT = """
 FROM {0} AS bootstrap
 RUN                                                                  \
@@ -135,6 +325,7 @@ Standards-Version: 3.9.2
 
 Package: seine-ansible
 Depends: ansible, attr, python3-apt
+Files: {0} /usr/share/ansible/plugins/callback/
 Architecture: all
 Description: dependencies for seine
 """
@@ -7,24 +7,52 @@ import subprocess
 import sys
 import yaml
 
+from seine.batch     import Batch, Budget
+from seine.cache     import Artifacts
 from seine.image     import Image
 from seine.cmd       import Cmd
 from seine.partition import PartitionHandler
+from seine.proxy     import AptProxy
+from seine.specs     import SpecCache
+from seine.trace     import Trace
+from seine.utils     import CacheUsage
+from seine.utils     import ContainerEngine
 
 class BuildCmd(Cmd):
+    # use the C implementation of the YAML parser when available
+    LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
     SHORT_OPTIONS = "dDhkv"
     LONG_OPTIONS = [
+        "ansible=",
+        "apt-cache-size=",
+        "apt-proxy",
+        "batch",
+        "bmap",
         "debug",
         "dump",
+        "engine=",
         "help",
+        "imager",
+        "imager-cpus=",
+        "imager-memory=",
+        "io=",
+        "jobs=",
         "keep",
+        "memory=",
+        "no-cache",
+        "pool=",
+        "refresh",
         "sbom",
+        "trace=",
+        "transport=",
         "verbose"
     ]
 
     def __init__(self):
         self.image = None
-        self.options = { "build": True, "debug": False, "keep": False, "sbom": False, "verbose": False }
+        self.loaded = {}
+        self.proxy = None
+        self.options = { "ansible": "target", "apt_cache_size": AptProxy.DEFAULT_SIZE, "apt_proxy": False, "batch": False, "bmap": False, "build": True, "cache": True, "debug": False, "engine": "api", "imager": False, "imager_cpus": None, "imager_memory": None, "keep": False, "pool": 0, "refresh": False, "sbom": False, "trace": None, "transport": "blk", "verbose": False }
         self.partitionHandler = PartitionHandler()
         self.spec = None
 
@@ -32,30 +60,63 @@ class BuildCmd(Cmd):
         return self._load("<string>", yaml_spec)
 
     def load(self, yaml_file):
-        with open(yaml_file, "r") as f:
-            return self._load(yaml_file, f)
+        with open(yaml_file, "rb") as f:
+            return self._load(yaml_file, f.read())
+
+    def _read(self, yaml_file):
+        # contents of loaded files are hashed for the spec cache
+        with open(yaml_file, "rb") as f:
+            content = f.read()
+        return content, SpecCache.digest(content)
+
+    def _parse_yaml(self, yaml_spec):
+        return yaml.load(yaml_spec, Loader=BuildCmd.LOADER)
+
+    def _find_requirement(self, yaml_filename, req):
+        req_path = os.path.join(os.path.dirname(yaml_filename), req)
+        req_yml = os.path.normpath("%s.yml" % req_path)
+        req_yaml = os.path.normpath("%s.yaml" % req_path)
+        if os.path.isfile(req_yml):
+            return req_yml
+        elif os.path.isfile(req_yaml):
+            return req_yaml
+        raise FileNotFoundError("%s: '%s' could not be found in %s/!"
+            % (yaml_filename, req, os.path.dirname(req_path)))
+
+    def _requirements(self, yaml_filename, spec, specs, seen, stack):
+        # walk the graph of requirements depth-first: files are parsed once
+        # and listed when first reached, cycles are errors
+        for req in spec.get("requires") or []:
+            req_path = self._find_requirement(yaml_filename, req)
+            key = os.path.realpath(req_path)
+            if key in stack:
+                cycle = [*stack[stack.index(key):], key]
+                raise ValueError("circular requirements: %s!" % " -> ".join(
+                    [os.path.relpath(path) for path in cycle]))
+            if key in self.loaded or key in seen:
+                continue
+            content, digest = self._read(req_path)
+            req_spec = self._parse_yaml(content)
+            specs.append((key, req_spec, digest))
+            seen.add(key)
+            self._requirements(req_path, req_spec, specs, seen, [*stack, key])
+        return specs
 
     def _load(self, yaml_filename, yaml_spec):
-        spec = yaml.safe_load(yaml_spec)
-
-        if self.spec is None:
-            self.spec = spec
-        else:
-            self.merge(spec)
-
-        if "requires" in spec:
-            for req in spec["requires"]:
-                req_path = os.path.join(os.path.dirname(yaml_filename), req)
-                req_yml = os.path.normpath("%s.yml" % req_path)
-                req_yaml = os.path.normpath("%s.yaml" % req_path)
-                if os.path.isfile(req_yml):
-                    req_path = req_yml
-                elif os.path.isfile(req_yaml):
-                    req_path = req_yaml
-                else:
-                    raise FileNotFoundError("%s: '%s' could not be found in %s/!"
-                        % (yaml_filename, req, os.path.dirname(req_path)))
-                self.load(req_path)
+        spec = self._parse_yaml(yaml_spec)
+        key, digest = None, None
+        if yaml_filename != "<string>":
+            key, digest = os.path.realpath(yaml_filename), SpecCache.digest(yaml_spec)
+        specs = self._requirements(yaml_filename, spec, [(key, spec, digest)], set([key]), [key])
+
+        # merge specifications in the order they were first required
+        for key, spec, digest in specs:
+            if key is not None:
+                self.loaded[key] = digest
+            if self.spec is None:
+                self.spec = spec
+            else:
+                self.merge(spec)
         return self.spec
 
     def _merge_distro(self, spec):
@@ -74,20 +135,6 @@ class BuildCmd(Cmd):
             elif "playbook" not in self.spec:
                 self.spec["playbook"] = spec["playbook"]
 
-    def _lookup_named_part_or_vol(self, parts, label, kind):
-        for part in parts:
-            if part["label"] == label:
-                return part
-        return None
-
-    def _update_named_part_or_vol(self, parts, newpart, kind):
-        index = 0
-        for part in parts:
-            if part["label"] == newpart["label"]:
-                parts[index] = newpart
-            index = index + 1
-        return parts
-
     def _merge_part_flags(self, part, newpart):
         for flag in newpart["flags"]:
             if flag.startswith("~"):
@@ -115,13 +162,16 @@ class BuildCmd(Cmd):
 
     def _merge_parts_or_vols(self, spec, kind):
         parts = self.spec["image"][kind]
+        labels = {}
+        for part in parts:
+            labels.setdefault(part["label"], part)
         for newpart in spec["image"][kind]:
-            part = self._lookup_named_part_or_vol(parts, newpart["label"], kind)
+            part = labels.get(newpart["label"])
             if part is None:
                 parts.append(newpart)
+                labels[newpart["label"]] = newpart
             else:
-                part = self._merge_part_or_vol(part, newpart, kind)
-                parts = self._update_named_part_or_vol(parts, part, kind)
+                self._merge_part_or_vol(part, newpart, kind)
         self.spec["image"][kind] = parts
 
     def _merge_image(self, spec):
@@ -148,11 +198,55 @@ class BuildCmd(Cmd):
         self.spec = self.image.parse(self.spec)
         return self.spec
 
+    def compile(self, specs):
+        # load and parse specification files, use the results of a previous
+        # run if none of the loaded files changed
+        cache = SpecCache(specs) if self.options["cache"] else None
+        if cache is not None:
+            cached = cache.get()
+            if cached is not None:
+                self.spec, self.partitionHandler, state = cached
+                self.image = Image(self.partitionHandler, self.options)
+                self.image.restore(state)
+                return self.spec
+        for spec in specs:
+            self.load(spec)
+        spec = self.parse()
+        if cache is not None:
+            cache.put(self.loaded, (self.spec, self.partitionHandler, self.image.state()))
+        return spec
+
     def build(self):
         if self.spec is None or self.image is None:
             raise RuntimeError("no specification was loaded or parsed!")
         return self.image.build()
 
+    def _memory():
+        try:
+            return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+        except (ValueError, OSError):
+            return 4096
+
+    def batch(self, specs, budget):
+        # each file is a specification of its own
+        builds = []
+        outputs = {}
+        for spec in specs:
+            cmd = BuildCmd()
+            cmd.options.update(self.options)
+            cmd.compile([spec])
+            output = os.path.abspath(cmd.spec["image"]["filename"])
+            if output in outputs:
+                raise ValueError("%s and %s would both produce %s!" % (outputs[output], spec, output))
+            outputs[output] = spec
+            builds.append((spec, cmd))
+        if self.options["build"] is False:
+            for spec, cmd in builds:
+                print("# %s" % spec)
+                print(cmd.dump(cmd.spec))
+            return 0
+        return Batch(builds, budget).run()
+
     def dump(self, spec):
         if "image" in spec:
             # hide internal attributes (_foo) but also "priority" settings
@@ -185,6 +279,16 @@ class BuildCmd(Cmd):
         # return the spec in YAML format
         return yaml.dump(spec)
 
+    def _collect(self):
+        # evict least recently used artifacts once the cache exceeds its quota
+        quota = CacheUsage.quota()
+        if quota is None:
+            return
+        try:
+            Artifacts.gc(quota, self.options["verbose"])
+        except (OSError, subprocess.CalledProcessError) as e:
+            sys.stderr.write("warning: cache could not be collected: {0}\n".format(e))
+
     def main(self, argv):
         try:
             opts, args = getopt.getopt(argv, BuildCmd.SHORT_OPTIONS, BuildCmd.LONG_OPTIONS)
@@ -192,19 +296,63 @@ class BuildCmd(Cmd):
             sys.stderr.write(err)
             sys.stderr.write(USAGE)
             sys.exit(1)
+        budget = { "cpu": os.cpu_count() or 1, "io": 2, "memory": BuildCmd._memory() // 2 }
         for o, a in opts:
-            if o in ("-d", "--debug"):
+            if o in ("--ansible"):
+                if a not in ["host", "target"]:
+                    sys.stderr.write("error: '%s' is not a supported Ansible mode!\n" % a)
+                    sys.exit(1)
+                self.options["ansible"] = a
+            elif o in ("--apt-cache-size"):
+                self.options["apt_cache_size"] = self.partitionHandler._from_human_size(a)
+            elif o in ("--apt-proxy"):
+                self.options["apt_proxy"] = True
+            elif o in ("--batch"):
+                self.options["batch"] = True
+            elif o in ("--bmap"):
+                self.options["bmap"] = True
+            elif o in ("-d", "--debug"):
                 self.options["debug"] = True
                 self.options["verbose"] = True
+            elif o in ("--engine"):
+                if a not in ["api", "cli"]:
+                    sys.stderr.write("error: '%s' is not a supported engine!\n" % a)
+                    sys.exit(1)
+                self.options["engine"] = a
             elif o in ("-h", "--help"):
                 print(USAGE)
                 sys.exit()
+            elif o in ("--imager"):
+                self.options["imager"] = True
+            elif o in ("--imager-cpus"):
+                self.options["imager_cpus"] = int(a)
+            elif o in ("--imager-memory"):
+                self.options["imager_memory"] = self.partitionHandler._from_human_size(a)
+            elif o in ("--io"):
+                budget["io"] = int(a)
+            elif o in ("--jobs"):
+                budget["cpu"] = int(a)
+            elif o in ("--memory"):
+                budget["memory"] = self.partitionHandler._from_human_size(a) // (1024 * 1024)
             elif o in ("-k", "--keep"):
                 self.options["keep"] = True
             elif o in ("-D", "--dump"):
                 self.options["build"] = False
+            elif o in ("--no-cache"):
+                self.options["cache"] = False
+            elif o in ("--pool"):
+                self.options["pool"] = int(a)
+            elif o in ("--refresh"):
+                self.options["refresh"] = True
             elif o in ("--sbom"):
                 self.options["sbom"] = True
+            elif o in ("--trace"):
+                self.options["trace"] = a
+            elif o in ("--transport"):
+                if a not in ["9p", "blk"]:
+                    sys.stderr.write("error: '%s' is not a supported transport!\n" % a)
+                    sys.exit(1)
+                self.options["transport"] = a
             elif o in ("-v", "--verbose"):
                 self.options["verbose"] = True
             else:
@@ -214,11 +362,22 @@ class BuildCmd(Cmd):
             sys.stderr.write("error: build command expects a YAML file\n")
             sys.exit(1)
 
+        if self.options["trace"] is not None:
+            Trace.enable()
+        if self.options["engine"] == "api" and self.options["build"]:
+            if ContainerEngine.connect() is False and self.options["verbose"]:
+                print("podman service could not be started, using the podman command")
+        if self.options["apt_proxy"] and self.options["build"]:
+            try:
+                self.proxy = AptProxy(self.options["apt_cache_size"])
+                ContainerEngine.proxy = self.proxy.start()
+            except RuntimeError as e:
+                sys.stderr.write("warning: %s\n" % e)
         try:
-            for spec in args:
-                self.load(spec)
+            if self.options["batch"]:
+                sys.exit(self.batch(args, Budget(**budget)))
 
-            spec = self.parse()
+            spec = self.compile(args)
             result = 0
             if self.options["build"]:
                 result = self.build()
@@ -235,6 +394,14 @@ class BuildCmd(Cmd):
         except subprocess.CalledProcessError as e:
             sys.stderr.write("error: build failed: {0}\n".format(e))
             sys.exit(4)
+        finally:
+            if self.options["trace"] is not None:
+                Trace.save(self.options["trace"])
+            if self.options["build"]:
+                self._collect()
+                ContainerEngine.disconnect()
+            if self.proxy is not None:
+                self.proxy.release()
 
 USAGE = """
 Build an image using instructions from specifications files
@@ -250,13 +417,35 @@ Usage:
 Examples:
   seine build demo-image.yml
   seine build -v demo-image.yml
+  seine build --batch --jobs=8 product-a.yml product-b.yml
 
 Flags:
+  --ansible=MODE        run playbooks with Ansible installed in the image ("target", default)
+                        or from a toolchain built from the host bootstrap ("host")
+  --apt-cache-size=SIZE size of the cache of the apt proxy (default: 4GiB)
+  --apt-proxy           download packages through a local caching proxy (shared by builds)
+  --batch               build each SPEC as an independent image, concurrently
+  --bmap                produce a block map (.bmap) of the image for "seine flash" or bmaptool
   -d, --debug           print debug messages
   -D, --dump            do not build the image, just dump the consolidated specification
+  --engine=MODE         talk to podman through the REST API of a service started by seine
+                        ("api", default) or run a podman command per operation ("cli")
   -h, --help            print this message
+  --imager              always assemble the image with the imager (virtual machine)
+  --imager-cpus=N       number of vCPUs of the imager (default: from the partitions)
+  --imager-memory=SIZE  memory of the imager (default: from the size of the root file-system)
+  --io=N                run at most N I/O intensive stages at once (--batch, default: 2)
+  --jobs=N              use at most N CPUs (--batch, default: all)
   -k, --keep            keep temporary files
+  --memory=SIZE         use at most SIZE of memory (--batch, default: half of the RAM)
+  --no-cache            do not reuse layers (or parsed specifications) cached by previous builds
+  --pool=N              keep up to N imager virtual machines running to run later builds
+  --refresh             check mirrors for a new release of the distribution (otherwise done
+                        once a week) and use a new bootstrap if there is one
   --sbom                produce a Software Bill of Materials (SBOM) using syft
+  --trace=FILE          record a timeline of the build in FILE (Chrome trace-event format)
+  --transport=MODE      pass the root file-system to the imager with "blk" (read-only disk,
+                        default) or "9p" (file-system share)
   -v, --verbose         produce verbose output while building the image
 
 """
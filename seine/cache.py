@@ -0,0 +1,345 @@
+# seine - Slim Embedded Images Now Easy
+# SPDX-License-Identifier Apache-2.0
+
+import datetime
+import getopt
+import glob
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tarfile
+
+from seine.cmd       import Cmd
+from seine.imager    import Imager
+from seine.partition import PartitionHandler
+from seine.utils     import Cache
+from seine.utils     import CacheUsage
+from seine.utils     import ContainerEngine
+
+class Artifact:
+    def __init__(self, kind, name, size, created, path=None):
+        self.kind = kind
+        self.name = name
+        self.size = size
+        self.created = created
+        self.path = path
+        self.hits = 0
+        self.uses = 0
+        self.last_use = created
+
+    def key(self):
+        if self.path is None:
+            return CacheUsage.image(self.name)
+        return CacheUsage.file(self.path)
+
+# Artifacts kept by builds to be reused by later builds: images of the private
+# root (bootstraps, layers, imager and qemu images) and files of the cache
+# directory (bootstrap tarballs, imager artifacts, parsed specifications and
+# packages downloaded by the apt proxy). Sizes of images include the layers
+# they share with others: the quota is rather conservative.
+class Artifacts:
+    IMAGES = [ "bootstrap", "imager", "layers", "qemu", "toolchain" ]
+
+    def _size(path):
+        if os.path.isdir(path) is False:
+            return os.path.getsize(path)
+        size = 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in filenames:
+                size = size + os.lstat(os.path.join(dirpath, name)).st_size
+        return size
+
+    def _images():
+        artifacts = []
+        for image in ContainerEngine.images():
+            # dangling images are pruned rather than evicted
+            names = image.get("Names") or []
+            if names:
+                name = CacheUsage.image(names[0])[len("image:"):]
+                kind = name.split("/")[0]
+                if kind not in Artifacts.IMAGES:
+                    kind = "image"
+                artifacts.append(Artifact(kind, name, image.get("Size", 0), image.get("Created", 0)))
+        return artifacts
+
+    def _files():
+        patterns = [
+            ("bootstrap", Cache.path("bootstrap", "*.tar")),
+            ("imager", Cache.path("imager", "*", "*")),
+            ("specs", Cache.path("specs", "*.pickle")),
+            ("apt", Cache.path("apt", "files")),
+        ]
+        artifacts = []
+        for kind, pattern in patterns:
+            for path in glob.glob(pattern):
+                try:
+                    st = os.stat(path)
+                    size = Artifacts._size(path)
+                except OSError:
+                    continue
+                artifacts.append(Artifact(kind, os.path.relpath(path, Cache.path()), size,
+                                          st.st_mtime, path))
+        return artifacts
+
+    def list():
+        # artifacts with their usage, least recently used first
+        artifacts = [*Artifacts._images(), *Artifacts._files()]
+        items = CacheUsage.load()["items"]
+        for artifact in artifacts:
+            usage = items.get(artifact.key())
+            if usage is not None:
+                artifact.hits = usage["hits"]
+                artifact.uses = usage["uses"]
+                artifact.last_use = max(usage["last_use"], artifact.created)
+        return sorted(artifacts, key=lambda a: a.last_use)
+
+    def find(artifacts, name):
+        for artifact in artifacts:
+            if name in [artifact.name, artifact.key()]:
+                return artifact
+        return None
+
+    def verify(artifact):
+        # description of what is wrong with an artifact (None if nothing)
+        try:
+            if artifact.path is None:
+                try:
+                    ContainerEngine.imageId(artifact.name)
+                except subprocess.CalledProcessError:
+                    return "image cannot be inspected"
+            elif artifact.kind == "bootstrap":
+                with tarfile.open(artifact.path) as tar:
+                    if "manifest.json" not in tar.getnames():
+                        return "not an image archive"
+            elif artifact.kind == "imager":
+                for name in Imager.ARTIFACTS:
+                    if os.path.getsize(os.path.join(artifact.path, name)) == 0:
+                        return "%s is empty" % name
+            elif artifact.kind == "specs":
+                with open(artifact.path, "rb") as f:
+                    pickle.load(f)
+            elif artifact.kind == "apt":
+                for name in os.listdir(artifact.path):
+                    if name.endswith(".json"):
+                        continue
+                    if name.endswith(".part") is False and not os.path.exists(
+                            os.path.join(artifact.path, name + ".json")):
+                        return "%s has no headers" % name
+        except (OSError, EOFError, tarfile.TarError, pickle.UnpicklingError,
+                AttributeError, ImportError, ValueError) as e:
+            return str(e)
+        return None
+
+    def evict(artifact):
+        # returns False if the artifact is in use (e.g. image of other images)
+        if artifact.path is None:
+            if artifact.kind in ["imager", "qemu"]:
+                # container created with the image to export its files
+                container = artifact.name.rsplit(":", 1)[0].replace("/", "-")
+                ContainerEngine.removeContainer(container)
+            if ContainerEngine.removeImage(artifact.name) is False:
+                return False
+        elif os.path.isdir(artifact.path):
+            shutil.rmtree(artifact.path)
+        else:
+            os.unlink(artifact.path)
+        CacheUsage.forget([artifact.key()])
+        return True
+
+    def prune():
+        # remove dangling images (of builds that did not complete) but final
+        # images of running builds: builds only remove their own objects, this
+        # is only done when requested with "seine cache gc"
+        ContainerEngine.pruneImages({ "label!": [ "seine.stage=finalize" ] })
+
+    def gc(quota, verbose=False, prune=False):
+        # evict least recently used artifacts until they fit in the quota
+        if prune:
+            Artifacts.prune()
+        artifacts = Artifacts.list()
+        used = sum([a.size for a in artifacts])
+        evicted = []
+        for artifact in artifacts:
+            if used <= quota:
+                break
+            if Artifacts.evict(artifact):
+                used = used - artifact.size
+                evicted.append(artifact)
+                if verbose:
+                    print("evicted %s (%s)" % (artifact.name, Artifacts.human_size(artifact.size)))
+        # forget about artifacts that were removed by other means
+        keys = set([a.key() for a in artifacts])
+        stale = [key for key in CacheUsage.load()["items"] if key not in keys]
+        if stale:
+            CacheUsage.forget(stale)
+        return evicted, used
+
+    def human_size(size):
+        return PartitionHandler()._to_human_size(size)
+
+class CacheCmd(Cmd):
+    SHORT_OPTIONS = "hv"
+    LONG_OPTIONS = [
+        "fix",
+        "help",
+        "quota=",
+        "verbose"
+    ]
+    ACTIONS = [ "evict", "gc", "inspect", "list", "verify" ]
+
+    def __init__(self):
+        self.options = { "fix": False, "quota": None, "verbose": False }
+
+    def _date(self, timestamp):
+        return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M")
+
+    def _quota(self):
+        if self.options["quota"] is None:
+            return CacheUsage.quota()
+        return self.options["quota"]
+
+    def list(self, args):
+        artifacts = Artifacts.list()
+        print("%-10s %10s %5s  %-16s %s" % ("KIND", "SIZE", "HITS", "LAST USE", "NAME"))
+        for artifact in reversed(artifacts):
+            print("%-10s %10s %5d  %-16s %s" % (artifact.kind, Artifacts.human_size(artifact.size),
+                  artifact.hits, self._date(artifact.last_use), artifact.name))
+        quota = self._quota()
+        print("\ntotal: %s (quota: %s)" % (Artifacts.human_size(sum([a.size for a in artifacts])),
+              "none" if quota is None else Artifacts.human_size(quota)))
+        return 0
+
+    def inspect(self, args):
+        artifacts = Artifacts.list()
+        for name in args:
+            artifact = Artifacts.find(artifacts, name)
+            if artifact is None:
+                sys.stderr.write("error: '%s' is not a cached artifact!\n" % name)
+                return 1
+            details = {
+                "key": artifact.key(),
+                "kind": artifact.kind,
+                "name": artifact.name,
+                "size": artifact.size,
+                "created": self._date(artifact.created),
+                "last_use": self._date(artifact.last_use),
+                "uses": artifact.uses,
+                "hits": artifact.hits,
+            }
+            if artifact.path is not None:
+                details["path"] = artifact.path
+            print(json.dumps(details, indent=2))
+        return 0
+
+    def verify(self, args):
+        artifacts = Artifacts.list()
+        if args:
+            artifacts = [a for a in artifacts if a.name in args or a.key() in args]
+        broken = 0
+        for artifact in artifacts:
+            problem = Artifacts.verify(artifact)
+            if problem is None:
+                if self.options["verbose"]:
+                    print("%s: ok" % artifact.name)
+                continue
+            broken = broken + 1
+            if self.options["fix"] and Artifacts.evict(artifact):
+                print("%s: %s (evicted)" % (artifact.name, problem))
+            else:
+                print("%s: %s" % (artifact.name, problem))
+        return 1 if broken and not self.options["fix"] else 0
+
+    def evict(self, args):
+        artifacts = Artifacts.list()
+        result = 0
+        for name in args:
+            artifact = Artifacts.find(artifacts, name)
+            if artifact is None:
+                sys.stderr.write("error: '%s' is not a cached artifact!\n" % name)
+                result = 1
+            elif Artifacts.evict(artifact) is False:
+                sys.stderr.write("error: '%s' is in use!\n" % name)
+                result = 1
+        return result
+
+    def gc(self, args):
+        if self.options["quota"] is not None:
+            CacheUsage.set_quota(self.options["quota"])
+        quota = self._quota()
+        if quota is None:
+            sys.stderr.write("error: no quota was set (see --quota)!\n")
+            return 1
+        evicted, used = Artifacts.gc(quota, self.options["verbose"], prune=True)
+        print("evicted %d artifacts, %s used (quota: %s)" % (len(evicted),
+              Artifacts.human_size(used), Artifacts.human_size(quota)))
+        return 0
+
+    def main(self, argv):
+        try:
+            opts, args = getopt.getopt(argv, CacheCmd.SHORT_OPTIONS, CacheCmd.LONG_OPTIONS)
+        except getopt.GetoptError as err:
+            sys.stderr.write("%s\n" % err)
+            sys.stderr.write(USAGE)
+            sys.exit(1)
+        for o, a in opts:
+            if o in ("--fix"):
+                self.options["fix"] = True
+            elif o in ("-h", "--help"):
+                print(USAGE)
+                sys.exit()
+            elif o in ("--quota"):
+                try:
+                    self.options["quota"] = PartitionHandler()._from_human_size(a)
+                except ValueError as e:
+                    sys.stderr.write("error: {0}\n".format(e))
+                    sys.exit(1)
+            elif o in ("-v", "--verbose"):
+                self.options["verbose"] = True
+            else:
+                assert False, "unhandled option"
+
+        if len(args) == 0 or args[0] not in CacheCmd.ACTIONS:
+            sys.stderr.write("error: cache command expects one of: %s\n" % ", ".join(CacheCmd.ACTIONS))
+            sys.exit(1)
+        if args[0] in ["evict", "inspect"] and len(args) == 1:
+            sys.stderr.write("error: %s expects the name of an artifact\n" % args[0])
+            sys.exit(1)
+
+        try:
+            sys.exit(getattr(self, args[0])(args[1:]))
+        except (OSError, subprocess.CalledProcessError) as e:
+            sys.stderr.write("error: {0}\n".format(e))
+            sys.exit(2)
+
+USAGE = """
+Manage artifacts cached by builds
+
+Description:
+  Lists, inspects, verifies and evicts artifacts kept by builds to be reused by later
+  builds: bootstrap, layer, imager and qemu images and the files of the cache directory
+  (bootstrap tarballs, imager artifacts, parsed specifications and apt packages). Their
+  last use and hits are recorded by builds. Once a quota is set, builds evict the least
+  recently used artifacts when they exceed it.
+
+Usage:
+  seine cache [options] list
+  seine cache [options] inspect NAME...
+  seine cache [options] verify [NAME...]
+  seine cache [options] evict NAME...
+  seine cache [options] gc
+
+Examples:
+  seine cache list
+  seine cache --quota=40GiB gc
+  seine cache --fix verify
+
+Flags:
+  --fix                 evict artifacts that failed verification
+  -h, --help            print this message
+  --quota=SIZE          disk quota of the cache (saved for later builds by gc)
+  -v, --verbose         produce verbose output
+
+"""
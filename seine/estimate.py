@@ -0,0 +1,286 @@
+# seine - Slim Embedded Images Now Easy
+# SPDX-License-Identifier Apache-2.0
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# What a mount holds: inodes by type, data blocks and the size of directory
+# entries (per directory) as accounted by the estimator of its file-system
+class Usage:
+    __slots__ = ("files", "dirs", "symlinks", "hardlinks", "others", "blocks", "dirents")
+
+    def __init__(self):
+        self.files = 0
+        self.dirs = 0
+        self.symlinks = 0
+        self.hardlinks = 0
+        self.others = 0
+        self.blocks = 0
+        self.dirents = {}
+
+    def inodes(self):
+        return self.files + self.dirs + self.symlinks + self.others
+
+class Estimator:
+    BLOCK_SIZE = 4096
+    MARGIN_PCT = 1
+    MARGIN_MB  = 1
+
+    def __init__(self, type):
+        self.type = type
+
+    def _blocks(self, size):
+        return (size + self.BLOCK_SIZE - 1) // self.BLOCK_SIZE
+
+    def _dirent_size(self, name):
+        return 8 + len(name)
+
+    def _margin(self, size):
+        return size * self.MARGIN_PCT // 100 + self.MARGIN_MB * 1024 * 1024
+
+    def file_blocks(self, size):
+        return self._blocks(size)
+
+    def file_blocks_many(self, sizes):
+        if numpy is not None:
+            blocks = (numpy.asarray(sizes, dtype=numpy.uint64) + (self.BLOCK_SIZE - 1)) // self.BLOCK_SIZE
+            return int(blocks.sum())
+        return sum([self.file_blocks(size) for size in sizes])
+
+    def symlink_blocks(self, length):
+        return self._blocks(length)
+
+    def account(self, usage, name, kind, linklen=0):
+        # count the inode and its directory entry, data blocks of regular
+        # files are added by the caller (see file_blocks)
+        if kind == "d":
+            usage.dirs = usage.dirs + 1
+        elif kind == "l":
+            usage.symlinks = usage.symlinks + 1
+            usage.blocks = usage.blocks + self.symlink_blocks(linklen)
+        elif kind == "h":
+            usage.hardlinks = usage.hardlinks + 1
+        elif kind == "f":
+            usage.files = usage.files + 1
+        else:
+            usage.others = usage.others + 1
+        pos = name.rfind("/")
+        parent = name[:pos]
+        usage.dirents[parent] = usage.dirents.get(parent, 0) + self._dirent_size(name[pos + 1:])
+
+    def dir_blocks(self, usage):
+        blocks = 0
+        for size in usage.dirents.values():
+            blocks = blocks + max(self._blocks(size), 1)
+        # directories without any entry still use one block
+        return blocks + max(usage.dirs + 1 - len(usage.dirents), 0)
+
+    def options(self, part):
+        return ""
+
+    def estimate(self, part):
+        usage = part["_usage"]
+        size = (usage.blocks + self.dir_blocks(usage)) * self.BLOCK_SIZE
+        return size + self._margin(size)
+
+    def get(type):
+        if type in ESTIMATORS:
+            return ESTIMATORS[type]
+        return Estimator(type)
+
+# ext2/3/4 (as created by mke2fs with a 4 KiB block size and 256-byte inodes):
+# inode tables sized for the files to be extracted (unless the default ratio
+# of mke2fs yields more inodes), bitmaps, superblock and
+# group descriptor backups (including blocks reserved for online resizing)
+# and the journal
+class ExtEstimator(Estimator):
+    BLOCKS_PER_GROUP = 32768
+    INODE_SIZE       = 256
+    INODE_HEADROOM   = 10
+    INODE_RATIO      = 16384
+    RESERVED_BLOCKS  = 6 # root directory, lost+found
+
+    def __init__(self, type):
+        super().__init__(type)
+        self.journal = (type != "ext2")
+        self.extents = (type == "ext4")
+        self.desc_size = 64 if self.extents else 32
+
+    def _dirent_size(self, name):
+        return (8 + len(name) + 3) & ~3
+
+    def file_blocks(self, size):
+        blocks = self._blocks(size)
+        if self.extents:
+            # up to four extents of 128 MiB are stored in the inode itself
+            return blocks + (1 if blocks > 4 * 32768 else 0)
+        # indirect blocks (1024 block addresses per block)
+        if blocks > 12:
+            indirect = blocks - 12
+            blocks = blocks + math.ceil(indirect / 1024)
+            if indirect > 1024:
+                blocks = blocks + math.ceil((indirect - 1024) / (1024 * 1024))
+        return blocks
+
+    def file_blocks_many(self, sizes):
+        if numpy is not None and self.extents:
+            blocks = (numpy.asarray(sizes, dtype=numpy.uint64) + (self.BLOCK_SIZE - 1)) // self.BLOCK_SIZE
+            return int(blocks.sum() + (blocks > 4 * 32768).sum())
+        return sum([self.file_blocks(size) for size in sizes])
+
+    def symlink_blocks(self, length):
+        # fast symlinks are stored in the inode
+        return 0 if length < 60 else 1
+
+    def dir_blocks(self, usage):
+        blocks = 0
+        for size in usage.dirents.values():
+            # "." and ".." then entries; leaves of hashed directories get split
+            # when full and are therefore only partially filled
+            size = size + 24
+            if size > self.BLOCK_SIZE:
+                size = size * 4 // 3
+            blocks = blocks + self._blocks(size)
+        return blocks + max(usage.dirs + 1 - len(usage.dirents), 0)
+
+    def inodes(self, usage):
+        inodes = usage.inodes() + 11 # reserved inodes
+        return inodes + inodes * self.INODE_HEADROOM // 100 + 16
+
+    def default_inodes(self, size):
+        # bytes-per-inode of the "default" usage type of mke2fs.conf (selected
+        # with -T so that small file-systems do not get 4 times as many)
+        return size // self.INODE_RATIO
+
+    def _journal_blocks(self, blocks):
+        if self.journal is False or blocks < 2048:
+            return 0
+        for limit, size in [ (32768, 1024), (256 * 1024, 4096), (512 * 1024, 8192),
+                             (4096 * 1024, 16384), (8192 * 1024, 32768),
+                             (16384 * 1024, 65536), (32768 * 1024, 131072) ]:
+            if blocks < limit:
+                return size
+        return 262144
+
+    def _backups(self, groups):
+        count = 1
+        for base in [3, 5, 7]:
+            n = base
+            while n < groups:
+                count = count + 1
+                n = n * base
+        return count + (1 if groups > 1 else 0)
+
+    def overhead(self, blocks, inodes):
+        groups = math.ceil(blocks / self.BLOCKS_PER_GROUP)
+        per_block = self.BLOCK_SIZE // self.desc_size
+        gdt = math.ceil(groups / per_block)
+        max_groups = math.ceil(min(blocks * 1024, 2 ** 32) / self.BLOCKS_PER_GROUP)
+        rgdt = min(max(math.ceil(max_groups / per_block) - gdt, 0), self.BLOCK_SIZE // 4)
+        per_table = self.BLOCK_SIZE // self.INODE_SIZE
+        inodes_per_group = math.ceil(inodes / groups / per_table) * per_table
+        itable = inodes_per_group * groups // per_table
+        return (self._backups(groups) * (1 + gdt + rgdt) + 2 * groups + itable +
+                self._journal_blocks(blocks) + self.RESERVED_BLOCKS)
+
+    def options(self, part):
+        # inodes are only forced when the default ratio would not give enough
+        # of them for the final size of the partition (including "extra")
+        options = "-b %d -I %d -T default" % (self.BLOCK_SIZE, self.INODE_SIZE)
+        inodes = self.inodes(part["_usage"])
+        if inodes > self.default_inodes(part["_size"]):
+            options = options + " -N %d" % inodes
+        return options
+
+    def estimate(self, part):
+        usage = part["_usage"]
+        data = usage.blocks + self.dir_blocks(usage)
+        data = data + self._blocks(self._margin(data * self.BLOCK_SIZE))
+        # overhead grows with the size of the file-system: iterate
+        blocks = data
+        while True:
+            inodes = max(self.inodes(usage), self.default_inodes(blocks * self.BLOCK_SIZE))
+            total = data + self.overhead(blocks, inodes)
+            if total <= blocks:
+                break
+            blocks = total
+        return blocks * self.BLOCK_SIZE
+
+# FAT (4 KiB clusters): one 32-byte entry per file plus long file name
+# entries, directories occupy whole clusters and the FAT is stored twice
+class VfatEstimator(Estimator):
+    RESERVED_SECTORS = 32
+    SECTOR_SIZE      = 512
+
+    def _dirent_size(self, name):
+        return 32 + math.ceil(len(name) / 13) * 32
+
+    def symlink_blocks(self, length):
+        return 0
+
+    def options(self, part):
+        return "-S %d -s %d" % (self.SECTOR_SIZE, self.BLOCK_SIZE // self.SECTOR_SIZE)
+
+    def estimate(self, part):
+        usage = part["_usage"]
+        clusters = usage.blocks + self.dir_blocks(usage)
+        clusters = clusters + self._blocks(self._margin(clusters * self.BLOCK_SIZE))
+        fats = 2 * self._blocks((clusters + 2) * 4)
+        # FAT16 keeps its root directory in a fixed area of 512 entries
+        root = self._blocks(512 * 32)
+        reserved = self._blocks(self.RESERVED_SECTORS * self.SECTOR_SIZE)
+        return (clusters + fats + root + reserved) * self.BLOCK_SIZE
+
+# btrfs: small files are inlined in metadata, metadata is duplicated (DUP
+# profile) and stored in 16 KiB nodes kept about half full; chunks for data,
+# metadata and system are allocated on top of a minimum file-system size
+class BtrfsEstimator(Estimator):
+    MAX_INLINE     = 2048
+    ITEM_OVERHEAD  = 160 + 2 * 25 + 53 + 12 + 3 * 25
+    MIN_SIZE_MB    = 114
+
+    def file_blocks(self, size):
+        return 0 if size <= self.MAX_INLINE else self._blocks(size)
+
+    def file_blocks_many(self, sizes):
+        return sum([self.file_blocks(size) for size in sizes])
+
+    def estimate(self, part):
+        usage = part["_usage"]
+        names = sum(usage.dirents.values())
+        metadata = (usage.inodes() + usage.hardlinks) * self.ITEM_OVERHEAD + 3 * names
+        metadata = metadata + usage.files * self.MAX_INLINE // 4
+        metadata = 2 * 2 * metadata
+        data = usage.blocks * self.BLOCK_SIZE
+        size = data + metadata + 2 * 8 * 1024 * 1024
+        size = size + self._margin(size)
+        return max(size, self.MIN_SIZE_MB * 1024 * 1024)
+
+# nilfs2: log-structured with 8 MiB segments of which a share is reserved for
+# the garbage collector; checkpoints and segment summaries add some overhead
+class Nilfs2Estimator(Estimator):
+    SEGMENT_SIZE     = 8 * 1024 * 1024
+    RESERVED_PCT     = 5
+    MIN_SEGMENTS     = 8
+    OVERHEAD_PCT     = 10
+
+    def estimate(self, part):
+        usage = part["_usage"]
+        size = (usage.blocks + self.dir_blocks(usage) + usage.inodes() // 16) * self.BLOCK_SIZE
+        size = size + size * self.OVERHEAD_PCT // 100 + self._margin(size)
+        segments = math.ceil(size / self.SEGMENT_SIZE)
+        reserved = max(math.ceil(segments * self.RESERVED_PCT / 100), self.MIN_SEGMENTS)
+        return (segments + reserved + 2) * self.SEGMENT_SIZE
+
+ESTIMATORS = {
+    "btrfs":  BtrfsEstimator("btrfs"),
+    "ext2":   ExtEstimator("ext2"),
+    "ext3":   ExtEstimator("ext3"),
+    "ext4":   ExtEstimator("ext4"),
+    "nilfs2": Nilfs2Estimator("nilfs2"),
+    "vfat":   VfatEstimator("vfat"),
+}
@@ -0,0 +1,109 @@
+# seine - Slim Embedded Images Now Easy
+# SPDX-License-Identifier Apache-2.0
+
+import getopt
+import os
+import sys
+
+from seine.bmap import BlockMap
+from seine.cmd  import Cmd
+
+class FlashCmd(Cmd):
+    SHORT_OPTIONS = "b:hv"
+    LONG_OPTIONS = [
+        "bmap=",
+        "help",
+        "no-verify",
+        "verbose"
+    ]
+
+    def __init__(self):
+        self.options = { "bmap": None, "verify": True, "verbose": False }
+
+    def _find_bmap(self, image):
+        candidates = [ image + ".bmap" ]
+        base, ext = os.path.splitext(image)
+        if ext:
+            candidates.append(base + ".bmap")
+        for candidate in candidates:
+            if os.path.exists(candidate):
+                return candidate
+        return None
+
+    def _progress(self, copied, total):
+        if total > 0:
+            sys.stdout.write("\r%3d%%" % (copied * 100 // total))
+            sys.stdout.flush()
+
+    def flash(self, image, target):
+        bmap_file = self.options["bmap"] or self._find_bmap(image)
+        if bmap_file is not None:
+            bmap = BlockMap.load(bmap_file)
+            if bmap.image_size != os.path.getsize(image):
+                raise ValueError("%s does not match the size of %s!" % (bmap_file, image))
+        else:
+            print("no bmap file found for '%s', scanning the image..." % image)
+            bmap = BlockMap.generate(image)
+        if self.options["verbose"]:
+            print("copying %d of %d blocks from '%s' to '%s'" % (
+                bmap.mapped_blocks_count(), bmap.blocks_count(), image, target))
+        progress = self._progress if self.options["verbose"] else None
+        bmap.copy(image, target, self.options["verify"], progress)
+        if progress is not None:
+            print("")
+
+    def main(self, argv):
+        try:
+            opts, args = getopt.getopt(argv, FlashCmd.SHORT_OPTIONS, FlashCmd.LONG_OPTIONS)
+        except getopt.GetoptError as err:
+            sys.stderr.write(str(err))
+            sys.stderr.write(USAGE)
+            sys.exit(1)
+        for o, a in opts:
+            if o in ("-b", "--bmap"):
+                self.options["bmap"] = a
+            elif o in ("-h", "--help"):
+                print(USAGE)
+                sys.exit()
+            elif o == "--no-verify":
+                self.options["verify"] = False
+            elif o in ("-v", "--verbose"):
+                self.options["verbose"] = True
+            else:
+                assert False, "unhandled option"
+
+        if len(args) != 2:
+            sys.stderr.write("error: flash command expects an image and a target\n")
+            sys.exit(1)
+
+        try:
+            self.flash(args[0], args[1])
+        except OSError as e:
+            sys.stderr.write("error: flash failed: {0}\n".format(e))
+            sys.exit(2)
+        except ValueError as e:
+            sys.stderr.write("error: invalid block map: {0}\n".format(e))
+            sys.exit(3)
+
+USAGE = """
+Copy an image to a block device or file
+
+Description:
+  Copies a disk image produced by "seine build" to a block device (or to another
+  file) using its block map (.bmap) so that only blocks holding data are written.
+  The block map is searched next to the image unless specified.
+
+Usage:
+  seine flash [options] IMAGE TARGET
+
+Examples:
+  seine flash pc-image.img /dev/sdc
+  seine flash -b pc-image.bmap pc-image.img /dev/sdc
+
+Flags:
+  -b, --bmap FILE       block map to use
+  -h, --help            print this message
+  --no-verify           do not verify checksums of copied blocks
+  -v, --verbose         print progress information
+
+"""
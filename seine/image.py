@@ -1,36 +1,60 @@
 # seine - Slim Embedded Images Now Easy
 # SPDX-License-Identifier Apache-2.0
 
+import hashlib
 import os
+import shutil
 import subprocess
-import tarfile
 import tempfile
 import yaml
 
+from seine.assembler import HostAssembler
+from seine.bmap      import BlockMap
+from seine.bootstrap import AnsibleToolchain
 from seine.bootstrap import HostBootstrap
 from seine.bootstrap import TargetBootstrap
 from seine.imager    import Imager
+from seine.manifest  import Manifest
+from seine.output    import OutputFormat
+from seine.pipeline  import Pipeline, Stage
+from seine.profile   import Profile
+from seine.qemu      import Qemu
 from seine.sbom      import SBOM
+from seine.trace     import Trace
+from seine.utils     import CacheUsage
 from seine.utils     import ContainerEngine
 
 class Image:
+    # directory of the host in which playbooks are run (as /host-tmp)
+    HOST_TMP = "/tmp"
+
     def __init__(self, partitionHandler, options={}):
         self.partitionHandler = partitionHandler
         self.options = options
         self.hostBootstrap = None
+        self.toolchain = None
         self._cid = None
         self._iid = None
         self.targetBootstrap = None
         self._from = None
         self._image = None
+        self._sbom_image = None
         self._keep = options["keep"]
+        self._format = None
         self._output = None
+        self.manifest = None
         self._tarball = None
         self._verbose = options["verbose"]
 
     def __del__(self):
+        if self.manifest:
+            self.manifest.close()
+        if self._sbom_image and os.path.exists(self._sbom_image):
+            os.unlink(self._sbom_image)
         if self._tarball:
             self._unlink(self._tarball, "root file-system as a tarball")
+            if os.path.exists(Manifest.sidecar(self._tarball)):
+                self._unlink(Manifest.sidecar(self._tarball), "manifest of the root file-system")
 
     def _unlink(self, path, descr):
         if self._keep:
@@ -57,6 +81,11 @@ class Image:
         if "filename" not in image:
             raise ValueError("output 'filename' not specified in 'image' section!")
         self._output = image["filename"]
+        if "format" not in image:
+            image["format"] = "raw"
+        self._format = OutputFormat.get(image["format"])
+        if "imager" in image:
+            self._parse_imager(image["imager"])
 
         spec = self._parse_playbooks(spec)
 
@@ -67,6 +96,25 @@ class Image:
         self.spec = spec
         return self.spec
 
+    # attributes set by parse() (saved in the spec cache)
+    PARSED = [ "_format", "_from", "_output", "spec" ]
+
+    def state(self):
+        return dict([(attr, getattr(self, attr)) for attr in Image.PARSED])
+
+    def restore(self, state):
+        for attr in Image.PARSED:
+            setattr(self, attr, state[attr])
+
+    def _parse_imager(self, settings):
+        if type(settings) != type({}):
+            raise ValueError("'imager' settings shall be a dictionary!")
+        if "memory" in settings:
+            settings["memory"] = self.partitionHandler._from_human_size(settings["memory"])
+        if "cpus" in settings:
+            if type(settings["cpus"]) != int or settings["cpus"] < 1:
+                raise ValueError("'cpus' of the imager shall be a positive number!")
+
     def _parse_playbooks(self, spec):
 
         playbooks = spec["playbook"] if "playbook" in spec else []
@@ -99,65 +147,213 @@ class Image:
         spec["playbook"] = playbooks
         return spec
 
-    def rootfs(self):
-        if self._from is None:
-            self._from = self.targetBootstrap.name
-
-        ansible = self.spec["playbook"]
-        ansiblefile = tempfile.NamedTemporaryFile(mode="w", delete=False)
-        yaml.dump(ansible, ansiblefile)
-        ansiblefile.close()
+    def _layer_name(self, key):
+        return os.path.join("layers", key)
+
+    def _layer_keys(self, playbooks):
+        # each layer is identified by a hash of the baseline image, the toolchain
+        # and of every playbook applied so far (with the local files it uses):
+        # a change to a playbook therefore only invalidates its own layer and
+        # those stacked on top of it
+        digest = hashlib.sha256()
+        digest.update(ContainerEngine.imageId(self._from).encode())
+        digest.update(ContainerEngine.imageId(self.hostBootstrap.name).encode())
+        if self._host_ansible():
+            digest.update(b"host-ansible")
+            digest.update(ContainerEngine.imageId(self.toolchain.name).encode())
+        keys = [digest.hexdigest()]
+        for playbook in playbooks:
+            digest.update(yaml.dump(playbook).encode())
+            for path in sorted(set(self._local_files(playbook))):
+                self._digest_path(digest, path)
+            keys.append(digest.hexdigest())
+        return keys
+
+    def _host_paths(self, path, subdirs):
+        # candidate paths on the host for a path used by a playbook: relative
+        # paths are looked up next to the playbook (in /host-tmp)
+        if path.startswith("/host-tmp/"):
+            return [os.path.join(Image.HOST_TMP, path[len("/host-tmp/"):])]
+        if os.path.isabs(path):
+            return []
+        return [os.path.join(Image.HOST_TMP, subdir, path) for subdir in subdirs]
+
+    def _local_files(self, node):
+        # files of the host used by a playbook: sources of modules such as
+        # copy or template and roles
+        paths = []
+        if type(node) == type([]):
+            for item in node:
+                paths.extend(self._local_files(item))
+        elif type(node) == type({}):
+            for key, value in node.items():
+                if key == "src" and type(value) == type(""):
+                    paths.extend(self._host_paths(value, ["files", "templates", ""]))
+                    continue
+                roles = []
+                if key == "roles" and type(value) == type([]):
+                    roles = value
+                elif key in ["import_role", "include_role"]:
+                    roles = [value]
+                for role in roles:
+                    if type(role) == type({}):
+                        role = role.get("role", role.get("name"))
+                    if type(role) == type(""):
+                        paths.extend(self._host_paths(role, ["roles"]))
+                paths.extend(self._local_files(value))
+        return paths
+
+    def _digest_path(self, digest, path):
+        # content (and names) of a file or of the files of a directory
+        if os.path.isdir(path):
+            for top, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    self._digest_path(digest, os.path.join(top, name))
+        elif os.path.isfile(path):
+            digest.update(path.encode("utf-8", "surrogateescape") + b"\0")
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+
+    def _cached_layers(self, keys):
+        # find the longest sequence of layers that may be reused
+        if self.options.get("cache", True) is False:
+            return 0
+        count = len(keys)
+        while count > 0:
+            if ContainerEngine.hasImage(self._layer_name(keys[count - 1])):
+                break
+            count = count - 1
+        return count
+
+    def _host_ansible(self):
+        return self.options.get("ansible", "target") == "host"
+
+    def _build_layer(self, name, script, *args, playbook=None, build_args=[], profile=None):
+        ansiblefile = None
+        if playbook is not None:
+            ansiblefile = tempfile.NamedTemporaryFile(mode="w", delete=False)
+            yaml.dump([playbook], ansiblefile)
+            ansiblefile.close()
+            args = (*args, os.path.basename(ansiblefile.name))
 
         iidfile = tempfile.NamedTemporaryFile(mode="r", delete=False)
-
         dockerfile = tempfile.NamedTemporaryFile(mode="w", delete=False)
-        dockerfile.write(IMAGE_ANSIBLE_SCRIPT.format(
-            self._from, self.hostBootstrap.name,
-            "-v" if self._verbose else "",
-            os.path.basename(ansiblefile.name)))
+        dockerfile.write(ContainerEngine.dockerfile(script.format(*args)))
         dockerfile.close()
 
         try:
-            self._iid = None
+            # layers are kept as cache, the final image is temporary
+            stage = "finalize" if name is None else "layer"
             cmd = [ "build", "--rm", "--iidfile", iidfile.name,
-                    "-v", "/tmp:/host-tmp:ro", "-f", dockerfile.name]
+                    *ContainerEngine.labels(stage), *build_args,
+                    "-v", "%s:/host-tmp:ro" % Image.HOST_TMP, "-f", dockerfile.name]
+            if name is not None:
+                cmd.extend(["-t", name])
             if self._verbose == False:
                 cmd.append("-q")
-            ContainerEngine.run(cmd, check=True)
+            layer = "finalize" if name is None else "prepare"
+            if playbook is not None:
+                layer = playbook.get("name", "unnamed")
+            # records of the seine_profile callback are not printed
+            with Trace.span("layer", args={ "playbook": layer }):
+                ContainerEngine.run(cmd, check=True, lines=profile.feed if profile else None)
             iidfile.seek(0)
-            self._iid = iidfile.readline()
+            return iidfile.readline()
         except subprocess.CalledProcessError:
             raise
         finally:
-            os.unlink(ansiblefile.name)
+            if ansiblefile is not None:
+                os.unlink(ansiblefile.name)
             os.unlink(dockerfile.name)
             os.unlink(iidfile.name)
 
+    @Trace.stage("rootfs")
+    def rootfs(self):
+        if self._from is None:
+            self._from = self.targetBootstrap.name
+        if ContainerEngine.hasImage(self._from) == False:
+            ContainerEngine.run(["pull", self._from], check=True)
+
+        playbooks = self.spec["playbook"]
+        keys = self._layer_keys(playbooks)
+        cached = self._cached_layers(keys)
+        if cached > 0:
+            print("Reusing %d of %d cached layers..." % (cached, len(keys)))
+        for index in range(len(keys)):
+            CacheUsage.record(CacheUsage.image(self._layer_name(keys[index])), index < cached)
+
+        # layer #0 has Ansible (or what its modules need when it is run from
+        # the host toolchain) installed, layer #n has playbooks 1..n applied
+        host = self._host_ansible()
+        if cached == 0:
+            if host:
+                self._build_layer(self._layer_name(keys[0]), IMAGE_HOST_PREPARE_SCRIPT,
+                    self._from)
+            else:
+                self._build_layer(self._layer_name(keys[0]), IMAGE_PREPARE_SCRIPT,
+                    self._from, self.hostBootstrap.name)
+            cached = 1
+
+        refresh = "apt-get update -qqy &&"
+        profile = Profile(os.path.basename(self._output or "rootfs"))
+        # the slowest tasks are reported even if a playbook failed, only
+        # profiles of successful builds are kept
+        try:
+            for index in range(cached, len(keys)):
+                playbook = playbooks[index - 1]
+                print("Applying playbook %d of %d (%s)..." % (index, len(playbooks),
+                      playbook["name"] if "name" in playbook else "unnamed"))
+                if host:
+                    # the layer is stacked on the previous one, the toolchain
+                    # is mounted (writes to it are discarded) and reaches the
+                    # root file-system with a bind mount
+                    self._build_layer(self._layer_name(keys[index]), IMAGE_HOST_PLAYBOOK_SCRIPT,
+                        self._layer_name(keys[index - 1]), refresh,
+                        "-v" if self._verbose else "", self.toolchain.name, playbook=playbook,
+                        build_args=["--cap-add", "SYS_ADMIN"], profile=profile)
+                else:
+                    self._build_layer(self._layer_name(keys[index]), IMAGE_PLAYBOOK_SCRIPT,
+                        self._layer_name(keys[index - 1]), refresh,
+                        "-v" if self._verbose else "", playbook=playbook, profile=profile)
+                # package lists of a reused layer may be stale, refresh them once
+                refresh = ""
+            profile.save()
+        finally:
+            profile.report()
+
+        self._iid = None
+        self._iid = self._build_layer(None, IMAGE_FINALIZE_SCRIPT,
+            self._layer_name(keys[-1]), "" if host else "seine-ansible")
+
+    @Trace.stage("build_tarball")
     def build_tarball(self):
         try:
             self._tarball = None
             image = tempfile.NamedTemporaryFile(mode="w", delete=False, dir=os.getcwd(), prefix='root-', suffix='.tar')
-            self._cid = ContainerEngine.check_output(["container", "create", self._iid]).strip()
-            ContainerEngine.run(["container", "export", "-o", image.name, self._cid], check=True)
+            image.close()
+            self._cid = ContainerEngine.createContainer(self._iid, "export")
+            # the manifest is built while the tarball is received
+            with ContainerEngine.export(self._cid) as stream:
+                self.manifest = Manifest.receive(stream, image.name)
             self._tarball = image.name
-        except subprocess.CalledProcessError:
+        except:
             os.unlink(image.name)
             raise
         finally:
             if self._cid:
-                ContainerEngine.run(["container", "rm", self._cid], check=False)
+                ContainerEngine.removeContainer(self._cid)
                 self._cid = None
             if self._iid:
-                ContainerEngine.run(["image", "rm", self._iid], check=False)
+                ContainerEngine.removeImage(self._iid)
                 self._iid = None
-            ContainerEngine.run(["image", "prune", "-f"], check=False)
 
+    @Trace.stage("size_partitions")
     def _size_partitions(self):
-        tar = tarfile.open(self._tarball, "r")
-        files = tar.getmembers()
-        for f in files:
-            self.partitionHandler.distribute(f)
-        tar.close()
+        manifest = self.manifest
+        self.partitionHandler.distribute_many(manifest.paths(), manifest.sizes,
+                                              manifest.types, manifest.linklens())
         self.partitionHandler.compute_sizes()
         self.partitionHandler.print_stats()
 
@@ -168,49 +364,162 @@ class Image:
         image.close()
         self._image = image.name
 
-    def build(self):
+    def _bmap_file(self):
+        # bmaptool looks for the block map of "foo.img.xz" in "foo.img.bmap"
+        output = self._output
+        if self._format.SUFFIX and output.endswith(self._format.SUFFIX):
+            output = output[:-len(self._format.SUFFIX)]
+        return output + ".bmap"
+
+    @Trace.stage("bootstrap")
+    def bootstrap(self):
+        # Create required bootstrap images
+        distro = self.spec["distribution"]
+        self.hostBootstrap = HostBootstrap(distro, self.options)
+        self.targetBootstrap = TargetBootstrap(distro, self.options)
+        if self._from is None:
+            self.targetBootstrap.refresh()
+        if ContainerEngine.cachedImage(self.hostBootstrap.name) == False:
+            self.hostBootstrap.create()
+        if self._from is None and ContainerEngine.cachedImage(self.targetBootstrap.name) == False:
+            self.targetBootstrap.create(self.hostBootstrap)
+        if self._host_ansible():
+            self.toolchain = AnsibleToolchain(distro, self.options)
+            if ContainerEngine.cachedImage(self.toolchain.name) == False:
+                self.toolchain.create(self.hostBootstrap)
+
+    def _sbom_source(self):
+        # the raw image is scanned through a link of its own: it may then be
+        # written (and removed) while being scanned
+        if self.options.get("sbom", False) and self._image is not None:
+            self._sbom_image = self._image + ".sbom"
+            os.link(self._image, self._sbom_image)
+
+    @Trace.stage("sbom")
+    def sbom(self):
+        sbom = SBOM(self.options)
         try:
-            # Create required bootstrap images
-            distro = self.spec["distribution"]
-            self.hostBootstrap = HostBootstrap(distro, self.options)
-            self.targetBootstrap = TargetBootstrap(distro, self.options)
-            if ContainerEngine.hasImage(self.hostBootstrap.name) == False:
-                self.hostBootstrap.create()
-            if self._from is None and ContainerEngine.hasImage(self.targetBootstrap.name) == False:
-                self.targetBootstrap.create(self.hostBootstrap)
-
-            # Assemble the root file-system
-            self.rootfs()
-            self.build_tarball()
-
-            # Generate SBOM
-            sbom = SBOM(self.options)
-            sbom.generate(self._output)
-
-            # Prepare target partitions and disk image
-            imager = Imager(self)
-            self._size_partitions()
-            script = self.partitionHandler.script("/dev/sdb", Imager.TARGET_DIR)
-            self._empty_disk()
+            sbom.generate(self._sbom_image or self._output, self._output)
+        finally:
+            self._drop_sbom_source()
 
-            # Produce the target image
+    async def asbom(self):
+        sbom = SBOM(self.options)
+        try:
+            with Trace.span("sbom"):
+                await sbom.agenerate(self._sbom_image or self._output, self._output)
+        finally:
+            self._drop_sbom_source()
+
+    def _drop_sbom_source(self):
+        if self._sbom_image is not None:
+            os.unlink(self._sbom_image)
+            self._sbom_image = None
+
+    @Trace.stage("assemble")
+    def assemble(self):
+        # Prepare target partitions and disk image
+        self._size_partitions()
+        self._empty_disk()
+
+        # Produce the target image, on the host unless the imager is needed
+        reason = HostAssembler.unsupported(self)
+        if reason is None:
+            print("Assembling image on the host...")
+            HostAssembler(self).create()
+        else:
+            if self._verbose:
+                print("Using the imager (%s)" % reason)
+            imager = Imager(self)
+            script = self.partitionHandler.script("${disk}", Imager.TARGET_DIR)
             imager.create(script, Imager.TARGET_DIR)
+        self._sbom_source()
+
+    @Trace.stage("write")
+    def write(self):
+        # Produce the block map of the (still sparse) raw image
+        if self.options.get("bmap", False):
+            print("Generating block map...")
+            BlockMap.generate(self._image).save(self._bmap_file())
+
+        # Write the image in the requested format
+        if self._format.name != "raw":
+            print("Writing %s image..." % self._format.name)
+        self._format.write(self._image, self._output, Qemu(self))
+        self._image = None
+
+    def _stages(self):
+        # the imager and qemu images are prepared while playbooks are applied
+        # when the specification alone requires them
+        imager = HostAssembler.unsupported(self) is not None
+        qemu = (imager and Imager.kvm() is False) or (
+            self._format.name == "qcow2" and shutil.which("qemu-img") is None)
+        return [
+            Stage("bootstrap", self.bootstrap),
+            Stage("rootfs", self.rootfs, ["bootstrap"]),
+            Stage("export", self.build_tarball, ["rootfs"]),
+            Stage("imager", lambda: Imager(self).prepare(), ["bootstrap"], imager),
+            Stage("qemu", lambda: Qemu(self).create(), ["bootstrap"], qemu),
+            Stage("assemble", self.assemble, ["export", "imager", "qemu"]),
+            Stage("sbom", self.asbom, ["assemble"], self.options.get("sbom", False)),
+            Stage("write", self.write, ["assemble"]),
+        ]
 
-            # Rename the image
-            os.rename(self._image, self._output)
+    def build(self):
+        build_id = ContainerEngine.begin()
+        try:
+            Pipeline(self._stages()).run()
 
         except:
             if self._image is not None:
                 os.unlink(self._image)
             raise
+        finally:
+            ContainerEngine.cleanup(build_id)
 
-IMAGE_ANSIBLE_SCRIPT = """
-FROM {0} AS playbooks
+IMAGE_PREPARE_SCRIPT = """
+FROM {0}
 COPY --from={1} /opt/seine /opt/seine
 RUN apt-get update -qqy && \
-    apt-get install -qqy /opt/seine/seine-ansible*.deb && \
-    ansible-playbook {2} /host-tmp/{3} && \
-    mkdir -p /var/lib/seine && \
+    apt-get install -qqy /opt/seine/seine-ansible*.deb
+"""
+
+IMAGE_PLAYBOOK_SCRIPT = """
+FROM {0}
+RUN {1} ansible-playbook {2} /host-tmp/{3}
+"""
+
+IMAGE_HOST_PREPARE_SCRIPT = """
+FROM {0}
+RUN missing=$(for p in python3 python3-apt attr; do                   \
+        dpkg -s $p >/dev/null 2>&1 || echo $p; done) &&                 \
+    if [ -n "$missing" ]; then                                          \
+        apt-get update -qqy &&                                          \
+        apt-get install -qqy $missing &&                                \
+        apt-mark auto $missing >/dev/null;                              \
+    fi
+"""
+
+IMAGE_HOST_PLAYBOOK_SCRIPT = """
+FROM {0}
+RUN --mount=type=bind,from={3},target=/toolchain,rw                     \
+    mkdir -p /toolchain/rootfs &&                                       \
+    mount --rbind / /toolchain/rootfs &&                                \
+    mount --rbind /dev /toolchain/dev &&                                \
+    mount -t proc proc /toolchain/proc &&                               \
+    {1} chroot /toolchain ansible-playbook {2} -i localhost,            \
+        -e ansible_connection=chroot -e ansible_host=/rootfs            \
+        -e ansible_python_interpreter=/usr/bin/python3                  \
+        /rootfs/host-tmp/{4};                                           \
+    rc=$?;                                                              \
+    umount -R /toolchain/rootfs; umount -R /toolchain/dev;              \
+    umount /toolchain/proc;                                             \
+    exit $rc
+"""
+
+IMAGE_FINALIZE_SCRIPT = """
+FROM {0} AS playbooks
+RUN mkdir -p /var/lib/seine && \
     getfattr -Rh -m '' -d $(find / -mindepth 1 -maxdepth 1 -type d \
         -not -name host-tmp \
         -not -name proc \
@@ -219,7 +528,7 @@ RUN apt-get update -qqy && \
         -printf '%P\\n') \
     > /rootfs.xattr
 FROM playbooks as clean
-RUN apt-get autoremove -qy seine-ansible && \
+RUN apt-get autoremove -qy {1} && \
     apt-get clean -y &&                     \
     rm -rf /var/lib/apt/lists/* &&          \
     rm -f /usr/bin/qemu-*-static
@@ -1,18 +1,29 @@
 # seine - Slim Embedded Images Now Easy
 # SPDX-License-Identifier Apache-2.0
 
+import collections
 import grp
 import os
+import shutil
 import subprocess
 import sys
-import tarfile
 import tempfile
 
 from seine.bootstrap import Bootstrap
+from seine.pool      import ImagerPool
 from seine.qemu      import Qemu
+from seine.trace     import Trace
+from seine.utils     import Cache
+from seine.utils     import CacheUsage
 from seine.utils     import ContainerEngine
 
 class Imager(Bootstrap):
+    ARTIFACTS = [ "vmlinuz", "initrd.img", "rootfs" ]
+    PROTOCOL = 3
+    MIN_MEMORY = 512
+    MAX_CACHE = 1536
+    MAX_CPUS = 8
+    TARBALL_SERIAL = "seine-rootfs"
     TARGET_DIR = "/tmp/image"
     PACKAGES = [
         "attr",
@@ -32,7 +43,9 @@ class Imager(Bootstrap):
         self.debug = source.options["debug"]
         self.keep = source.options["keep"]
         self.qemu = Qemu(source)
+        self.transport = source.options.get("transport", "blk")
         self.verbose = source.options["verbose"]
+        self._section = None
         super().__init__(source.spec["distribution"], source.options)
 
     def _unlink(self, path, descr):
@@ -48,7 +61,9 @@ class Imager(Bootstrap):
         return self.name
 
     def defaultName(self):
-        return os.path.join("imager", self.distro["source"], self.distro["release"], "all")
+        # the imager script is part of the image: name it after its protocol
+        return os.path.join("imager", self.distro["source"], self.distro["release"],
+                            "all-v%d" % Imager.PROTOCOL)
 
     def build_imager(self):
         hostBootstrap = self.source.hostBootstrap
@@ -62,7 +77,7 @@ class Imager(Bootstrap):
         scriptfile.close()
 
         dockerfile = tempfile.NamedTemporaryFile(mode="w", delete=False)
-        dockerfile.write("""
+        dockerfile.write(ContainerEngine.dockerfile("""
             FROM {0} AS bootstrap
             RUN                                                                    \
                 apt-get update -qqy &&                                             \
@@ -113,55 +128,73 @@ class Imager(Bootstrap):
             os.path.basename(unitfile.name),
             os.path.basename(scriptfile.name),
             self.imageName
-        ))
+        )))
         dockerfile.close()
 
         imageCreated = False
         try:
             ContainerEngine.run([
                 "build", "--rm", "--squash",
+                *ContainerEngine.labels("imager"),
                 "-t", self.image_id(),
                 "-v", "/tmp:/host-tmp:ro",
                 "-f", dockerfile.name], check=True)
             imageCreated = True
-            ContainerEngine.run([
-                "container", "create",
-                "--name", self.container_id(), self.image_id()], check=True)
+            ContainerEngine.createContainer(self.image_id(), "imager", self.container_id())
         except subprocess.CalledProcessError:
             if imageCreated is True:
-                ContainerEngine.run(["image", "rm", self.image_id()], check=False)
+                ContainerEngine.removeImage(self.image_id())
             raise
         finally:
             self._unlink(dockerfile.name, "dockerfile for the imager")
             self._unlink(scriptfile.name, "imager script")
             self._unlink(unitfile.name, "systemd unit file for the imager")
 
-    def get_file(self, name, output_dir):
-        output = os.path.join(output_dir, name)
-        with open(output, "w") as output_file:
+    def cache_dir(self):
+        digest = ContainerEngine.imageId(self.image_id()).replace(":", "-")
+        return Cache.path("imager", self.container_id(), digest)
+
+    def get_artifacts(self):
+        # the kernel, initrd and ISO are extracted from the imager container in
+        # a single pass and kept on the host for as long as the image exists
+        cache = self.cache_dir()
+        artifacts = [os.path.join(cache, name) for name in Imager.ARTIFACTS]
+        cached = all([os.path.exists(f) for f in artifacts])
+        CacheUsage.record(CacheUsage.file(cache), cached)
+        if cached:
+            return artifacts
+
+        # artifacts of previous imager images are stale, directories of
+        # extractions in progress (of concurrent builds) are left alone
+        parent = os.path.dirname(cache)
+        os.makedirs(parent, exist_ok=True)
+        for name in os.listdir(parent):
+            if name != os.path.basename(cache) and name.startswith("tmp") is False:
+                shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+
+        output_dir = tempfile.mkdtemp(prefix="tmp", dir=parent)
+        try:
+            tar_proc = subprocess.Popen(
+                [ "tar", "-xf", "-", "-C", output_dir, *Imager.ARTIFACTS ],
+                stdin=subprocess.PIPE)
             try:
-                podman_proc = ContainerEngine.Popen(
-                    [ "container", "export", self.container_id() ],
-                    stdout=subprocess.PIPE)
-                tar_proc = subprocess.Popen(
-                    [ "tar", "-Oxf", "-", name ],
-                    stdin=podman_proc.stdout,
-                    stdout=output_file)
-                out, err = tar_proc.communicate(input=300)
-                podman_proc.wait()
-                return output
-            except:
-                os.unlink(output)
+                with ContainerEngine.export(self.container_id()) as stream:
+                    shutil.copyfileobj(stream, tar_proc.stdin)
+            finally:
+                tar_proc.stdin.close()
+                tar_proc.wait()
+            if tar_proc.returncode != 0:
+                raise subprocess.CalledProcessError(tar_proc.returncode, tar_proc.args)
+            os.rename(output_dir, cache)
+        except OSError:
+            # artifacts may have been extracted by a concurrent build
+            shutil.rmtree(output_dir, ignore_errors=True)
+            if all([os.path.exists(f) for f in artifacts]) is False:
                 raise
-
-    def get_kernel(self, output_dir):
-        return self.get_file("vmlinuz", output_dir)
-
-    def get_initrd(self, output_dir):
-        return self.get_file("initrd.img", output_dir)
-
-    def get_imager(self, output_dir):
-        return self.get_file("rootfs", output_dir)
+        except:
+            shutil.rmtree(output_dir, ignore_errors=True)
+            raise
+        return artifacts
 
     def build_script(self, script, targetdir):
         script_file = tempfile.NamedTemporaryFile(mode="w", delete=False, dir=os.getcwd())
@@ -169,148 +202,295 @@ class Imager(Bootstrap):
         script_file.write("set -e\n")
         if self.debug:
             script_file.write("set -x\n")
+        script_file.write("echo '# Creating partitions'\n")
         script_file.write(script)
         script_file.write("\ncd %s\n" % targetdir)
         script_file.write("echo '# Extracting rootfs'\n")
-        script_file.write("tar -xf /mnt${tarball}\n")
+        script_file.write("SECONDS=0\n")
+        script_file.write(self.source.partitionHandler.extract_script(
+            "${tardev:-/mnt${tarball}}", self.source.manifest))
+        script_file.write("echo \"# Extracted rootfs in ${SECONDS}s\"\n")
         script_file.write("update_fstab >etc/fstab\n")
         script_file.write(IMAGER_POST_INSTALL_SCRIPT)
         script_file.write(IMAGER_SELINUX_SETUP_SCRIPT)
         script_file.write(IMAGER_GRUB_INSTALL_SCRIPT)
         script_file.write("copy_bootlets\n")
+        script_file.write(IMAGER_TRIM_SCRIPT.format(targetdir))
         script_file.write("df -h|grep -e '^Filesystem' -e {0}|sed -e 's,{0},/,g'|sed -e 's,^,# ,g' -e 's,//,/,g'\n".format(targetdir))
         script_file.close()
         return script_file.name
 
     def _process_xattrs(self, output_dir):
         output = os.path.join(output_dir, "rootfs.xattr")
-        with tarfile.open(self.source._tarball) as tar:
-            files = []
-            for f in tar.getmembers():
-                if f.issym() or f.isdir():
-                    continue
-                files.append(f.name)
-            content = tar.extractfile('rootfs.xattr').readlines()
-            f = open(output, "w")
-            lines = []
-            present = False
-            for line in content:
-                line = line.decode().strip()
-                if line.startswith("# file: "):
-                    if lines:
-                        f.write("\n".join(lines))
-                        f.write("\n")
-                        lines = []
-                    target = line[8:]
-                    present = (target in files)
-                if present is True:
-                    lines.append(line)
-            f.close()
-            return output
-
+        manifest = self.source.manifest
+        files = set()
+        for f in manifest:
+            if f.issym() or f.isdir():
+                continue
+            files.add(f.name)
+        content = manifest.read(self.source._tarball, 'rootfs.xattr').splitlines()
+        f = open(output, "w")
+        lines = []
+        present = False
+        for line in content:
+            line = line.decode().strip()
+            if line.startswith("# file: "):
+                if lines:
+                    f.write("\n".join(lines))
+                    f.write("\n")
+                    lines = []
+                target = line[8:]
+                present = (target in files)
+            if present is True:
+                lines.append(line)
+        f.close()
+        return output
+
+    def kvm():
+        user_groups = [grp.getgrgid(g).gr_name for g in os.getgroups()]
+        return 'kvm' in user_groups
+
+    @Trace.stage("imager prepare")
+    def prepare(self):
+        if ContainerEngine.cachedImage(self.image_id()) is False:
+            self.build_imager()
+        return self.get_artifacts()
+
+    def _available_memory():
+        try:
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    if line.startswith("MemAvailable:"):
+                        return int(line.split()[1]) // 1024
+        except OSError:
+            pass
+        return None
+
+    def resources(self):
+        # memory (MiB) and vCPUs of the imager: from the command line, the spec
+        # or sized after the root file-system and the resources of the host
+        settings = self.source.spec["image"].get("imager", {})
+        memory = self.source.options.get("imager_memory") or settings.get("memory")
+        cpus = self.source.options.get("imager_cpus") or settings.get("cpus")
+        if memory is None:
+            # leave room for the page cache while extracting the root file-system
+            data = sum(self.source.manifest.sizes) // (1024 * 1024)
+            memory = Imager.MIN_MEMORY + min(data // 8, Imager.MAX_CACHE)
+            available = Imager._available_memory()
+            if available is not None:
+                memory = min(memory, available // 2)
+            memory = max(memory, Imager.MIN_MEMORY)
+        else:
+            memory = memory // (1024 * 1024)
+        if cpus is None:
+            # file-systems are created concurrently
+            mounts = len(self.source.partitionHandler.mounts)
+            cpus = min(os.cpu_count() or 1, max(2, mounts + 1), Imager.MAX_CPUS)
+        return memory, cpus
+
+    def _launcher(self, dirs, extra_args=[]):
+        # run qemu from the host when the user may use kvm, from the qemu
+        # container otherwise (with the provided directories mounted)
+        if Imager.kvm():
+            return subprocess, [], "kvm", ["/"]
+        self.qemu.create()
+        imager_dirs = []
+        for d in dirs:
+            if d not in imager_dirs:
+                imager_dirs.append(d)
+        imager_args = ['run', *extra_args]
+        for d in imager_dirs:
+            imager_args.append('-v')
+            imager_args.append('{}:{}:z'.format(d, d))
+        imager_args.append(self.qemu.image_id())
+        return ContainerEngine, imager_args, "qemu-system-x86_64", imager_dirs
+
+    def _imager_cmd(self, imager_vm, kernel_args, extra_cmd):
+        imager_kernel, imager_initrd, imager_rootfs = self.get_artifacts()
+
+        # boot the live image with SELinux disabled
+        kernel_cmd = 'boot=live console=ttyS0 selinux=0'
+
+        # quiet the kernel and systemd
+        kernel_cmd += ' quiet loglevel=0 systemd.mask=getty.target systemd.show_status=false'
+
+        # settings for the imager script
+        kernel_cmd += ''.join([' {}={}'.format(k, v) for k, v in kernel_args.items()])
+
+        memory, cpus = self.resources()
+        accel = []
+        if imager_vm != "kvm":
+            # let each vCPU run on its own host thread
+            accel = [ "-accel", "tcg,thread=multi" ]
+
+        return [
+            imager_vm,
+            *accel,
+            "-m", "%d" % memory,
+            "-smp", "%d" % cpus,
+            "-kernel", imager_kernel,
+            "-initrd", imager_initrd,
+            "-append", kernel_cmd,
+            "-drive", "file={},index=0,media=disk,format=raw,readonly=on".format(imager_rootfs),
+            "-fsdev", "local,id=hostfs_dev,path=/,security_model=none",
+            "-device", "virtio-9p-pci,fsdev=hostfs_dev,mount_tag=hostfs_mount",
+            "-display", "none",
+            *extra_cmd
+        ]
+
+    def _log(self, log, tail):
+        # handle a message from the imager, returns its exit code once done
+        print_log = self.verbose
+        if log.startswith("EXIT "):
+            self._trace_section(None)
+            return int(log[5:].strip())
+        if log.startswith("LOG "):
+            log = log[4:]
+        if log.startswith('# '):
+            log = log[2:]
+            print_log = True
+            self._trace_section(log.strip())
+        if print_log is True:
+            print(log.strip())
+        tail.append(log)
+        return None
+
+    def _trace_section(self, name):
+        # sections of the imager script start with a "# " line and end with
+        # the next one (or the exit of the script)
+        if self._section is not None:
+            Trace.complete(self._section[0], self._section[1], cat="imager")
+        self._section = (name, Trace.now()) if name is not None else None
+
+    def _failed(self, result, tail, cmd):
+        if self.verbose is False:
+            for line in tail:
+                sys.stderr.write(line.rstrip("\n") + "\n")
+        raise subprocess.CalledProcessError(result, cmd)
+
+    def start_warm(self, vm, dirs):
+        artifacts = [os.path.dirname(f) for f in self.get_artifacts()]
+        imager_proc, imager_args, imager_vm, imager_dirs = self._launcher(
+            [*artifacts, *dirs, vm.path],
+            ["-d", "--rm", *ContainerEngine.labels("imager-pool"),
+             "--name", "seine-imager-%s" % os.path.basename(vm.path)])
+        imager_cmd = self._imager_cmd(imager_vm,
+            { "control": vm.CONTROL_PORT, "idle": vm.IDLE_TIMEOUT }, [
+            "-device", "virtio-scsi-pci,id=scsi0",
+            "-device", "virtio-serial-pci",
+            "-chardev", "socket,id=control,path={},server=on,wait=off".format(vm.control_socket()),
+            "-device", "virtserialport,chardev=control,name={}".format(vm.CONTROL_PORT),
+            "-qmp", "unix:{},server=on,wait=off".format(vm.qmp_socket()),
+            "-serial", "file:{}".format(os.path.join(vm.path, "console.log"))
+        ])
+        print("Starting warm imager using %s..." % imager_vm)
+        if self.verbose is True:
+            print(' '.join([*imager_args, *imager_cmd]))
+        info = { "dirs": imager_dirs }
+        if imager_proc is ContainerEngine:
+            ContainerEngine.run([*imager_args, *imager_cmd], check=True)
+            info["container"] = "seine-imager-%s" % os.path.basename(vm.path)
+        else:
+            proc = subprocess.Popen(imager_cmd, stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+            info["pid"] = proc.pid
+        vm.save_info(info)
+
+    def _run_warm(self, vm, script_file, xattrs):
+        tail = collections.deque(maxlen=20)
+        job = { "script": script_file, "tarball": self.source._tarball, "xattrs": xattrs }
+        disks = [ vm.attach(self.source._image) ]
+        result = None
+        try:
+            if self.transport == "blk":
+                disks.append(vm.attach(self.source._tarball, readonly=True))
+                job["tarserial"] = disks[-1][0]
+            for log in vm.run(disks[0], **job):
+                result = self._log(log, tail)
+        finally:
+            self._trace_section(None)
+            for disk in disks:
+                vm.detach(disk)
+        if result != 0:
+            self._failed(result, tail, "imager job")
+
+    def _run_oneshot(self, script_file, xattrs):
+        files = [script_file, *self.get_artifacts(), xattrs]
+        imager_proc, imager_args, imager_vm, imager_dirs = self._launcher(
+            [os.path.dirname(f) for f in files], ["--rm", *ContainerEngine.labels("imager-run")])
+        print("Starting imager using %s..." % imager_vm)
+        kernel_args = { "tarball": self.source._tarball, "script": script_file, "xattrs": xattrs }
+        extra_cmd = [
+            "-drive", "file={},index=1,media=disk,format=raw,discard=unmap,detect-zeroes=unmap".format(self.source._image),
+            "-serial", "stdio",
+            "-no-reboot"
+        ]
+        if self.transport == "blk":
+            # the tarball is read from a read-only disk rather than over 9p
+            kernel_args["tarserial"] = Imager.TARBALL_SERIAL
+            extra_cmd.extend([
+                "-drive", "file={},if=none,id=tarball,format=raw,readonly=on".format(self.source._tarball),
+                "-device", "virtio-blk-pci,drive=tarball,serial={}".format(Imager.TARBALL_SERIAL)
+            ])
+        imager_cmd = self._imager_cmd(imager_vm, kernel_args, extra_cmd)
+
+        if self.verbose is True:
+            if imager_args:
+                print(' '.join(imager_args))
+            print(' '.join(imager_cmd))
+        proc = imager_proc.Popen([*imager_args, *imager_cmd], stdout=subprocess.PIPE)
+        self._section = ("boot", Trace.now())
+
+        # Extract exit code from logs
+        tail = collections.deque(maxlen=20)
+        result = None
+        for log in proc.stdout:
+            result = self._log(log.decode(), tail)
+            if result is not None:
+                break
+        rc = proc.wait()
+        self._trace_section(None)
+        if result is None:
+            result = rc
+        if result != 0:
+            self._failed(result, tail, imager_cmd)
+
+    @Trace.stage("imager")
     def create(self, script, targetdir):
         output_dir = None
-        imager_kernel = None
-        imager_initrd = None
-        imager_rootfs = None
         script_file = None
         xattrs = None
+        vm = None
         try:
             output_dir = tempfile.mkdtemp(dir=os.getcwd())
 
             print("Processing extended attributes...")
-            xattrs = self._process_xattrs(output_dir)
+            with Trace.span("xattrs"):
+                xattrs = self._process_xattrs(output_dir)
 
             print("Creating imager script...")
-            script_file = self.build_script(script, targetdir)
+            with Trace.span("imager script"):
+                script_file = self.build_script(script, targetdir)
 
             print("Preparing imager...")
-            if ContainerEngine.hasImage(self.image_id()) is False:
-                self.build_imager()
-            imager_kernel = self.get_kernel(output_dir)
-            imager_initrd = self.get_initrd(output_dir)
-            imager_rootfs = self.get_imager(output_dir)
-
-            user_groups = [grp.getgrgid(g).gr_name for g in os.getgroups()]
-            if 'kvm' in user_groups:
-                imager_proc = subprocess
-                imager_args = []
-                imager_vm = "kvm"
-            else:
-                self.qemu.create()
-                imager_proc = ContainerEngine
-                imager_args = ['run']
-                imager_vm = "qemu-system-x86_64"
-                imager_dirs = []
-                for f in [script_file, imager_kernel, imager_initrd, imager_rootfs, xattrs]:
-                    d = os.path.dirname(f)
-                    if d not in imager_dirs:
-                        imager_dirs.append(d)
-                for d in imager_dirs:
-                    imager_args.append('-v')
-                    imager_args.append('{}:{}:z'.format(d, d))
-                imager_args.append(self.qemu.image_id())
-
-            print("Starting imager using %s..." % imager_vm)
-
-            # boot the live image with SELinux disabled
-            kernel_cmd = 'boot=live console=ttyS0 selinux=0'
-
-            # quiet the kernel and systemd
-            kernel_cmd += ' quiet loglevel=0 systemd.mask=getty.target systemd.show_status=false'
-
-            # let imager script know where to find the image tarball and imager script
-            kernel_cmd += ' tarball={} script={} xattrs={}'.format(self.source._tarball, script_file, xattrs)
-
-            imager_cmd = [
-                imager_vm,
-                "-m", "512",
-                "-kernel", imager_kernel,
-                "-initrd", imager_initrd,
-                "-append", kernel_cmd,
-                "-drive", "file={},index=0,media=disk,format=raw".format(imager_rootfs),
-                "-drive", "file={},index=1,media=disk,format=raw".format(self.source._image),
-                "-fsdev", "local,id=hostfs_dev,path=/,security_model=none",
-                "-device", "virtio-9p-pci,fsdev=hostfs_dev,mount_tag=hostfs_mount",
-                "-display", "none",
-                "-serial", "stdio",
-                "-no-reboot"
-            ]
-
-            if self.verbose is True:
-                if imager_args:
-                    print(' '.join(imager_args))
-                print(' '.join(imager_cmd))
-            proc = imager_proc.Popen([*imager_args, *imager_cmd], stdout=subprocess.PIPE)
-
-            # Extract exit code from logs
-            result = None
-            for log in proc.stdout:
-                log = log.decode()
-                print_log = self.verbose
-                if log.startswith('# '):
-                    log = log[2:]
-                    print_log = True
-                if print_log is True:
-                    print(log.strip())
-                if log.startswith("IMAGER EXIT ="):
-                    result = int(log.split("=")[1].strip())
-                    if result != 0:
-                        if self.verbose is False:
-                            lines = stdout[-20:]
-                            for line in lines:
-                                sys.stderr.write(line)
-                    break
-            rc = proc.wait()
-            if result is None:
-                result = rc
-            if result != 0:
-                raise subprocess.CalledProcessError(result, imager_cmd)
+            self.prepare()
+
+            pool = self.source.options.get("pool", 0)
+            if pool > 0:
+                # temporary files are all created in the working directory
+                dirs = [os.path.dirname(f) for f in [script_file, self.source._tarball, output_dir]]
+                with Trace.span("imager pool"):
+                    vm = ImagerPool(self, pool).acquire(dirs)
+            if vm is not None:
+                self._run_warm(vm, script_file, xattrs)
             else:
-                print("Done.")
+                self._run_oneshot(script_file, xattrs)
+            print("Done.")
         finally:
+            if vm is not None:
+                vm.unlock()
             if self.keep is False:
-                for f in [imager_kernel, imager_initrd, imager_rootfs, script_file, xattrs]:
+                for f in [script_file, xattrs]:
                     if f is not None:
                         os.unlink(f)
                 if output_dir:
@@ -328,22 +508,85 @@ ExecStart=/usr/sbin/imager
 WantedBy=multi-user.target"""
 
 IMAGER_SYSTEMD_SCRIPT = """#!/bin/bash
-set -o pipefail
 mount -t 9p -o trans=virtio hostfs_mount /mnt -oversion=9p2000.L,posixacl,cache=loose,msize=16777216
 mount -t tmpfs none /tmp
-result=1
 for x in $(cat /proc/cmdline); do
-    if [[ ${x} =~ ^script=.* ]] || [[ ${x} =~ ^tarball=.* ]] || [[ ${x} =~ ^xattrs=.* ]]; then
+    if [[ ${x} =~ ^(control|idle|script|tarball|tarserial|xattrs)=.* ]]; then
         eval ${x}
     fi
 done
-if [ -n "${script}" ] && [ -e /mnt${script} ]; then
-    export script tarball xattrs
-    bash /mnt${script} 2>&1 | tee /dev/ttyS0
-    result=${?}
+
+# run the script of a job: its output is sent as LOG messages (on fd 3)
+run_job() {
+    local result=1
+    if [ -n "${disk}" ] && [ -n "${script}" ] && [ -e /mnt${script} ]; then
+        tardev=
+        if [ -n "${tarserial}" ]; then
+            tardev=$(find_disk ${tarserial})
+        fi
+        export disk script tarball tardev xattrs
+        bash /mnt${script} 2>&1 | while IFS= read -r line; do echo "LOG ${line}"; done >&3
+        result=${PIPESTATUS[0]}
+    fi
+    echo "EXIT ${result}" >&3
+}
+
+# find the disk hot-plugged for a job from its serial number
+find_disk() {
+    local d i
+    for i in $(seq 100); do
+        udevadm settle
+        d=$(ls /dev/disk/by-id/*[-_]${1} 2>/dev/null | head -n 1)
+        if [ -n "${d}" ]; then
+            readlink -f ${d}
+            return 0
+        fi
+        sleep 0.1
+    done
+}
+
+# release the disk of the previous job so that it may be unplugged
+cleanup_job() {
+    cd /
+    umount -R /tmp/image 2>/dev/null
+    vgchange -an >/dev/null 2>&1
+    [ -z "${disk}" ] || partx -d ${disk} 2>/dev/null
+    rm -rf /dev/parts /tmp/image
+    sync
+}
+
+if [ -n "${control}" ]; then
+    # warm imager: take jobs from the control channel until idle for too long
+    exec 3<>/dev/virtio-ports/${control}
+    while read -r -t ${idle:-600} -u 3 verb args; do
+        case ${verb} in
+            HELLO)
+                echo "READY" >&3
+                ;;
+            JOB)
+                disk= script= serial= tarball= tarserial= xattrs=
+                for x in ${args}; do
+                    if [[ ${x} =~ ^(script|serial|tarball|tarserial|xattrs)=.* ]]; then
+                        eval ${x}
+                    fi
+                done
+                disk=$(find_disk ${serial})
+                run_job
+                cleanup_job
+                ;;
+            QUIT)
+                break
+                ;;
+        esac
+    done
+    exec 3>&-
+    poweroff -f
+else
+    exec 3>/dev/ttyS0
+    disk=/dev/sdb
+    run_job
+    /sbin/reboot
 fi
-echo "IMAGER EXIT = ${result}" > /dev/ttyS0
-/sbin/reboot
 """
 
 IMAGER_POST_INSTALL_SCRIPT = """
@@ -365,7 +608,7 @@ if [ -e usr/sbin/grub-install ]; then
     if [ -d usr/lib/grub/x86_64-efi ]; then
         options="--target x86_64-efi --efi-directory=/efi"
     fi
-    chroot . /usr/sbin/grub-install ${options} /dev/sdb
+    chroot . /usr/sbin/grub-install ${options} ${disk}
     if [ -d usr/lib/grub/x86_64-efi ]; then
         mkdir -p efi/EFI/boot
         mv efi/EFI/debian/grubx64.efi efi/EFI/boot/bootx64.efi
@@ -374,6 +617,11 @@ if [ -e usr/sbin/grub-install ]; then
 fi
 """
 
+IMAGER_TRIM_SCRIPT = """
+# discard unused blocks so that they remain holes in the (sparse) disk image
+grep '^/dev/[^ ]* {0}' /proc/mounts | cut -d' ' -f2 | xargs -r -n1 fstrim || true
+"""
+
 IMAGER_SELINUX_SETUP_SCRIPT = """
 SE_FILE_CONTEXTS=/etc/selinux/default/contexts/files/file_contexts
 if [ -e .${SE_FILE_CONTEXTS} ]; then
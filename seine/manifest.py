@@ -0,0 +1,264 @@
+# seine - Slim Embedded Images Now Easy
+# SPDX-License-Identifier Apache-2.0
+
+import array
+import bisect
+import mmap
+import os
+import shutil
+import struct
+import tarfile
+
+# Reader copying what is read from a stream to a file
+class _Tee:
+    def __init__(self, stream, output):
+        self.stream = stream
+        self.output = output
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.output.write(data)
+        return data
+
+class ManifestEntry:
+    __slots__ = ("name", "size", "type", "mode", "linkname", "offset")
+
+    def __init__(self, name, size, type, mode, linkname, offset):
+        self.name = name
+        self.size = size
+        self.type = type
+        self.mode = mode
+        self.linkname = linkname
+        self.offset = offset
+
+    def isdir(self):
+        return self.type == Manifest.DIRECTORY
+
+    def isfile(self):
+        return self.type == Manifest.FILE
+
+    def islnk(self):
+        return self.type == Manifest.HARDLINK
+
+    def issym(self):
+        return self.type == Manifest.SYMLINK
+
+# Compact table of the members of a root file-system tarball: headers are read
+# once and stored column-wise (names, sizes, types, modes, link targets and
+# offsets of the data in the tarball) instead of one TarInfo object per file.
+# The table is saved next to the tarball and memory-mapped by later users.
+class Manifest:
+    MAGIC   = b"SEINEMF1"
+    HEADER  = struct.Struct("<8sQQQQQ")
+    SUFFIX  = ".manifest"
+
+    FILE      = ord("f")
+    DIRECTORY = ord("d")
+    SYMLINK   = ord("l")
+    HARDLINK  = ord("h")
+    OTHER     = ord("o")
+
+    __slots__ = ("count", "name_offsets", "link_offsets", "sizes", "offsets",
+                 "modes", "types", "names", "links", "_file", "_mmap", "_names_base")
+
+    def __init__(self):
+        self.count = 0
+        self.name_offsets = array.array("Q", [0])
+        self.link_offsets = array.array("Q", [0])
+        self.sizes = array.array("Q")
+        self.offsets = array.array("Q")
+        self.modes = array.array("I")
+        self.types = bytearray()
+        self.names = bytearray()
+        self.links = bytearray()
+        self._file = None
+        self._mmap = None
+        self._names_base = 0
+
+    def __del__(self):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self.entry(index)
+
+    def _type(self, info):
+        if info.isdir():
+            return Manifest.DIRECTORY
+        if info.issym():
+            return Manifest.SYMLINK
+        if info.islnk():
+            return Manifest.HARDLINK
+        if info.isreg():
+            return Manifest.FILE
+        return Manifest.OTHER
+
+    def _append(self, info):
+        self.names += info.name.encode("utf-8", "surrogateescape") + b"\0"
+        self.name_offsets.append(len(self.names))
+        self.links += info.linkname.encode("utf-8", "surrogateescape")
+        self.link_offsets.append(len(self.links))
+        self.sizes.append(info.size)
+        self.offsets.append(info.offset_data)
+        self.modes.append(info.mode)
+        self.types.append(self._type(info))
+        self.count = self.count + 1
+
+    def name(self, index):
+        start = self.name_offsets[index]
+        end = self.name_offsets[index + 1] - 1
+        return bytes(self.names[start:end]).decode("utf-8", "surrogateescape")
+
+    def linkname(self, index):
+        start = self.link_offsets[index]
+        end = self.link_offsets[index + 1]
+        return bytes(self.links[start:end]).decode("utf-8", "surrogateescape")
+
+    def paths(self):
+        for index in range(self.count):
+            yield self.name(index)
+
+    def linklens(self):
+        for index in range(self.count):
+            yield self.link_offsets[index + 1] - self.link_offsets[index]
+
+    def entry(self, index):
+        return ManifestEntry(self.name(index), self.sizes[index], self.types[index],
+                             self.modes[index], self.linkname(index), self.offsets[index])
+
+    def find(self, name):
+        # members may be named with or without a leading "./"
+        while name.startswith("./"):
+            name = name[2:]
+        name = name.lstrip("/")
+        for candidate in [name, "./" + name]:
+            index = self._find(candidate)
+            if index is not None:
+                return index
+        return None
+
+    def _find(self, name):
+        needle = name.encode("utf-8", "surrogateescape") + b"\0"
+        if bytes(self.names[0:len(needle)]) == needle:
+            return 0
+        if self._mmap is not None:
+            base = self._names_base
+            pos = self._mmap.find(b"\0" + needle, base, base + len(self.names))
+            pos = pos - base if pos >= 0 else pos
+        else:
+            pos = self.names.find(b"\0" + needle)
+        if pos < 0:
+            return None
+        return bisect.bisect_left(self.name_offsets, pos + 1)
+
+    def read(self, tarball, name):
+        index = self.find(name)
+        if index is None:
+            raise KeyError("'%s' not found in %s!" % (name, tarball))
+        with open(tarball, "rb") as f:
+            f.seek(self.offsets[index])
+            return f.read(self.sizes[index])
+
+    def sidecar(tarball):
+        return tarball + Manifest.SUFFIX
+
+    def _stamp(tarball):
+        st = os.stat(tarball)
+        return st.st_size, st.st_mtime_ns
+
+    def build(tarball):
+        manifest = Manifest()
+        with tarfile.open(tarball, "r:") as tar:
+            while True:
+                info = tar.next()
+                if info is None:
+                    break
+                # do not let tarfile accumulate TarInfo objects
+                tar.members = []
+                manifest._append(info)
+        return manifest
+
+    def receive(stream, tarball):
+        # write a tarball read from a stream and build its manifest on the fly
+        manifest = Manifest()
+        with open(tarball, "wb") as f:
+            tee = _Tee(stream, f)
+            with tarfile.open(fileobj=tee, mode="r|") as tar:
+                while True:
+                    info = tar.next()
+                    if info is None:
+                        break
+                    tar.members = []
+                    manifest._append(info)
+            # end of archive blocks left unread by tarfile
+            shutil.copyfileobj(stream, f)
+        manifest.save(tarball)
+        return manifest
+
+    def save(self, tarball):
+        size, mtime = Manifest._stamp(tarball)
+        with open(Manifest.sidecar(tarball), "wb") as f:
+            f.write(Manifest.HEADER.pack(Manifest.MAGIC, self.count, size, mtime,
+                                         len(self.names), len(self.links)))
+            for column in [self.name_offsets, self.link_offsets, self.sizes,
+                           self.offsets, self.modes, self.types,
+                           self.names, self.links]:
+                f.write(column)
+
+    def _map(self, f):
+        self._file = f
+        self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        magic, count, size, mtime, names, links = Manifest.HEADER.unpack_from(view)
+        pos = Manifest.HEADER.size
+
+        def column(fmt, length, itemsize):
+            nonlocal pos
+            data = view[pos:pos + length * itemsize]
+            pos = pos + length * itemsize
+            return data.cast(fmt) if fmt else data
+
+        self.count = count
+        self.name_offsets = column("Q", count + 1, 8)
+        self.link_offsets = column("Q", count + 1, 8)
+        self.sizes = column("Q", count, 8)
+        self.offsets = column("Q", count, 8)
+        self.modes = column("I", count, 4)
+        self.types = column(None, count, 1)
+        self._names_base = pos
+        self.names = column(None, names, 1)
+        self.links = column(None, links, 1)
+        return self
+
+    def close(self):
+        for attr in ["name_offsets", "link_offsets", "sizes", "offsets", "modes", "types", "names", "links"]:
+            column = getattr(self, attr)
+            if isinstance(column, memoryview):
+                column.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def open(tarball):
+        # use the sidecar file unless missing or created for another tarball
+        path = Manifest.sidecar(tarball)
+        if os.path.exists(path):
+            f = open(path, "rb")
+            header = f.read(Manifest.HEADER.size)
+            if len(header) == Manifest.HEADER.size:
+                magic, count, size, mtime, names, links = Manifest.HEADER.unpack(header)
+                if magic == Manifest.MAGIC and (size, mtime) == Manifest._stamp(tarball):
+                    return Manifest()._map(f)
+            f.close()
+        manifest = Manifest.build(tarball)
+        manifest.save(tarball)
+        return manifest
@@ -0,0 +1,154 @@
+# seine - Slim Embedded Images Now Easy
+# SPDX-License-Identifier Apache-2.0
+
+from abc import ABC, abstractmethod
+
+import collections
+import errno
+import lzma
+import os
+import shutil
+import struct
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+
+from seine.utils import ContainerEngine
+
+class OutputFormat:
+    SUFFIX = ""
+
+    def __init__(self, name):
+        self.name = name
+
+    def write(self, image, output, qemu=None):
+        os.rename(image, output)
+
+    def get(name):
+        if name not in FORMATS:
+            raise ValueError("'%s' is not a supported image format!" % name)
+        return FORMATS[name]
+
+    def names():
+        return sorted(FORMATS.keys())
+
+# Compressed outputs are produced from the sparse raw image as a sequence of
+# independently compressed frames (concatenated frames form a valid stream):
+# frames are compressed concurrently and written in order while the image is
+# being read, and frames only covering holes reuse a single compressed frame
+# of zeroes instead of being read and compressed again
+class FramedFormat(OutputFormat, ABC):
+    FRAME_SIZE = 32 * 1024 * 1024
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.jobs = os.cpu_count() or 1
+
+    @abstractmethod
+    def compress(self, data):
+        pass
+
+    def trailer(self, frames):
+        return b""
+
+    def _is_hole(self, fd, start, end):
+        try:
+            return os.lseek(fd, start, os.SEEK_DATA) >= end
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                return True
+            return False
+
+    def _frame(self, fd, start, size):
+        return self.compress(os.pread(fd, size, start)), size
+
+    def write(self, image, output, qemu=None):
+        fd = os.open(image, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            frames = []
+            zeroes = {}
+            with open(output, "wb") as out, ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                pending = collections.deque()
+                for start in range(0, size, self.FRAME_SIZE):
+                    length = min(self.FRAME_SIZE, size - start)
+                    if self._is_hole(fd, start, start + length):
+                        if length not in zeroes:
+                            zeroes[length] = self.compress(bytes(length))
+                        pending.append((zeroes[length], length))
+                    else:
+                        pending.append(pool.submit(self._frame, fd, start, length))
+                    # bound the number of frames held in memory
+                    while len(pending) > 2 * self.jobs:
+                        self._write_frame(out, pending.popleft(), frames)
+                while pending:
+                    self._write_frame(out, pending.popleft(), frames)
+                out.write(self.trailer(frames))
+        except:
+            if os.path.exists(output):
+                os.unlink(output)
+            raise
+        finally:
+            os.close(fd)
+        os.unlink(image)
+
+    def _write_frame(self, out, frame, frames):
+        data, length = frame if isinstance(frame, tuple) else frame.result()
+        out.write(data)
+        frames.append((len(data), length))
+
+class XzFormat(FramedFormat):
+    SUFFIX = ".xz"
+    PRESET = 6
+
+    def compress(self, data):
+        return lzma.compress(data, format=lzma.FORMAT_XZ, preset=self.PRESET)
+
+# zstd frames followed by a seek table (skippable frame) as described by the
+# zstd seekable format: frames may be decompressed individually
+class ZstdFormat(FramedFormat):
+    SUFFIX = ".zst"
+    LEVEL  = 3
+
+    SKIPPABLE_MAGIC = 0x184D2A5E
+    SEEKABLE_MAGIC  = 0x8F92EAB1
+
+    def compress(self, data):
+        proc = subprocess.run(["zstd", "-q", "-c", "-%d" % self.LEVEL, "--no-progress", "-"],
+                              input=data, stdout=subprocess.PIPE, check=True)
+        return proc.stdout
+
+    def trailer(self, frames):
+        entries = b"".join([struct.pack("<II", c, d) for c, d in frames])
+        footer = struct.pack("<IBI", len(frames), 0, ZstdFormat.SEEKABLE_MAGIC)
+        content = entries + footer
+        return struct.pack("<II", ZstdFormat.SKIPPABLE_MAGIC, len(content)) + content
+
+class Qcow2Format(OutputFormat):
+    SUFFIX = ".qcow2"
+
+    def write(self, image, output, qemu=None):
+        # qemu-img skips holes of the raw image on its own
+        image = os.path.realpath(image)
+        output = os.path.realpath(output)
+        cmd = ["qemu-img", "convert", "-c", "-f", "raw", "-O", "qcow2", image, output]
+        if shutil.which("qemu-img"):
+            subprocess.run(cmd, check=True)
+        else:
+            dirs = []
+            for d in [os.path.dirname(image), os.path.dirname(output)]:
+                if d not in dirs:
+                    dirs.append(d)
+            args = ["run", "--rm", *ContainerEngine.labels("output")]
+            for d in dirs:
+                args.extend(["-v", "{}:{}:z".format(d, d)])
+            qemu.create()
+            ContainerEngine.run([*args, qemu.image_id(), *cmd], check=True)
+        os.unlink(image)
+
+FORMATS = {
+    "qcow2": Qcow2Format("qcow2"),
+    "raw":   OutputFormat("raw"),
+    "xz":    XzFormat("xz"),
+    "zstd":  ZstdFormat("zstd"),
+}
@@ -1,19 +1,25 @@
 # seine - Slim Embedded Images Now Easy
 # SPDX-License-Identifier Apache-2.0
 
+import array
+import itertools
 import math
 import os
 import re
 import sys
 
+from seine.estimate import Estimator, Usage
+
 class PartitionHandler:
 
     START_OFFSET_KB  = 1 * 1024
-    DEFAULT_EXTRA_MB = 16
     DEFAULT_TABLE    = "gpt"
+    DEFAULT_EXTRA_MB = 16
 
     def __init__(self):
+        self._bootlet_index = {}
         self._min_size = None
+        self._mount_index = {}
         self._table = None
         self.bootlets = []
         self.groups = []
@@ -82,16 +88,22 @@ class PartitionHandler:
         return bootlet
 
     def _parse_common(self, part):
-        part["_blksz"] = 4096
+        if "type" not in part:
+            part["type"] = "ext4"
+
+        part["_blksz"] = Estimator.get(part["type"]).BLOCK_SIZE
         part["_depth"] = 0
+        part["_size"] = 0
+        part["_usage"] = Usage()
 
         if "priority" not in part:
             part["priority"] = 500
 
         if "extra" in part:
-            part["_size"] = self._from_human_size(part["extra"])
+            part["_extra"] = self._from_human_size(part["extra"])
         else:
-            part["_size"] = PartitionHandler.DEFAULT_EXTRA_MB
+            # free space left in file-systems whose size is estimated
+            part["_extra"] = PartitionHandler.DEFAULT_EXTRA_MB * 1024 * 1024
 
         if "where" in part:
             prefix = os.path.normpath(part["where"])
@@ -102,8 +114,6 @@ class PartitionHandler:
             part["_prefix"] = prefix
         if "size" in part:
             part["size"] = self._from_human_size(part["size"])
-        if "type" not in part:
-            part["type"] = "ext4"
 
         return part
 
@@ -145,11 +155,6 @@ class PartitionHandler:
             raise ValueError("'where' not defined in volume '%s'!" % label)
         return vol
 
-    def _size_file(self, f, part):
-        blksz = part["_blksz"]
-        size = math.floor((f.size + blksz - 1) / blksz) * blksz
-        return size if size > 0 else blksz
-
     def disk_size(self):
         if self._min_size is None:
             raise RuntimeError("partitions sizes shall be computed first!")
@@ -159,22 +164,93 @@ class PartitionHandler:
         else:
             return self.size
 
+    def _lookup_mount(self, name):
+        # longest matching prefix: try each parent directory of the file,
+        # deepest first, against the prefix index
+        pos = len(name)
+        while pos > 0:
+            pos = name.rfind("/", 0, pos)
+            if pos < 0:
+                break
+            mount = self._mount_index.get(name[:pos + 1])
+            if mount is not None:
+                return mount
+        return None
+
+    def _kind(self, f):
+        if f.isdir():
+            return "d"
+        if f.issym():
+            return "l"
+        if f.islnk():
+            return "h"
+        if f.isfile():
+            return "f"
+        return "o"
+
     def distribute(self, f):
         if f.name.startswith("/") == False:
             name = "/" + f.name
         else:
             name = f.name
 
-        for bootlet in self.bootlets:
-            if name == bootlet["file"]:
-                bootlet["_size"] = f.size
-                break
-
-        for mount in self.mounts:
-            if mount["_prefix"] is not None and name.startswith(mount["_prefix"]):
-                mount["_size"] = mount["_size"] + self._size_file(f, mount)
-                return mount
-        return None
+        bootlet = self._bootlet_index.get(name)
+        if bootlet is not None:
+            bootlet["_size"] = f.size
+
+        mount = self._lookup_mount(name)
+        if mount is not None:
+            estimator = Estimator.get(mount["type"])
+            usage = mount["_usage"]
+            kind = self._kind(f)
+            estimator.account(usage, name, kind, len(f.linkname))
+            if kind == "f":
+                usage.blocks = usage.blocks + estimator.file_blocks(f.size)
+        return mount
+
+    def distribute_many(self, names, sizes, types=None, linklens=None):
+        # map each file to the index of its mount; files from the same
+        # directory share the same mount so only look directories up once
+        dirs = {}
+        mounts = {}
+        for index, mount in enumerate(self.mounts):
+            mounts.setdefault(id(mount), index)
+        estimators = [Estimator.get(m["type"]) for m in self.mounts]
+        usages = [m["_usage"] for m in self.mounts]
+        blocks = [u.blocks for u in usages]
+        files = [array.array("Q") for m in self.mounts]
+        if types is None:
+            types = itertools.repeat("f")
+        if linklens is None:
+            linklens = itertools.repeat(0)
+
+        for name, size, kind, linklen in zip(names, sizes, types, linklens):
+            if name.startswith("/") == False:
+                name = "/" + name
+            bootlet = self._bootlet_index.get(name)
+            if bootlet is not None:
+                bootlet["_size"] = size
+            dir = name[:name.rfind("/") + 1]
+            index = dirs.get(dir)
+            if index is None:
+                mount = self._lookup_mount(dir)
+                index = mounts[id(mount)] if mount is not None else -1
+                dirs[dir] = index
+            if index < 0:
+                continue
+            if type(kind) is int:
+                kind = chr(kind)
+            estimators[index].account(usages[index], name, kind, linklen)
+            if kind == "f":
+                files[index].append(size)
+
+        # data blocks of regular files (vectorized when possible)
+        totals = []
+        for index, mount in enumerate(self.mounts):
+            usage = usages[index]
+            usage.blocks = usage.blocks + estimators[index].file_blocks_many(files[index])
+            totals.append((usage.blocks - blocks[index]) * mount["_blksz"])
+        return totals
 
     def compute_sizes(self):
         # check if all bootlets were found
@@ -211,11 +287,29 @@ class PartitionHandler:
 
         # add estimated size of each partition
         for mount in self.mounts:
+            mount["_size"] = Estimator.get(mount["type"]).estimate(mount) + mount["_extra"]
             mount["_size"] = self._to_rounded_mib(mount["_size"]) * 1024 * 1024
             if "size" in mount and mount["size"] > mount["_size"]:
                 mount["_size"] = mount["size"]
             self._min_size = self._min_size + mount["_size"]
 
+        # offset of each partition on the disk (in bytes)
+        for part in self.partitions:
+            part["_offset"] = start * 1024 * 1024
+            start = start + self._to_rounded_mib(part["_size"])
+
+    def fstab_options(self, mount):
+        options = "defaults"
+        if mount["_prefix"] == "/":
+            if mount["type"] != "btrfs":
+                options = "errors=remount-ro"
+            passno = 1
+        else:
+            passno = 2
+            if mount["type"] == "vfat":
+                options = "umask=0077"
+        return options, passno
+
     def print_stats(self):
         print("prologue:\t%s" % self._to_human_size(self._start_offset))
         print("mounts:")
@@ -269,29 +363,37 @@ class PartitionHandler:
             image["volumes"] = sorted(self.volumes, key=lambda p: p["priority"])
 
         self.mounts = sorted(self.mounts, key=lambda vol: vol["_depth"], reverse=True)
+
+        # index bootlets and mounts for distribute()
+        for bootlet in self.bootlets:
+            self._bootlet_index.setdefault(bootlet["file"], bootlet)
+        for mount in self.mounts:
+            self._mount_index.setdefault(mount["_prefix"], mount)
         return spec
 
     def _script_setup_common(self, script, part, dev):
-        options = ""
+        options = Estimator.get(part["type"]).options(part)
         if "label" in part:
             options = options + " -L %s" % part["label"]
-        script = script + "mkfs.%s %s %s\n" % (part["type"], options.strip(), dev)
+        script = script + "mkfs.%s %s %s &\n" % (part["type"], options.strip(), dev)
         return script
 
     def _script_setup_vfat(self, script, part, dev):
-        options = ""
+        options = Estimator.get(part["type"]).options(part)
         if "label" in part:
             options = options + " -n %s" % part["label"]
-        script = script + "mkfs.vfat %s %s\n" % (options.strip(), dev)
+        script = script + "mkfs.vfat %s %s &\n" % (options.strip(), dev)
         return script
 
     def _script_setup_fs(self, script, part, dev):
+        # file-systems are created in the background (see wait_pids)
         if part["type"].startswith("ext") or part["type"] in ["btrfs", "nilfs2"]:
-            return self._script_setup_common(script, part, dev)
+            script = self._script_setup_common(script, part, dev)
         elif part["type"] == "vfat":
-            return self._script_setup_vfat(script, part, dev)
+            script = self._script_setup_vfat(script, part, dev)
         else:
             raise NotImplementedError("'%s' is not a supported file-system!" % part["type"])
+        return script + "pids+=($!)\n"
 
     def script(self, device, targetdir):
         fstab = ""
@@ -299,7 +401,6 @@ class PartitionHandler:
         script = PARTITION_HANDLER_SCRIPT
         script = script + "targetdir=%s\n" % targetdir
         script = script + "parted %s --script mklabel %s\n" % (device, self._table)
-        start = self._start_offset
 
         for part in self.partitions:
             if self._table == "msdos":
@@ -319,9 +420,9 @@ class PartitionHandler:
             else:
                 mkpart_type = part["type"]
 
+            start = self._to_rounded_mib(part["_offset"])
             end = start + self._to_rounded_mib(part["_size"])
             script = script + "parted %s --script mkpart %s %s %sMiB %sMiB\n" % (device, mkpart_arg, mkpart_type, start, end)
-            start = end
 
             if "flags" in part:
                 for f in part["flags"]:
@@ -334,7 +435,6 @@ class PartitionHandler:
             if part["_lvm"] == False:
                 script = script + "id=%s\n" % part["_prefix"].replace("/", "_")
                 script = script + "mounts[${id}]=${dev}\n"
-                script = self._script_setup_fs(script, part, "${dev}")
             else:
                 script = script + "pvcreate ${dev}\n"
                 script = script + "pvs=${groups[%s]}\n" % part["group"]
@@ -347,12 +447,17 @@ class PartitionHandler:
             script = script + "vgcreate %s ${pvs}\n" % group
 
         for vol in self.volumes:
-            script = script + "lvcreate -n %s -L %dM %s\n" % (vol["label"], self._to_rounded_mib(vol["size"]), vol["group"])
+            script = script + "lvcreate -n %s -L %dM %s\n" % (vol["label"], self._to_rounded_mib(vol["_size"]), vol["group"])
             voldev = "/dev/mapper/%s-%s" % (vol["group"], vol["label"])
-            script = self._script_setup_fs(script, vol, voldev)
             script = script + "id=%s\n" % vol["_prefix"].replace("/", "_")
             script = script + "mounts[${id}]=%s\n" % (voldev)
 
+        # create file-systems once all partitions and volumes were created
+        for mount in self.mounts:
+            dev = "${mounts[%s]}" % mount["_prefix"].replace("/", "_")
+            script = self._script_setup_fs(script, mount, dev)
+        script = script + "wait_pids\n"
+
         for mount in reversed(self.mounts):
             script = script + "dev=${mounts[%s]}\n" % mount["_prefix"].replace("/", "_")
             script = script + "mkdir -p ${targetdir}%s\n" % mount["_prefix"]
@@ -363,15 +468,7 @@ class PartitionHandler:
                 what = "${uuid}"
             else:
                 what = "${dev}"
-            options = "defaults"
-            if mount["_prefix"] == "/":
-                if mount["type"] != "btrfs":
-                    options = "errors=remount-ro"
-                passno = 1
-            else:
-                passno = 2
-                if mount["type"] == "vfat":
-                    options = "umask=0077"
+            options, passno = self.fstab_options(mount)
             fstab = fstab + "    echo \"%s %s %s %s 0 %d\"\n" % (what, mount["_prefix"], mount["type"], options, passno)
 
         script = script + "copy_bootlets() {\n    true\n"
@@ -385,6 +482,27 @@ class PartitionHandler:
 
         return script
 
+    def extract_script(self, archive, manifest):
+        # extract the subtree of each mount concurrently (largest first): each
+        # mount gets the files under its prefix but those of nested mounts
+        script = ""
+        dot = "./" if len(manifest) > 0 and manifest.name(0).startswith("./") else ""
+        for mount in sorted(self.mounts, key=lambda m: m["_usage"].blocks, reverse=True):
+            prefix = mount["_prefix"]
+            member = ""
+            if prefix != "/":
+                member = "'%s%s'" % (dot, prefix.strip("/"))
+                if manifest.find(member[1:-1]) is None:
+                    continue
+            excludes = ""
+            for nested in self.mounts:
+                if nested is not mount and nested["_prefix"].startswith(prefix):
+                    excludes = excludes + " --exclude='%s%s'" % (dot, nested["_prefix"].strip("/"))
+            script = script + "throttle $(nproc)\n"
+            script = script + "tar -xf %s --anchored --no-wildcards%s -- %s &\n" % (archive, excludes, member)
+            script = script + "pids+=($!)\n"
+        return script + "wait_pids\n"
+
 PARTITION_HANDLER_SCRIPT = """
 part_device() {
     mkdir -p /dev/parts
@@ -399,7 +517,22 @@ part_device() {
     done
 }
 
+wait_pids() {
+    local pid
+    for pid in ${pids[@]}; do
+        wait ${pid} || return 1
+    done
+    pids=()
+}
+
+throttle() {
+    while [ $(jobs -rp | wc -l) -ge ${1} ]; do
+        wait -n || return 1
+    done
+}
+
 declare -A groups
 declare -A mounts
+declare -a pids
 
 """
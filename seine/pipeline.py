@@ -0,0 +1,65 @@
+# seine - Slim Embedded Images Now Easy
+# SPDX-License-Identifier Apache-2.0
+
+import asyncio
+import inspect
+
+class Stage:
+    def __init__(self, name, fn, after=[], needed=True):
+        self.name = name
+        self.fn = fn
+        self.after = after
+        self.needed = needed
+
+# Stages of a build, each run as soon as the stages it comes after completed:
+# stages are either coroutines (run by the event loop) or functions (run in
+# threads of their own). Stages that are not needed are skipped but stages
+# coming after them still run. Stages coming after a stage that failed do
+# not run and the first error is raised once running stages completed.
+class Pipeline:
+    def __init__(self, stages):
+        self.stages = dict([(stage.name, stage) for stage in stages])
+        self.order = []
+        self.failures = []
+        visiting = []
+        def visit(stage):
+            if stage in self.order:
+                return
+            if stage in visiting:
+                cycle = visiting[visiting.index(stage):] + [stage]
+                raise ValueError("circular stages: %s!" % " -> ".join([s.name for s in cycle]))
+            visiting.append(stage)
+            for name in stage.after:
+                if name not in self.stages:
+                    raise ValueError("stage '%s' comes after unknown stage '%s'!" % (stage.name, name))
+                visit(self.stages[name])
+            visiting.pop()
+            self.order.append(stage)
+        for stage in stages:
+            visit(stage)
+
+    async def _run(self, stage, tasks):
+        for name in stage.after:
+            await tasks[name]
+        if stage.needed is False:
+            return
+        try:
+            if inspect.iscoroutinefunction(stage.fn):
+                await stage.fn()
+            else:
+                await asyncio.to_thread(stage.fn)
+        except BaseException as e:
+            self.failures.append((stage.name, e))
+            raise
+
+    async def _main(self):
+        # stages are scheduled after those they come after
+        tasks = {}
+        for stage in self.order:
+            tasks[stage.name] = asyncio.ensure_future(self._run(stage, tasks))
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        if self.failures:
+            raise self.failures[0][1]
+
+    def run(self):
+        asyncio.run(self._main())
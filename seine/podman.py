@@ -0,0 +1,213 @@
+# seine - Slim Embedded Images Now Easy
+# SPDX-License-Identifier Apache-2.0
+
+import atexit
+import contextlib
+import http.client
+import json
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from seine.trace import Trace
+
+# Errors returned by the API are reported as failed podman commands
+class PodmanError(subprocess.CalledProcessError):
+    def __init__(self, status, request, message):
+        super().__init__(status, request, stderr=message)
+
+    def __str__(self):
+        return "podman request '%s' failed (%d): %s" % (self.cmd, self.returncode, self.stderr)
+
+class _UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self._socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self._socket_path)
+
+# Client of the REST API (libpod flavor) of a podman service listening on a
+# unix socket. Each thread keeps its connection open between requests, exports
+# are streamed over connections of their own.
+class PodmanClient:
+    VERSION = "v4.0.0"
+
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _url(self, path, query=None):
+        url = "/%s/libpod%s" % (PodmanClient.VERSION, urllib.parse.quote(path, safe="/:@"))
+        query = dict([(k, v) for k, v in (query or {}).items() if v is not None])
+        for key, value in query.items():
+            if isinstance(value, bool):
+                query[key] = "true" if value else "false"
+            elif isinstance(value, dict):
+                query[key] = json.dumps(value)
+        if query:
+            url = url + "?" + urllib.parse.urlencode(query)
+        return url
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = _UnixConnection(self.path, self.timeout)
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        # close the connection of this thread
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _send(self, conn, method, url, body):
+        headers = {}
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+        conn.request(method, url, body=body, headers=headers)
+        return conn.getresponse()
+
+    def _check(self, response, method, url, ok):
+        if response.status in ok:
+            return response
+        data = response.read()
+        try:
+            message = json.loads(data.decode()).get("message", "")
+        except (ValueError, AttributeError):
+            message = data.decode(errors="replace").strip()
+        raise PodmanError(response.status, "%s %s" % (method, url), message)
+
+    def request(self, name, method, path, query=None, body=None, ok=(200, 201, 204)):
+        # send a request on the connection of this thread (re-opened if it
+        # was closed by the service) and return its status and decoded body
+        url = self._url(path, query)
+        with Trace.span("podman " + name, cat="podman", args={ "request": "%s %s" % (method, url) }):
+            conn = self._connection()
+            try:
+                response = self._send(conn, method, url, body)
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                conn.close()
+                response = self._send(conn, method, url, body)
+            except:
+                conn.close()
+                raise
+            self._check(response, method, url, ok)
+            data = response.read()
+        return response.status, json.loads(data.decode()) if data else None
+
+    @contextlib.contextmanager
+    def stream(self, name, method, path, query=None):
+        url = self._url(path, query)
+        conn = _UnixConnection(self.path, self.timeout)
+        try:
+            with Trace.span("podman " + name, cat="podman", args={ "request": "%s %s" % (method, url) }):
+                response = self._send(conn, method, url, None)
+                self._check(response, method, url, (200,))
+                yield response
+        finally:
+            conn.close()
+
+    def ping(self):
+        conn = _UnixConnection(self.path, self.timeout)
+        try:
+            conn.request("GET", "/_ping")
+            response = conn.getresponse()
+            response.read()
+            return response.status == 200
+        finally:
+            conn.close()
+
+    def image_exists(self, name):
+        status, data = self.request("image exists", "GET", "/images/%s/exists" % name, ok=(204, 404))
+        return status == 204
+
+    def image_inspect(self, name):
+        return self.request("image inspect", "GET", "/images/%s/json" % name)[1]
+
+    def images(self, filters=None):
+        return self.request("image ls", "GET", "/images/json", { "filters": filters })[1] or []
+
+    def image_remove(self, name, force=False):
+        self.request("image rm", "DELETE", "/images/%s" % name, { "force": force })
+
+    def images_prune(self, filters=None):
+        return self.request("image prune", "POST", "/images/prune", { "filters": filters })[1]
+
+    def containers(self, filters=None):
+        return self.request("container ls", "GET", "/containers/json",
+                            { "all": True, "filters": filters })[1] or []
+
+    def container_create(self, image, name=None, labels=None):
+        spec = { "image": image }
+        if name is not None:
+            spec["name"] = name
+        if labels:
+            spec["labels"] = labels
+        return self.request("container create", "POST", "/containers/create", body=spec)[1]["Id"]
+
+    def container_remove(self, name, force=False):
+        self.request("container rm", "DELETE", "/containers/%s" % name, { "force": force })
+
+    def container_export(self, name):
+        # context manager yielding the tarball of the container as a stream
+        return self.stream("container export", "GET", "/containers/%s/export" % name)
+
+# podman system service of seine: it is started with the storage root used by
+# seine and stopped when seine exits
+class PodmanService:
+    START_TIMEOUT = 10
+
+    def __init__(self, root):
+        self.root = root
+        self._dir = None
+        self._proc = None
+
+    def start(self):
+        self._dir = tempfile.mkdtemp(prefix="seine-podman-")
+        path = os.path.join(self._dir, "podman.sock")
+        try:
+            self._proc = subprocess.Popen(["podman", "--root", self.root, "system", "service",
+                                           "--time=0", "unix://%s" % path],
+                                          stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                          stderr=subprocess.DEVNULL)
+        except OSError:
+            self.stop()
+            raise
+        atexit.register(self.stop)
+        client = PodmanClient(path)
+        deadline = time.monotonic() + PodmanService.START_TIMEOUT
+        while time.monotonic() < deadline and self._proc.poll() is None:
+            try:
+                if client.ping():
+                    return client
+            except OSError:
+                pass
+            time.sleep(0.05)
+        self.stop()
+        raise RuntimeError("the podman service could not be started!")
+
+    def stop(self):
+        if self._proc is not None:
+            self._proc.terminate()
+            try:
+                self._proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self._proc.kill()
+                self._proc.wait()
+            self._proc = None
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
@@ -0,0 +1,221 @@
+# seine - Slim Embedded Images Now Easy
+# SPDX-License-Identifier Apache-2.0
+
+import fcntl
+import json
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+
+from seine.qmp   import QMP
+from seine.utils import ContainerEngine
+
+# An imager VM kept running between builds: jobs are sent over a virtio-serial
+# control channel using a line protocol (host: HELLO, JOB key=value..., QUIT;
+# guest: READY, LOG <line>, EXIT <code>) and target disks are hot-plugged with
+# QMP. The guest powers itself off after being idle for IDLE_TIMEOUT seconds.
+class WarmImager:
+    CONTROL_PORT = "org.seine.control"
+    IDLE_TIMEOUT = 600
+    BOOT_TIMEOUT = 900
+
+    def __init__(self, path):
+        self.path = path
+        self._control = None
+        self._lock = None
+        self._qmp = None
+        self._serial = 0
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def qmp_socket(self):
+        return self._file("qmp.sock")
+
+    def control_socket(self):
+        return self._file("control.sock")
+
+    def lock(self):
+        os.makedirs(self.path, exist_ok=True)
+        self._lock = open(self._file("lock"), "w")
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            self._lock.close()
+            self._lock = None
+            return False
+
+    def unlock(self):
+        self.disconnect()
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
+
+    def info(self):
+        try:
+            with open(self._file("info.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_info(self, info):
+        with open(self._file("info.json"), "w") as f:
+            json.dump(info, f)
+
+    def serves(self, dirs):
+        # files of a job shall be visible from the VM (through its 9p export)
+        info = self.info()
+        if info is None:
+            return False
+        for d in dirs:
+            if not [v for v in info["dirs"] if d == v or d.startswith(v.rstrip("/") + "/")]:
+                return False
+        return True
+
+    def connect(self, timeout=10):
+        self._qmp = QMP(self.qmp_socket()).connect(timeout)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self._control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self._control.connect(self.control_socket())
+                break
+            except OSError:
+                self._control.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        self._control.settimeout(timeout)
+        self._reader = self._control.makefile("r", encoding="utf-8", errors="replace")
+        self.send("HELLO")
+        if self.receive() != "READY":
+            raise RuntimeError("%s: imager did not answer!" % self.path)
+        self._control.settimeout(None)
+        return self
+
+    def disconnect(self):
+        if self._control is not None:
+            self._reader.close()
+            self._control.close()
+            self._control = None
+        if self._qmp is not None:
+            self._qmp.close()
+            self._qmp = None
+
+    def send(self, line):
+        self._control.sendall((line + "\n").encode())
+
+    def receive(self):
+        line = self._reader.readline()
+        if not line:
+            raise EOFError("%s: control channel closed!" % self.path)
+        return line.rstrip("\n")
+
+    def stop(self):
+        # shut a VM down (it may already be gone) and forget about it
+        info = self.info()
+        if info is not None:
+            if "container" in info:
+                ContainerEngine.removeContainer(info["container"], force=True)
+            elif "pid" in info:
+                try:
+                    os.kill(info["pid"], signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+        for name in ["info.json", "qmp.sock", "control.sock"]:
+            if os.path.exists(self._file(name)):
+                os.unlink(self._file(name))
+
+    def attach(self, image, readonly=False):
+        # hot-plug a disk: the image is passed to qemu as a file descriptor
+        # so that it does not need to be visible from its container
+        self._serial = self._serial + 1
+        serial = "seine%d-%d" % (os.getpid(), self._serial)
+        fd = os.open(image, os.O_RDONLY if readonly else os.O_RDWR)
+        try:
+            fdset = self._qmp.execute("add-fd", fds=[fd])["fdset-id"]
+        finally:
+            os.close(fd)
+        options = { "driver": "raw", "node-name": serial, "read-only": readonly,
+                    "file": { "driver": "file", "filename": "/dev/fdset/%d" % fdset, "read-only": readonly } }
+        if readonly is False:
+            options["discard"] = options["file"]["discard"] = "unmap"
+            options["detect-zeroes"] = "unmap"
+        self._qmp.execute("blockdev-add", options)
+        self._qmp.execute("device_add", {
+            "driver": "scsi-hd", "bus": "scsi0.0", "drive": serial, "id": serial, "serial": serial
+        })
+        return serial, fdset
+
+    def detach(self, disk):
+        serial, fdset = disk
+        self._qmp.execute("device_del", { "id": serial })
+        # disks are hot-plugged concurrently: wait for this one to be gone
+        self._qmp.wait_event("DEVICE_DELETED", data={ "device": serial })
+        self._qmp.execute("blockdev-del", { "node-name": serial })
+        self._qmp.execute("remove-fd", { "fdset-id": fdset })
+
+    def run(self, disk, **job):
+        args = " ".join(["%s=%s" % (k, v) for k, v in sorted(job.items())])
+        self.send("JOB serial=%s %s" % (disk[0], args))
+        while True:
+            line = self.receive()
+            yield line
+            if line.startswith("EXIT "):
+                break
+
+class ImagerPool:
+    def __init__(self, imager, size):
+        self.imager = imager
+        self.size = size
+
+    def _root(self):
+        # socket paths are limited to 108 characters: use the runtime directory
+        root = os.environ.get("XDG_RUNTIME_DIR")
+        if root is None:
+            root = os.path.join(tempfile.gettempdir(), "seine-%d" % os.getuid())
+        digest = ContainerEngine.imageId(self.imager.image_id()).split(":")[-1]
+        return os.path.join(root, "seine", "imager", digest[:12])
+
+    def prune(self):
+        # VMs of previous imager images are not used anymore
+        parent = os.path.dirname(self._root())
+        if not os.path.isdir(parent):
+            return
+        for name in os.listdir(parent):
+            path = os.path.join(parent, name)
+            if path == self._root():
+                continue
+            for slot in os.listdir(path):
+                vm = WarmImager(os.path.join(path, slot))
+                if vm.lock():
+                    vm.stop()
+                    vm.unlock()
+            shutil.rmtree(path, ignore_errors=True)
+
+    def acquire(self, dirs):
+        # use an idle VM able to see the files of the job, start a new one in
+        # a free slot otherwise (None if all slots are busy)
+        self.prune()
+        for slot in range(self.size):
+            vm = WarmImager(os.path.join(self._root(), "%d" % slot))
+            if vm.lock() is False:
+                continue
+            if vm.serves(dirs):
+                try:
+                    return vm.connect()
+                except (OSError, EOFError, RuntimeError, TimeoutError):
+                    vm.disconnect()
+            vm.stop()
+            try:
+                self.imager.start_warm(vm, dirs)
+                return vm.connect(WarmImager.BOOT_TIMEOUT)
+            except:
+                vm.stop()
+                vm.unlock()
+                raise
+        return None
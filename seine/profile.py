@@ -0,0 +1,103 @@
+# seine - Slim Embedded Images Now Easy
+# SPDX-License-Identifier Apache-2.0
+
+import json
+import os
+import re
+import statistics
+import tempfile
+import time
+
+from seine.ansible_callback import MARKER
+from seine.trace            import Trace
+from seine.utils            import Cache
+
+# Profile of the playbooks applied to a root file-system, from records of the
+# seine_profile callback of Ansible found in the output of "podman build".
+# Profiles of previous builds of an image are kept to spot regressions.
+class Profile:
+    HISTORY = 20
+    SLOWEST = 5
+
+    def __init__(self, name):
+        self.name = name
+        self.tasks = []
+        self.playbooks = []
+        self._history = None
+
+    def feed(self, line):
+        # return whether the line was a record of the profile
+        if line.startswith(MARKER) == False:
+            return False
+        try:
+            record = json.loads(line[len(MARKER):])
+        except ValueError:
+            return False
+        if record.get("kind") == "task":
+            self.tasks.append(record)
+            Trace.complete(record["name"], Trace.now() - record["wall"], cat="ansible",
+                           args={ "playbook": record.get("playbook"), "changed": record["changed"] })
+        elif record.get("kind") == "playbook":
+            self.playbooks.append(record)
+        return True
+
+    def _path(self):
+        return Cache.path("profile", re.sub(r"[^\w.-]", "_", self.name) + ".jsonl")
+
+    def history(self):
+        # profiles of previous builds (loaded once)
+        if self._history is None:
+            try:
+                with open(self._path()) as f:
+                    self._history = [json.loads(line) for line in f if line.strip()]
+            except (OSError, ValueError):
+                self._history = []
+        return self._history
+
+    def save(self):
+        if not self.playbooks:
+            return
+        entry = { "time": int(time.time()), "playbooks": self.playbooks, "tasks": self.tasks }
+        entries = self.history()[-(Profile.HISTORY - 1):] + [entry]
+        path = self._path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "w") as f:
+            for e in entries:
+                f.write(json.dumps(e) + "\n")
+        os.rename(temp, path)
+
+    def _baseline(self, kind, key):
+        # median wall time of playbooks (or tasks) in previous builds, the
+        # time of this build is reported as a delta from it
+        baseline = {}
+        for entry in self.history():
+            for record in entry.get(kind, []):
+                baseline.setdefault(key(record), []).append(record["wall"])
+        return dict([(k, statistics.median(v)) for k, v in baseline.items()])
+
+    def _print(self, records, baseline, key, title):
+        print("%8s %8s %8s  %-7s %s" % ("WALL", "CPU", "DELTA", "CHANGED", title))
+        records = sorted(records, key=lambda r: r["wall"], reverse=True)[:Profile.SLOWEST]
+        for record in records:
+            median = baseline.get(key(record))
+            delta = "-" if median is None else "%+.1fs" % (record["wall"] - median)
+            print("%7.1fs %7.1fs %8s  %-7s %s" % (record["wall"], record["cpu"], delta,
+                  "yes" if record["changed"] else "no", key(record)))
+
+    def report(self):
+        if not self.playbooks:
+            return
+        print("\nslowest playbooks of %s:" % self.name)
+        self._print(self.playbooks, self._baseline("playbooks", Profile._playbook),
+                    Profile._playbook, "PLAYBOOK")
+        print("\nslowest tasks of %s:" % self.name)
+        self._print(self.tasks, self._baseline("tasks", Profile._task),
+                    Profile._task, "TASK")
+        print("")
+
+    def _playbook(record):
+        return record["name"]
+
+    def _task(record):
+        return "%s / %s" % (record.get("playbook", "unnamed"), record["name"])
@@ -0,0 +1,385 @@
+# seine - Slim Embedded Images Now Easy
+# SPDX-License-Identifier Apache-2.0
+
+import fcntl
+import getopt
+import hashlib
+import http.client
+import http.server
+import json
+import os
+import select
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from seine.utils import Cache
+
+# Files downloaded by apt, kept in a size-bounded cache: least recently used
+# files are evicted first. Files are named after the hash of their URL and
+# their headers are kept in a sidecar (.json) file.
+class AptCache:
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.used = 0
+        self._files = {}
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):
+            if name.endswith(".json") is False:
+                continue
+            data = os.path.join(path, name[:-5])
+            try:
+                st = os.stat(data)
+            except FileNotFoundError:
+                os.unlink(os.path.join(path, name))
+                continue
+            self._files[data] = st.st_size
+            self.used = self.used + st.st_size
+
+    def _name(self, url):
+        return os.path.join(self.path, hashlib.sha256(url.encode()).hexdigest())
+
+    def get(self, url):
+        # headers of a cached file (None if not cached), its use is recorded
+        path = self._name(url)
+        try:
+            with open(path + ".json") as f:
+                headers = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None, None
+        return path, headers
+
+    def tempfile(self):
+        return tempfile.NamedTemporaryFile(mode="wb", delete=False, dir=self.path, suffix=".part")
+
+    def put(self, url, temp, headers):
+        path = self._name(url)
+        size = os.path.getsize(temp)
+        with self._lock:
+            os.replace(temp, path)
+            with open(path + ".json", "w") as f:
+                json.dump(headers, f)
+            self.used = self.used + size - self._files.get(path, 0)
+            self._files[path] = size
+            self._evict()
+        return path
+
+    def _evict(self):
+        if self.used <= self.size:
+            return
+        lru = sorted(self._files, key=lambda p: os.stat(p).st_mtime if os.path.exists(p) else 0)
+        for path in lru:
+            if self.used <= self.size * 9 // 10:
+                break
+            for f in [path, path + ".json"]:
+                if os.path.exists(f):
+                    os.unlink(f)
+            self.used = self.used - self._files.pop(path)
+
+class _ProxyHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    HEADERS = [ "Content-Type", "Last-Modified", "ETag" ]
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _policy(self, path):
+        # packages and by-hash indexes never change, other indexes are
+        # revalidated with their mirror, everything else is not cached
+        if "/by-hash/" in path or path.endswith((".deb", ".udeb", ".dsc", ".diff.gz")):
+            return "immutable"
+        name = os.path.basename(path)
+        if name in [ "Release", "InRelease", "Release.gpg" ] or name.startswith(
+                ("Packages", "Sources", "Translation-", "Contents-", "Components-")):
+            return "revalidate"
+        if "/pool/" in path:
+            return "immutable"
+        return None
+
+    def _send_file(self, path, headers, head=False):
+        self._send_headers(200, None, headers, str(os.path.getsize(path)))
+        if head is False:
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, self.wfile)
+
+    def _upstream(self, url, headers=None):
+        parts = urllib.parse.urlsplit(url)
+        conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        request = { "Host": parts.netloc, "User-Agent": self.headers.get("User-Agent", "seine") }
+        request.update(headers or {})
+        conn.request(self.command, path, headers=request)
+        return conn, conn.getresponse()
+
+    def _forward(self, response, cache=None, url=None):
+        # relay the response of the mirror, a copy of the body is stored in
+        # the cache for successful downloads of cacheable files
+        body = self.command != "HEAD"
+        length = response.getheader("Content-Length")
+        headers = {}
+        for name in _ProxyHandler.HEADERS:
+            if response.getheader(name) is not None:
+                headers[name] = response.getheader(name)
+        temp = cache.tempfile() if cache is not None and response.status == 200 and body else None
+        try:
+            if length is None and body:
+                # body of unknown length: download it before relaying it
+                spool = temp or tempfile.TemporaryFile()
+                shutil.copyfileobj(response, spool)
+                length = str(spool.tell())
+                spool.seek(0)
+                self._send_headers(response.status, response.reason, headers, length)
+                shutil.copyfileobj(spool, self.wfile)
+                if spool is not temp:
+                    spool.close()
+                received = int(length)
+            else:
+                self._send_headers(response.status, response.reason, headers, length)
+                received = 0
+                while body:
+                    chunk = response.read(64 * 1024)
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    if temp is not None:
+                        temp.write(chunk)
+                    received = received + len(chunk)
+            if temp is not None:
+                temp.close()
+                if received == int(length):
+                    cache.put(url, temp.name, headers)
+                    temp = None
+        finally:
+            if temp is not None:
+                temp.close()
+                os.unlink(temp.name)
+
+    def _send_headers(self, status, reason, headers, length):
+        self.send_response(status, reason)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if length is not None:
+            self.send_header("Content-Length", length)
+        self.end_headers()
+
+    def _error(self, code, message):
+        body = (message + "\n").encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.touch()
+        url = self.path
+        if url.startswith("http://") is False:
+            self._error(400, "only proxy requests are supported")
+            return
+        cache = self.server.cache
+        policy = self._policy(urllib.parse.urlsplit(url).path)
+        path, headers = cache.get(url) if policy is not None else (None, None)
+        if path is not None and policy == "immutable":
+            self._send_file(path, headers, self.command == "HEAD")
+            return
+
+        conditions = {}
+        if path is not None and "Last-Modified" in headers:
+            conditions["If-Modified-Since"] = headers["Last-Modified"]
+        try:
+            conn, response = self._upstream(url, conditions)
+        except OSError as e:
+            if path is not None:
+                # the mirror cannot be reached: use what was cached
+                self._send_file(path, headers, self.command == "HEAD")
+            else:
+                self._error(502, "%s: %s" % (url, e))
+            return
+        try:
+            if response.status == 304 and path is not None:
+                self._send_file(path, headers, self.command == "HEAD")
+            else:
+                self._forward(response, cache if policy is not None else None, url)
+        finally:
+            conn.close()
+
+    do_HEAD = do_GET
+
+    def do_CONNECT(self):
+        # tunnel (https) connections to the requested host, nothing is cached
+        self.server.touch()
+        host, _, port = self.path.partition(":")
+        try:
+            upstream = socket.create_connection((host, int(port or 443)), timeout=60)
+        except (OSError, ValueError) as e:
+            self._error(502, "%s: %s" % (self.path, e))
+            return
+        self.send_response(200, "Connection established")
+        self.end_headers()
+        sockets = [self.connection, upstream]
+        try:
+            while True:
+                readable, _, _ = select.select(sockets, [], [], 60)
+                if not readable:
+                    break
+                for s in readable:
+                    data = s.recv(64 * 1024)
+                    if not data:
+                        return
+                    (upstream if s is self.connection else self.connection).sendall(data)
+                self.server.touch()
+        finally:
+            upstream.close()
+            self.close_connection = True
+
+class _ProxyServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, cache, verbose=False):
+        self.cache = cache
+        self.last_use = time.monotonic()
+        self.verbose = verbose
+        super().__init__(address, _ProxyHandler)
+
+    def touch(self):
+        self.last_use = time.monotonic()
+
+# Caching HTTP proxy for apt shared by builds: it is started when first needed
+# and exits after being idle for IDLE_TIMEOUT seconds once no build uses it
+# (builds hold a shared lock on a clients file until they release the proxy).
+# Its address is saved in a port file for later builds to find it. Containers
+# reach it through the network of the host.
+class AptProxy:
+    PORT = 3142
+    DEFAULT_SIZE = 4 << 30
+    IDLE_TIMEOUT = 900
+    START_TIMEOUT = 10
+
+    def __init__(self, size=DEFAULT_SIZE, path=None):
+        self.path = path or Cache.path("apt")
+        self.size = size
+        self._client = None
+
+    def _port_file(self):
+        return os.path.join(self.path, "proxy.json")
+
+    def _lock_file(self):
+        return os.path.join(self.path, "proxy.lock")
+
+    def _clients_file(self):
+        return os.path.join(self.path, "proxy.clients")
+
+    def _acquire(self):
+        # the proxy is used (and kept running) until released
+        if self._client is None:
+            self._client = open(self._clients_file(), "w")
+            fcntl.flock(self._client, fcntl.LOCK_SH)
+
+    def release(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    def url(self):
+        # address of a running proxy (None if there is none)
+        try:
+            with open(self._port_file()) as f:
+                port = json.load(f)["port"]
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return "http://127.0.0.1:%d" % port
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def start(self):
+        # reuse the proxy of another build or start one in the background
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._lock_file(), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            url = self.url()
+            if url is not None:
+                self._acquire()
+                return url
+            env = dict(os.environ)
+            for name in [ "http_proxy", "HTTP_PROXY" ]:
+                env.pop(name, None)
+            sources = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            env["PYTHONPATH"] = os.pathsep.join([sources, *filter(None, [env.get("PYTHONPATH")])])
+            subprocess.Popen([sys.executable, "-m", "seine.proxy", "--size=%d" % self.size,
+                              "--path=%s" % self.path], env=env, start_new_session=True,
+                             stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.DEVNULL)
+            deadline = time.monotonic() + AptProxy.START_TIMEOUT
+            while time.monotonic() < deadline:
+                url = self.url()
+                if url is not None:
+                    self._acquire()
+                    return url
+                time.sleep(0.1)
+        raise RuntimeError("the apt proxy could not be started!")
+
+    def server(self, port=PORT, verbose=False):
+        # the usual port is preferred so that build arguments do not change
+        cache = AptCache(os.path.join(self.path, "files"), self.size)
+        try:
+            return _ProxyServer(("127.0.0.1", port), cache, verbose)
+        except OSError:
+            return _ProxyServer(("127.0.0.1", 0), cache, verbose)
+
+    def _idle(self):
+        # no build holds the clients lock: the proxy may exit
+        with open(self._clients_file(), "w") as clients:
+            try:
+                fcntl.flock(clients, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except OSError:
+                return False
+
+    def serve(self, server, idle_timeout=IDLE_TIMEOUT):
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._port_file(), "w") as f:
+            json.dump({ "pid": os.getpid(), "port": server.server_address[1] }, f)
+        try:
+            while True:
+                time.sleep(min(idle_timeout, 10))
+                if time.monotonic() - server.last_use < idle_timeout:
+                    continue
+                # builds look for a running proxy with the lock held: the
+                # proxy does not exit while a build is about to use it
+                with open(self._lock_file(), "w") as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                    if self._idle():
+                        os.unlink(self._port_file())
+                        break
+                server.touch()
+        finally:
+            if os.path.exists(self._port_file()):
+                os.unlink(self._port_file())
+            server.shutdown()
+            server.server_close()
+
+def main(argv):
+    opts, args = getopt.getopt(argv, "v", [ "path=", "size=", "verbose" ])
+    size, path, verbose = AptProxy.DEFAULT_SIZE, None, False
+    for o, a in opts:
+        if o in ("--path"):
+            path = a
+        elif o in ("--size"):
+            size = int(a)
+        elif o in ("-v", "--verbose"):
+            verbose = True
+    proxy = AptProxy(size, path)
+    proxy.serve(proxy.server(verbose=verbose))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
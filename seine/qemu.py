@@ -8,11 +8,16 @@ import sys
 import tempfile
 
 from seine.bootstrap import Bootstrap
+from seine.trace     import Trace
 from seine.utils     import ContainerEngine
 
 class Qemu(Bootstrap):
+    # version of the qemu image: changes to PACKAGES shall come with a new
+    # version for images built with previous packages not to be reused
+    VERSION = 2
     PACKAGES = [
-        "qemu-system-x86"
+        "qemu-system-x86",
+        "qemu-utils"
     ]
 
     def __init__(self, source):
@@ -35,16 +40,18 @@ class Qemu(Bootstrap):
         return self.name
 
     def defaultName(self):
-        return os.path.join("qemu", self.distro["source"], self.distro["release"], "all")
+        return os.path.join("qemu", self.distro["source"], self.distro["release"],
+                            "all-v%d" % Qemu.VERSION)
 
+    @Trace.stage("qemu image")
     def create(self):
-        if ContainerEngine.hasImage(self.image_id()) is True:
+        if ContainerEngine.cachedImage(self.image_id()) is True:
             return
 
         print("Preparing qemu image...")
         hostBootstrap = self.source.hostBootstrap
         dockerfile = tempfile.NamedTemporaryFile(mode="w", delete=False)
-        dockerfile.write("""
+        dockerfile.write(ContainerEngine.dockerfile("""
             FROM {} AS image
             RUN                            \
                 apt-get update -qqy &&     \
@@ -57,22 +64,21 @@ class Qemu(Bootstrap):
         .format(
             hostBootstrap.name,
             " ".join(Qemu.PACKAGES)
-        ))
+        )))
         dockerfile.close()
 
         imageCreated = False
         try:
             ContainerEngine.run([
                 "build", "--rm", "--squash",
+                *ContainerEngine.labels("qemu"),
                 "-t", self.image_id(),
                 "-f", dockerfile.name], check=True)
             imageCreated = True
-            ContainerEngine.run([
-                "container", "create",
-                "--name", self.container_id(), self.image_id()], check=True)
+            ContainerEngine.createContainer(self.image_id(), "qemu", self.container_id())
         except subprocess.CalledProcessError:
             if imageCreated is True:
-                ContainerEngine.run(["image", "rm", self.image_id()], check=False)
+                ContainerEngine.removeImage(self.image_id())
             raise
         finally:
             self._unlink(dockerfile.name, "dockerfile for the qemu image")
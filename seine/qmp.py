@@ -0,0 +1,87 @@
+# seine - Slim Embedded Images Now Easy
+# SPDX-License-Identifier Apache-2.0
+
+import json
+import os
+import socket
+import time
+
+# Minimal client for the QEMU Machine Protocol (QMP) over a unix socket
+class QMP:
+    def __init__(self, path):
+        self.path = path
+        self.events = []
+        self._buffer = b""
+        self._sock = None
+
+    def connect(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self._sock.settimeout(timeout)
+                self._sock.connect(self.path)
+                break
+            except OSError:
+                self._sock.close()
+                self._sock = None
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        greeting = self._recv()
+        if "QMP" not in greeting:
+            raise RuntimeError("%s: unexpected QMP greeting!" % self.path)
+        self.execute("qmp_capabilities")
+        return self
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _recv(self):
+        while b"\n" not in self._buffer:
+            data = self._sock.recv(4096)
+            if not data:
+                raise EOFError("%s: connection closed by qemu!" % self.path)
+            self._buffer = self._buffer + data
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        return json.loads(line.decode())
+
+    def execute(self, command, arguments=None, fds=None):
+        request = { "execute": command }
+        if arguments is not None:
+            request["arguments"] = arguments
+        data = (json.dumps(request) + "\n").encode()
+        if fds:
+            # file descriptors are passed along with the command (SCM_RIGHTS)
+            socket.send_fds(self._sock, [data], fds)
+        else:
+            self._sock.sendall(data)
+        while True:
+            response = self._recv()
+            if "event" in response:
+                self.events.append(response)
+            elif "error" in response:
+                raise RuntimeError("%s failed: %s" % (command, response["error"]["desc"]))
+            elif "return" in response:
+                return response["return"]
+
+    def wait_event(self, name, timeout=30, data=None):
+        # events that do not match (name and items of data) are kept queued
+        deadline = time.monotonic() + timeout
+        while True:
+            for event in self.events:
+                if event["event"] != name:
+                    continue
+                items = event.get("data", {})
+                if all([items.get(k) == v for k, v in (data or {}).items()]):
+                    self.events.remove(event)
+                    return event
+            self._sock.settimeout(max(deadline - time.monotonic(), 0.01))
+            try:
+                response = self._recv()
+            except socket.timeout:
+                raise TimeoutError("%s: timed out waiting for %s!" % (self.path, name))
+            if "event" in response:
+                self.events.append(response)
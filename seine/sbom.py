@@ -20,12 +20,23 @@ class SBOM:
             output = output + suffix
         return output
 
-    def generate(self, image):
+    def _command(self, image, name=None):
+        # scan image, the SBOM is named after name (the image by default)
         image = os.path.realpath(image)
-        output = self._output_file(image)
-        if output is not None:
-            dir = os.path.dirname(image)
-            run_cmd = ['run', '-v', '{}:{}:z'.format(dir, dir), '-t', 'docker.io/anchore/syft']
-            syft_cmd = ['-q', '-o', 'spdx-json', '--file', output, image]
-            cmd = [*run_cmd, *syft_cmd]
+        output = self._output_file(name or image)
+        if output is None:
+            return None
+        dir = os.path.dirname(image)
+        run_cmd = ['run', '--rm', *ContainerEngine.labels('sbom'), '-v', '{}:{}:z'.format(dir, dir), '-t', 'docker.io/anchore/syft']
+        syft_cmd = ['-q', '-o', 'spdx-json', '--file', output, image]
+        return [*run_cmd, *syft_cmd]
+
+    def generate(self, image, name=None):
+        cmd = self._command(image, name)
+        if cmd is not None:
             ContainerEngine.run(cmd)
+
+    async def agenerate(self, image, name=None):
+        cmd = self._command(image, name)
+        if cmd is not None:
+            await ContainerEngine.arun(cmd)
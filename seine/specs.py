@@ -0,0 +1,87 @@
+# seine - Slim Embedded Images Now Easy
+# SPDX-License-Identifier Apache-2.0
+
+import hashlib
+import json
+import os
+import pickle
+import sys
+import tempfile
+
+from seine.utils import Cache
+from seine.utils import CacheUsage
+
+# Persistent cache of parsed specifications. Entries are keyed by the content
+# of every file that was loaded (specifications given on the command line and
+# all they require), the sources of seine and the version of python. An index named after
+# the command line lists the files loaded by its last run so that they may be
+# hashed (rather than parsed) to find the entry.
+class SpecCache:
+    _sources = None
+
+    def __init__(self, specs):
+        self.path = Cache.path("specs")
+        self.specs = [os.path.realpath(spec) for spec in specs]
+
+    def digest(content):
+        return hashlib.sha256(content).hexdigest()
+
+    def _sources_digest():
+        # pickled objects may not load (or differ) once seine is changed
+        if SpecCache._sources is None:
+            top = os.path.dirname(os.path.abspath(__file__))
+            sources = hashlib.sha256()
+            for name in sorted(os.listdir(top)):
+                if name.endswith(".py"):
+                    with open(os.path.join(top, name), "rb") as f:
+                        sources.update(name.encode() + b"\0" + f.read())
+            SpecCache._sources = sources.hexdigest()
+        return SpecCache._sources
+
+    def _version(self):
+        return "%s/%d.%d" % (SpecCache._sources_digest(), *sys.version_info[:2])
+
+    def _index(self):
+        key = json.dumps([self._version(), self.specs])
+        return os.path.join(self.path, SpecCache.digest(key.encode()) + ".json")
+
+    def _entry(self, files):
+        key = json.dumps([self._version(), sorted(files.items())])
+        return os.path.join(self.path, SpecCache.digest(key.encode()) + ".pickle")
+
+    def _write(self, path, data):
+        os.makedirs(self.path, exist_ok=True)
+        f = tempfile.NamedTemporaryFile(mode="wb", delete=False, dir=self.path)
+        try:
+            f.write(data)
+            f.close()
+            os.replace(f.name, path)
+        except:
+            f.close()
+            os.unlink(f.name)
+            raise
+
+    def get(self):
+        # files of the last run shall all be unchanged
+        try:
+            with open(self._index()) as f:
+                files = json.load(f)
+            for path, digest in files.items():
+                with open(path, "rb") as f:
+                    if SpecCache.digest(f.read()) != digest:
+                        return None
+            with open(self._entry(files), "rb") as f:
+                data = pickle.load(f)
+            CacheUsage.record(CacheUsage.file(self._entry(files)), True)
+            return data
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return None
+
+    def put(self, files, data):
+        try:
+            self._write(self._entry(files), pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+            self._write(self._index(), json.dumps(files).encode())
+            CacheUsage.record(CacheUsage.file(self._entry(files)))
+        except OSError:
+            # the cache is an optimization, carry on without it
+            pass
@@ -0,0 +1,143 @@
+# seine - Slim Embedded Images Now Easy
+# SPDX-License-Identifier Apache-2.0
+
+from abc import ABC, abstractmethod
+
+import os
+import struct
+import uuid
+import zlib
+
+# Partition tables written directly to the disk image (as parted would) from
+# the offsets and sizes computed by the PartitionHandler
+class PartitionTable(ABC):
+    SECTOR_SIZE = 512
+
+    def __init__(self, name):
+        self.name = name
+
+    def _sectors(self, size):
+        return size // PartitionTable.SECTOR_SIZE
+
+    def _mbr(self, entries, signature=0):
+        mbr = bytearray(PartitionTable.SECTOR_SIZE)
+        struct.pack_into("<I", mbr, 440, signature)
+        offset = 446
+        for status, type, start, sectors in entries:
+            # CHS addresses are not used (LBA only)
+            struct.pack_into("<B3sB3sII", mbr, offset, status, b"\xfe\xff\xff", type,
+                             b"\xfe\xff\xff", start, min(sectors, 0xffffffff))
+            offset = offset + 16
+        mbr[510:512] = b"\x55\xaa"
+        return mbr
+
+    def check(self, partitions):
+        pass
+
+    @abstractmethod
+    def write(self, image, size, partitions):
+        pass
+
+    def get(name):
+        if name not in TABLES:
+            raise ValueError("'%s' is not a supported partition table!" % name)
+        return TABLES[name]
+
+class MsdosTable(PartitionTable):
+    MAX_PARTITIONS = 4
+
+    TYPE_FAT32_LBA = 0x0c
+    TYPE_LINUX     = 0x83
+
+    def check(self, partitions):
+        if len(partitions) > MsdosTable.MAX_PARTITIONS:
+            raise ValueError("only %d primary partitions may be created!" % MsdosTable.MAX_PARTITIONS)
+        for part in partitions:
+            flags = part["flags"] if "flags" in part else []
+            if "extended" in flags or "logical" in flags:
+                raise ValueError("extended partitions are not supported!")
+
+    def write(self, image, size, partitions):
+        self.check(partitions)
+        entries = []
+        for part in partitions:
+            flags = part["flags"] if "flags" in part else []
+            status = 0x80 if "boot" in flags else 0
+            type = MsdosTable.TYPE_FAT32_LBA if part["type"] == "vfat" else MsdosTable.TYPE_LINUX
+            entries.append((status, type, self._sectors(part["_offset"]), self._sectors(part["_size"])))
+        signature = struct.unpack("<I", os.urandom(4))[0]
+        fd = os.open(image, os.O_WRONLY)
+        try:
+            os.pwrite(fd, self._mbr(entries, signature), 0)
+        finally:
+            os.close(fd)
+
+class GptTable(PartitionTable):
+    ENTRIES      = 128
+    ENTRY_SIZE   = 128
+    HEADER       = struct.Struct("<8sIIIIQQQQ16sQIII")
+    ENTRY        = struct.Struct("<16s16sQQQ72s")
+    REVISION     = 0x00010000
+    SIGNATURE    = b"EFI PART"
+    TYPE_PMBR    = 0xee
+
+    TYPE_ESP     = uuid.UUID("c12a7328-f81f-11d2-ba4b-00a0c93ec93b")
+    TYPE_LINUX   = uuid.UUID("0fc63daf-8483-4772-8e79-3d69d8477de4")
+
+    def _entries_sectors(self):
+        return GptTable.ENTRIES * GptTable.ENTRY_SIZE // PartitionTable.SECTOR_SIZE
+
+    def _header(self, current, backup, first, last, disk, entries_lba, entries_crc):
+        fields = [GptTable.SIGNATURE, GptTable.REVISION, GptTable.HEADER.size, 0, 0,
+                  current, backup, first, last, disk.bytes_le, entries_lba,
+                  GptTable.ENTRIES, GptTable.ENTRY_SIZE, entries_crc]
+        crc = zlib.crc32(GptTable.HEADER.pack(*fields))
+        fields[3] = crc
+        header = bytearray(PartitionTable.SECTOR_SIZE)
+        GptTable.HEADER.pack_into(header, 0, *fields)
+        return header
+
+    def _entry(self, part):
+        flags = part["flags"] if "flags" in part else []
+        # parted marks partitions with the "boot" flag as EFI system partitions
+        type = GptTable.TYPE_ESP if "boot" in flags else GptTable.TYPE_LINUX
+        first = self._sectors(part["_offset"])
+        last = first + self._sectors(part["_size"]) - 1
+        name = part["label"].encode("utf-16-le")[:72]
+        return GptTable.ENTRY.pack(type.bytes_le, uuid.uuid4().bytes_le, first, last, 0, name)
+
+    def write(self, image, size, partitions):
+        if len(partitions) > GptTable.ENTRIES:
+            raise ValueError("only %d partitions may be created!" % GptTable.ENTRIES)
+        lbas = self._sectors(size)
+        table = bytearray(GptTable.ENTRIES * GptTable.ENTRY_SIZE)
+        offset = 0
+        for part in partitions:
+            table[offset:offset + GptTable.ENTRY_SIZE] = self._entry(part)
+            offset = offset + GptTable.ENTRY_SIZE
+        entries_crc = zlib.crc32(table)
+
+        # primary table after the protective MBR, backup at the end of the disk
+        disk = uuid.uuid4()
+        first = 2 + self._entries_sectors()
+        last = lbas - 2 - self._entries_sectors()
+        backup_entries = lbas - 1 - self._entries_sectors()
+        pmbr = self._mbr([(0, GptTable.TYPE_PMBR, 1, lbas - 1)])
+        primary = self._header(1, lbas - 1, first, last, disk, 2, entries_crc)
+        backup = self._header(lbas - 1, 1, first, last, disk, backup_entries, entries_crc)
+
+        sector = PartitionTable.SECTOR_SIZE
+        fd = os.open(image, os.O_WRONLY)
+        try:
+            os.pwrite(fd, pmbr, 0)
+            os.pwrite(fd, primary, sector)
+            os.pwrite(fd, table, 2 * sector)
+            os.pwrite(fd, table, backup_entries * sector)
+            os.pwrite(fd, backup, (lbas - 1) * sector)
+        finally:
+            os.close(fd)
+
+TABLES = {
+    "gpt":   GptTable("gpt"),
+    "msdos": MsdosTable("msdos"),
+}
@@ -0,0 +1,85 @@
+# seine - Slim Embedded Images Now Easy
+# SPDX-License-Identifier Apache-2.0
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+# Timeline of a build in the Chrome trace-event format (chrome://tracing,
+# https://ui.perfetto.dev): stages and sub-stages are recorded as complete
+# events ("X") on the thread running them, nothing is recorded unless enabled
+class Trace:
+    _events = None
+    _lock = threading.Lock()
+    _start = 0
+    _threads = set()
+
+    def enable():
+        Trace._events = []
+        Trace._threads = set()
+        Trace._start = time.perf_counter()
+
+    def enabled():
+        return Trace._events is not None
+
+    def now():
+        return time.perf_counter()
+
+    def _event(event):
+        thread = threading.current_thread()
+        event["pid"] = os.getpid()
+        event["tid"] = thread.ident
+        with Trace._lock:
+            if thread.ident not in Trace._threads:
+                Trace._threads.add(thread.ident)
+                Trace._events.append({ "name": "thread_name", "ph": "M", "pid": event["pid"],
+                                       "tid": thread.ident, "args": { "name": thread.name } })
+            Trace._events.append(event)
+
+    def complete(name, start, end=None, cat="stage", args=None):
+        if Trace._events is None:
+            return
+        if end is None:
+            end = Trace.now()
+        event = { "name": name, "cat": cat, "ph": "X",
+                  "ts": round((start - Trace._start) * 1e6),
+                  "dur": round((end - start) * 1e6) }
+        if args:
+            event["args"] = args
+        Trace._event(event)
+
+    def instant(name, cat="stage", args=None):
+        if Trace._events is None:
+            return
+        event = { "name": name, "cat": cat, "ph": "i", "s": "t",
+                  "ts": round((Trace.now() - Trace._start) * 1e6) }
+        if args:
+            event["args"] = args
+        Trace._event(event)
+
+    @contextlib.contextmanager
+    def span(name, cat="stage", args=None):
+        start = Trace.now()
+        try:
+            yield
+        finally:
+            Trace.complete(name, start, cat=cat, args=args)
+
+    def stage(name):
+        # decorator recording each call of a function as a span
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with Trace.span(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def save(path):
+        with Trace._lock:
+            events = list(Trace._events or [])
+        with open(path, "w") as f:
+            json.dump({ "traceEvents": events, "displayTimeUnit": "ms" }, f)
@@ -1,26 +1,322 @@
 # seine - Slim Embedded Images Now Easy
 # SPDX-License-Identifier Apache-2.0
 
+import asyncio
+import contextlib
+import contextvars
+import fcntl
+import http.client
+import json
 import os
 import subprocess
+import sys
+import tempfile
+import time
+import uuid
 
+from seine.podman import PodmanError, PodmanService
+from seine.trace  import Trace
+
+class Cache:
+    def path(*names):
+        root = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        return os.path.join(root, "seine", *names)
+
+# Last use and hits of cached artifacts, for "seine cache" to evict the least
+# recently used first. Artifacts are named "image:NAME" (images of the private
+# root) or "file:PATH" (PATH being relative to the cache directory).
+class CacheUsage:
+    def _path():
+        return Cache.path("usage.json")
+
+    @contextlib.contextmanager
+    def _locked():
+        os.makedirs(Cache.path(), exist_ok=True)
+        with open(CacheUsage._path() + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _read():
+        try:
+            with open(CacheUsage._path()) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        data.setdefault("items", {})
+        return data
+
+    def _write(data):
+        f = tempfile.NamedTemporaryFile(mode="w", delete=False, dir=Cache.path())
+        with f:
+            json.dump(data, f)
+        os.replace(f.name, CacheUsage._path())
+
+    def image(name):
+        # images are listed by podman as localhost/NAME:TAG
+        if name.startswith("localhost/"):
+            name = name[len("localhost/"):]
+        if ":" not in os.path.basename(name):
+            name = name + ":latest"
+        return "image:" + name
+
+    def file(path):
+        return "file:" + os.path.relpath(path, Cache.path())
+
+    def load():
+        try:
+            with CacheUsage._locked():
+                return CacheUsage._read()
+        except OSError:
+            return CacheUsage._read()
+
+    def record(key, hit=False):
+        # the cache is an optimization, errors are ignored
+        try:
+            with CacheUsage._locked():
+                data = CacheUsage._read()
+                item = data["items"].setdefault(key, { "hits": 0, "uses": 0 })
+                item["last_use"] = time.time()
+                item["uses"] = item["uses"] + 1
+                if hit:
+                    item["hits"] = item["hits"] + 1
+                CacheUsage._write(data)
+        except OSError:
+            pass
+
+    def forget(keys):
+        with CacheUsage._locked():
+            data = CacheUsage._read()
+            for key in keys:
+                data["items"].pop(key, None)
+            CacheUsage._write(data)
+
+    def quota():
+        return CacheUsage.load().get("quota")
+
+    def set_quota(size):
+        with CacheUsage._locked():
+            data = CacheUsage._read()
+            data["quota"] = size
+            CacheUsage._write(data)
+
+# Images and containers created by seine are labelled with the build creating
+# them (seine.build) and its stage (seine.stage). Objects of temporary stages
+# are removed by their build when it ends, other images are kept as cache for
+# "seine cache" to collect.
+#
+# Images, containers and exports go through the REST API of a podman service
+# once connected (see connect), other commands and requests failing to reach
+# the service use the podman command.
 class ContainerEngine:
+    # URL of the apt proxy to be used by container builds (if any)
+    proxy = None
+    # client of the podman service (if any)
+    api = None
+    TEMPORARY = [ "export", "finalize", "imager-run", "intermediate", "output", "sbom" ]
+    # stages of a build may run in threads of their own (and copy this)
+    _build = contextvars.ContextVar("build", default=None)
+    _service = None
+
+    def root():
+        return os.path.join(os.path.expanduser("~"), ".local", "share", "seine")
+    def connect():
+        try:
+            ContainerEngine._service = PodmanService(ContainerEngine.root())
+            ContainerEngine.api = ContainerEngine._service.start()
+        except (OSError, RuntimeError):
+            ContainerEngine._service = None
+            ContainerEngine.api = None
+        return ContainerEngine.api is not None
+    def disconnect():
+        if ContainerEngine.api is not None:
+            ContainerEngine.api.close()
+        ContainerEngine.api = None
+        if ContainerEngine._service is not None:
+            ContainerEngine._service.stop()
+            ContainerEngine._service = None
+    def _call(request, command):
+        # use the API if connected, the podman command otherwise (or if the
+        # service cannot be reached anymore)
+        api = ContainerEngine.api
+        if api is not None:
+            try:
+                return request(api)
+            except (OSError, http.client.HTTPException):
+                ContainerEngine.api = None
+        return command()
+    def _filters(filters):
+        args = []
+        for key, values in (filters or {}).items():
+            for value in values:
+                args.extend(["--filter", "%s=%s" % (key, value)])
+        return args
+
+    def begin(build_id=None):
+        # builds of a batch run in threads of their own
+        build_id = build_id or uuid.uuid4().hex[:12]
+        ContainerEngine._build.set(build_id)
+        return build_id
+    def _labels(stage):
+        build_id = ContainerEngine._build.get() or ContainerEngine.begin()
+        return { "seine.build": build_id, "seine.stage": stage }
+    def labels(stage):
+        args = []
+        for label in ContainerEngine._labels(stage).items():
+            args.extend(["--label", "%s=%s" % label])
+        return args
+    def dockerfile(script):
+        # podman build only labels the final image: stages (and images cached
+        # for their instructions) are labelled as intermediate objects of the
+        # build for cleanup() to remove them
+        label = " ".join(['%s="%s"' % label for label in ContainerEngine._labels("intermediate").items()])
+        lines = []
+        for line in script.split("\n"):
+            lines.append(line)
+            if line.strip().upper().startswith("FROM "):
+                lines.append(line[:len(line) - len(line.lstrip())] + "LABEL " + label)
+        return "\n".join(lines)
+    def cleanup(build_id):
+        # remove temporary containers (first) and images of a build
+        filters = { "label": [ "seine.build=%s" % build_id ] }
+        for kind in ["container", "image"]:
+            try:
+                if kind == "container":
+                    objects = ContainerEngine.containers(filters)
+                else:
+                    objects = ContainerEngine.images(filters)
+            except (OSError, subprocess.CalledProcessError, ValueError):
+                continue
+            for obj in objects:
+                if (obj.get("Labels") or {}).get("seine.stage") in ContainerEngine.TEMPORARY:
+                    if kind == "container":
+                        ContainerEngine.removeContainer(obj["Id"], force=True)
+                    else:
+                        ContainerEngine.removeImage(obj["Id"], force=True)
+
     def hasImage(name):
-        result = ContainerEngine.run(["image", "exists", name], check=False)
-        return result.returncode == 0
+        def command():
+            result = ContainerEngine.run(["image", "exists", name], check=False)
+            return result.returncode == 0
+        return ContainerEngine._call(lambda api: api.image_exists(name), command)
+    def cachedImage(name):
+        # same as hasImage for images that may be reused: their use is recorded
+        exists = ContainerEngine.hasImage(name)
+        CacheUsage.record(CacheUsage.image(name), exists)
+        return exists
+    def imageId(name):
+        def command():
+            output = ContainerEngine.check_output(["image", "inspect", "--format", "{{.Id}}", name])
+            return output.decode().strip()
+        return ContainerEngine._call(lambda api: api.image_inspect(name)["Id"], command)
+    def images(filters=None):
+        def command():
+            output = ContainerEngine.check_output(["image", "ls", "--format", "json",
+                                                   *ContainerEngine._filters(filters)])
+            return json.loads(output.decode() or "[]")
+        return ContainerEngine._call(lambda api: api.images(filters), command)
+    def removeImage(name, force=False):
+        # returns False if the image could not be removed (e.g. in use)
+        def request(api):
+            try:
+                api.image_remove(name, force)
+                return True
+            except PodmanError:
+                return False
+        def command():
+            cmd = ["image", "rm", "-f", name] if force else ["image", "rm", name]
+            return ContainerEngine.run(cmd, check=False).returncode == 0
+        return ContainerEngine._call(request, command)
+    def pruneImages(filters=None):
+        command = lambda: ContainerEngine.run(["image", "prune", "-f",
+                                               *ContainerEngine._filters(filters)], check=False)
+        ContainerEngine._call(lambda api: api.images_prune(filters), command)
+    def containers(filters=None):
+        def command():
+            output = ContainerEngine.check_output(["container", "ls", "-a", "--format", "json",
+                                                   *ContainerEngine._filters(filters)])
+            return json.loads(output.decode() or "[]")
+        return ContainerEngine._call(lambda api: api.containers(filters), command)
+    def createContainer(image, stage, name=None):
+        def command():
+            cmd = ["container", "create", *ContainerEngine.labels(stage)]
+            if name is not None:
+                cmd.extend(["--name", name])
+            return ContainerEngine.check_output([*cmd, image]).decode().strip()
+        return ContainerEngine._call(
+            lambda api: api.container_create(image, name, ContainerEngine._labels(stage)), command)
+    def removeContainer(name, force=False):
+        def request(api):
+            try:
+                api.container_remove(name, force)
+                return True
+            except PodmanError:
+                return False
+        def command():
+            cmd = ["container", "rm", "-f", name] if force else ["container", "rm", name]
+            return ContainerEngine.run(cmd, check=False).returncode == 0
+        return ContainerEngine._call(request, command)
+    @contextlib.contextmanager
+    def export(container):
+        # stream the file-system of a container as a tarball
+        if ContainerEngine.api is not None:
+            with ContainerEngine.api.container_export(container) as stream:
+                yield stream
+            return
+        proc = ContainerEngine.Popen(["container", "export", container], stdout=subprocess.PIPE)
+        try:
+            yield proc.stdout
+        finally:
+            proc.stdout.close()
+            rc = proc.wait()
+        if rc != 0:
+            raise subprocess.CalledProcessError(rc, "container export")
     def _podman_cmd(cmd):
-        home = os.path.expanduser("~")
-        root = os.path.join(home, ".local", "share", "seine")
+        root = ContainerEngine.root()
+        if cmd[0] == "build" and ContainerEngine.proxy is not None:
+            # the proxy listens on the loopback interface of the host
+            cmd[1:1] = [ "--network", "host",
+                         "--build-arg", "http_proxy=%s" % ContainerEngine.proxy ]
         cmd.insert(0, root)
         cmd.insert(0, "--root")
         cmd.insert(0, "podman")
         return cmd
-    def run(cmd, check=False):
+    def _trace_args(cmd):
+        # name podman invocations after their (sub-)command: "podman image rm"
+        verbs = cmd[3:5] if cmd[3] in ["container", "image", "system", "volume"] else cmd[3:4]
+        return "podman " + " ".join(verbs), { "cmd": " ".join(cmd) }
+    def run(cmd, check=False, lines=None):
+        # lines (if specified) is called with each line of the output and
+        # returns whether it was consumed (other lines are printed)
+        cmd = ContainerEngine._podman_cmd(cmd)
+        name, args = ContainerEngine._trace_args(cmd)
+        with Trace.span(name, cat="podman", args=args):
+            if lines is None:
+                return subprocess.run(cmd, check=check)
+            with subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True, errors="replace") as proc:
+                for line in proc.stdout:
+                    if lines(line.rstrip("\n")) == False:
+                        sys.stdout.write(line)
+                        sys.stdout.flush()
+            if check and proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
+            return subprocess.CompletedProcess(cmd, proc.returncode)
+    async def arun(cmd, check=False):
+        # same as run for stages running as coroutines
         cmd = ContainerEngine._podman_cmd(cmd)
-        return subprocess.run(cmd, check=check)
+        name, args = ContainerEngine._trace_args(cmd)
+        with Trace.span(name, cat="podman", args=args):
+            proc = await asyncio.create_subprocess_exec(*cmd)
+            returncode = await proc.wait()
+        if check and returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
+        return subprocess.CompletedProcess(cmd, returncode)
     def check_output(cmd):
         cmd = ContainerEngine._podman_cmd(cmd)
-        return subprocess.check_output(cmd)
+        name, args = ContainerEngine._trace_args(cmd)
+        with Trace.span(name, cat="podman", args=args):
+            return subprocess.check_output(cmd)
     def Popen(cmd, stdin=None, stdout=None, stderr=None):
         cmd = ContainerEngine._podman_cmd(cmd)
+        name, args = ContainerEngine._trace_args(cmd)
+        Trace.instant(name, cat="podman", args=args)
         return subprocess.Popen(cmd, stdin=stdin, stdout=stdout, stderr=stderr)
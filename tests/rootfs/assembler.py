@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+import avocado
+import io
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tarfile
+import tempfile
+import zlib
+
+path_to_self    = os.path.realpath(__file__)
+path_to_sources = os.path.join(os.path.dirname(path_to_self), "..", "..")
+sys.path.append(path_to_sources)
+
+from seine.assembler import HostAssembler
+from seine.build     import BuildCmd
+from seine.manifest  import Manifest
+from seine.table     import GptTable
+
+class Source:
+    def __init__(self, spec, workdir):
+        build = BuildCmd()
+        build.loads(spec)
+        build.parse()
+        self.options = build.options
+        self.partitionHandler = build.partitionHandler
+        self._tarball = os.path.join(workdir, "rootfs.tar")
+        self._image = os.path.join(workdir, "disk.img")
+
+    def populate(self, files):
+        with tarfile.open(self._tarball, "w") as tar:
+            for name, data in files:
+                info = tarfile.TarInfo(name)
+                if data is None:
+                    info.type = tarfile.DIRTYPE
+                    info.mode = 0o755
+                    tar.addfile(info)
+                else:
+                    info.size = len(data)
+                    info.uid = 1000
+                    tar.addfile(info, io.BytesIO(data))
+        self.manifest = Manifest.build(self._tarball)
+        handler = self.partitionHandler
+        handler.distribute_many(self.manifest.paths(), self.manifest.sizes,
+                                self.manifest.types, self.manifest.linklens())
+        handler.compute_sizes()
+        with open(self._image, "wb") as f:
+            f.truncate(handler.disk_size())
+
+class HostAssemblerGpt(avocado.Test):
+    def test(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            source = Source("""
+                image:
+                    filename: simple-test.img
+                    bootlets:
+                        - file: /usr/lib/loader.bin
+                    partitions:
+                        - label: rootfs
+                          where: /
+                        - label: boot
+                          where: /boot
+            """, workdir)
+            source.populate([
+                ("etc", None),
+                ("etc/hostname", b"seine\n"),
+                ("boot", None),
+                ("boot/vmlinuz", os.urandom(65536)),
+                ("usr", None),
+                ("usr/lib", None),
+                ("usr/lib/loader.bin", b"LOADER" * 100),
+            ])
+            reason = HostAssembler.unsupported(source)
+            if reason is not None:
+                self.cancel("image may not be assembled on this host: %s" % reason)
+            HostAssembler(source).create()
+
+            handler = source.partitionHandler
+            with open(source._image, "rb") as f:
+                f.seek(512)
+                header = GptTable.HEADER.unpack(f.read(GptTable.HEADER.size))
+                f.seek(1024)
+                table = f.read(GptTable.ENTRIES * GptTable.ENTRY_SIZE)
+                f.seek(handler.bootlets[0]["_seek"] * 1024)
+                bootlet = f.read(600)
+            if header[0] != GptTable.SIGNATURE or header[13] != zlib.crc32(table):
+                self.fail("invalid GPT header!")
+            for index, part in enumerate(handler.partitions):
+                first, last = struct.unpack_from("<QQ", table, index * GptTable.ENTRY_SIZE + 32)
+                if first * 512 != part["_offset"] or (last + 1 - first) * 512 != part["_size"]:
+                    self.fail("partition '%s' is misplaced!" % part["label"])
+            if bootlet != b"LOADER" * 100:
+                self.fail("bootlet was not copied!")
+
+            debugfs = shutil.which("debugfs") or shutil.which("debugfs", path="/sbin:/usr/sbin")
+            if debugfs is not None:
+                root = handler._mount_index["/"]
+                device = "%s?offset=%d" % (source._image, root["_offset"])
+                result = subprocess.run([debugfs, "-R", "cat /etc/fstab", device],
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                fstab = result.stdout.decode()
+                if "UUID=%s /boot/ ext4" % handler._mount_index["/boot/"]["_uuid"] not in fstab:
+                    self.fail("/etc/fstab was not generated: %s" % fstab)
+                result = subprocess.run([debugfs, "-R", "ls -l /boot", device],
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                if "vmlinuz" in result.stdout.decode():
+                    self.fail("/boot/vmlinuz was copied to the root file-system!")
+        finally:
+            shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    avocado.main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import avocado
+import os
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+path_to_self    = os.path.realpath(__file__)
+path_to_sources = os.path.join(os.path.dirname(path_to_self), "..", "..")
+sys.path.append(path_to_sources)
+
+from seine.batch import Batch, Budget
+
+class BatchSharedStagesRunOnce(avocado.Test):
+    def test(self):
+        batch = Batch([], Budget(4, 4096, 2))
+        calls = []
+        def create():
+            calls.append(threading.get_ident())
+            time.sleep(0.1)
+            return "bootstrap"
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(lambda i: batch.once(("image", "host"), create), range(8)))
+        if len(calls) != 1:
+            self.fail("shared stage was run %d times!" % len(calls))
+        if results != ["bootstrap"] * 8:
+            self.fail("builds did not all get the result of the shared stage!")
+
+class BatchBudget(avocado.Test):
+    def test(self):
+        budget = Budget(2, 1024, 1)
+        lock = threading.Lock()
+        running = []
+        peak = { "io": 0, "cpu": 0 }
+        def stage(demand):
+            with budget.reserve(demand):
+                with lock:
+                    running.append(demand)
+                    peak["io"] = max(peak["io"], sum([d.get("io", 0) for d in running]))
+                    peak["cpu"] = max(peak["cpu"], sum([d.get("cpu", 0) for d in running]))
+                time.sleep(0.05)
+                with lock:
+                    running.remove(demand)
+        demands = [ { "cpu": 1, "io": 1 } for i in range(4) ] + [ { "cpu": 1 } for i in range(4) ]
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(stage, demands))
+        if peak["io"] > 1 or peak["cpu"] > 2:
+            self.fail("budget was exceeded: %s" % peak)
+
+        # stages larger than the budget still run (alone)
+        with budget.reserve({ "cpu": 8 }):
+            pass
+
+if __name__ == "__main__":
+    avocado.main()
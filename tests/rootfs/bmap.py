@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import avocado
+import os
+import sys
+import tempfile
+
+path_to_self    = os.path.realpath(__file__)
+path_to_sources = os.path.join(os.path.dirname(path_to_self), "..", "..")
+sys.path.append(path_to_sources)
+
+from seine.bmap import BlockMap
+
+def make_sparse_image(size):
+    image = tempfile.NamedTemporaryFile(delete=False, suffix=".img")
+    image.truncate(size)
+    for offset in [ 0, 1024 * 1024 + 100, size - 10 ]:
+        image.seek(offset)
+        image.write(os.urandom(10))
+    image.close()
+    return image.name
+
+class BlockMapRoundTrip(avocado.Test):
+    def test(self):
+        size = 8 * 1024 * 1024 + 512
+        image = make_sparse_image(size)
+        bmap_file = image + ".bmap"
+        copy = image + ".copy"
+        try:
+            bmap = BlockMap.generate(image)
+            if bmap.image_size != size or bmap.blocks_count() != 2049:
+                self.fail("unexpected image or block count: %d/%d" % (bmap.image_size, bmap.blocks_count()))
+            if bmap.mapped_blocks_count() >= bmap.blocks_count():
+                self.fail("holes were not detected: %s" % bmap.ranges)
+            bmap.save(bmap_file)
+
+            loaded = BlockMap.load(bmap_file)
+            if loaded.ranges != bmap.ranges or loaded.checksums != bmap.checksums:
+                self.fail("block map changed when saved and loaded again!")
+            loaded.copy(image, copy)
+            with open(image, "rb") as a, open(copy, "rb") as b:
+                if a.read() != b.read():
+                    self.fail("copy differs from the original image!")
+            if os.stat(copy).st_blocks * 512 > bmap.mapped_blocks_count() * BlockMap.BLOCK_SIZE:
+                self.fail("copy is not sparse!")
+        finally:
+            for f in [ image, bmap_file, copy ]:
+                if os.path.exists(f):
+                    os.unlink(f)
+
+class BlockMapCopyOverFile(avocado.Test):
+    def test(self):
+        size = 4 * 1024 * 1024
+        image = make_sparse_image(size)
+        copy = image + ".copy"
+        try:
+            with open(copy, "wb") as f:
+                f.write(b"\xff" * (size + 4096))
+            BlockMap.generate(image).copy(image, copy)
+            with open(image, "rb") as a, open(copy, "rb") as b:
+                if a.read() != b.read():
+                    self.fail("data of the previous file was left in the copy!")
+        finally:
+            for f in [ image, copy ]:
+                if os.path.exists(f):
+                    os.unlink(f)
+
+class BlockMapChecksumMismatch(avocado.Test):
+    def test(self):
+        image = make_sparse_image(1024 * 1024)
+        copy = image + ".copy"
+        try:
+            bmap = BlockMap.generate(image)
+            bmap.checksums[0] = "0" * 64
+            try:
+                bmap.copy(image, copy)
+                self.fail("copy should have failed (bad checksum)!")
+            except IOError as e:
+                if "checksum mismatch" not in str(e):
+                    raise
+        finally:
+            for f in [ image, copy ]:
+                if os.path.exists(f):
+                    os.unlink(f)
+
+if __name__ == "__main__":
+    avocado.main()
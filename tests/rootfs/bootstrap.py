@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import avocado
+import functools
+import http.server
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+path_to_self    = os.path.realpath(__file__)
+path_to_sources = os.path.join(os.path.dirname(path_to_self), "..", "..")
+sys.path.append(path_to_sources)
+
+from seine.bootstrap import AnsibleToolchain, TargetBootstrap
+from seine.image     import Image
+from seine.utils     import ContainerEngine
+
+class Mirror(http.server.SimpleHTTPRequestHandler):
+    requests = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        Mirror.requests = Mirror.requests + 1
+        super().do_GET()
+
+class TargetBootstrapKeys(avocado.Test):
+    def test(self):
+        workdir = tempfile.mkdtemp()
+        saved = (ContainerEngine.run, ContainerEngine.hasImage, os.environ.get("XDG_CACHE_HOME"))
+        mirror = None
+        try:
+            os.environ["XDG_CACHE_HOME"] = workdir
+            root = os.path.join(workdir, "mirror")
+            os.makedirs(os.path.join(root, "dists", "stable"))
+            release = os.path.join(root, "dists", "stable", "InRelease")
+            with open(release, "w") as f:
+                f.write("Suite: stable\nVersion: 1\n")
+            handler = functools.partial(Mirror, directory=root)
+            mirror = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+            threading.Thread(target=mirror.serve_forever, daemon=True).start()
+            uri = "http://127.0.0.1:%d" % mirror.server_address[1]
+
+            def bootstrap(refresh=False, **settings):
+                distro = { "source": "debian", "release": "stable", "architecture": "amd64", "uri": uri }
+                distro.update(settings)
+                return TargetBootstrap(distro, { "refresh": refresh }).refresh()
+
+            first = bootstrap()
+            if first.name != bootstrap().name or not first.name.startswith("bootstrap/debian/stable/amd64:"):
+                self.fail("unexpected bootstrap name: %s" % first.name)
+            if bootstrap(variant="buildd").name == first.name:
+                self.fail("settings of the distribution are not part of the key!")
+
+            # bootstraps are loaded from their tarball
+            commands = []
+            def run(cmd, check=False):
+                commands.append(cmd[0] if cmd[0] != "image" else " ".join(cmd))
+                if cmd[0] == "save":
+                    open(cmd[cmd.index("-o") + 1], "w").close()
+                return subprocess.CompletedProcess(cmd, 0)
+            ContainerEngine.run = run
+            ContainerEngine.hasImage = lambda name: True
+            first._save()
+            if bootstrap().create(None) is None or commands != ["save", "load"]:
+                self.fail("bootstrap was not loaded from its tarball: %s" % commands)
+
+            # a new release is only looked for once a week or when requested
+            with open(release, "w") as f:
+                f.write("Suite: stable\nVersion: 2\n")
+            Mirror.requests = 0
+            if bootstrap().name != first.name or Mirror.requests != 0:
+                self.fail("mirror was checked again for a new release!")
+            second = bootstrap(refresh=True)
+            if second.name == first.name:
+                self.fail("bootstrap of a previous release was reused!")
+
+            # the bootstrap of the previous release is evicted
+            del commands[:]
+            second._save()
+            if commands != ["save", "image rm %s" % first.name] or os.path.exists(first.tarball()):
+                self.fail("previous bootstrap was not evicted: %s" % commands)
+
+            # the last known release is used when the mirror cannot be reached
+            mirror.shutdown()
+            mirror.server_close()
+            mirror = None
+            if bootstrap(refresh=True).name != second.name:
+                self.fail("cached bootstrap was not used while offline!")
+        finally:
+            ContainerEngine.run, ContainerEngine.hasImage = saved[0], saved[1]
+            if saved[2] is None:
+                os.environ.pop("XDG_CACHE_HOME", None)
+            else:
+                os.environ["XDG_CACHE_HOME"] = saved[2]
+            if mirror is not None:
+                mirror.shutdown()
+                mirror.server_close()
+            shutil.rmtree(workdir)
+
+class HostAnsibleLayers(avocado.Test):
+    def test(self):
+        workdir = tempfile.mkdtemp()
+        saved = (ContainerEngine.run, ContainerEngine.hasImage, ContainerEngine.imageId,
+                 os.environ.get("XDG_CACHE_HOME"))
+        try:
+            os.environ["XDG_CACHE_HOME"] = workdir
+            builds = []
+            def run(cmd, check=False, lines=None):
+                with open(cmd[cmd.index("-f") + 1]) as f:
+                    builds.append((cmd, f.read()))
+                return subprocess.CompletedProcess(cmd, 0)
+            ContainerEngine.run = run
+            ContainerEngine.hasImage = lambda name: name == "debian:bookworm"
+            ContainerEngine.imageId = lambda name: "sha256:" + name
+
+            distro = { "source": "debian", "release": "bookworm", "architecture": "amd64" }
+            def rootfs(mode):
+                image = Image(None, { "ansible": mode, "keep": False, "verbose": False })
+                image.spec = { "playbook": [{ "name": "base", "hosts": "localhost", "tasks": [] }] }
+                image._from = "debian:bookworm"
+                image.hostBootstrap = type("Host", (), { "name": "bootstrap/debian/bookworm/all" })()
+                image.toolchain = AnsibleToolchain(distro, {})
+                del builds[:]
+                image.rootfs()
+                return image._layer_keys(image.spec["playbook"])
+
+            target = rootfs("target")
+            host = rootfs("host")
+            if host == target:
+                self.fail("layers of both Ansible modes share their keys!")
+            if AnsibleToolchain(distro, {}).name != "toolchain/debian/bookworm/ansible":
+                self.fail("unexpected toolchain name")
+
+            # Ansible is not installed in the root file-system but run from the
+            # toolchain, the root file-system being reached with chroot
+            prepare, playbook, finalize = [script for cmd, script in builds]
+            if "seine-ansible" in prepare or "seine-ansible" in finalize:
+                self.fail("Ansible was installed in the root file-system:\n%s" % prepare)
+            if "from=toolchain/debian/bookworm/ansible," not in playbook \
+                    or "ansible_connection=chroot" not in playbook:
+                self.fail("playbook was not run from the toolchain:\n%s" % playbook)
+            # layers are stacked (and hold what their playbook changed)
+            if playbook.split("\n")[1] != "FROM layers/%s" % host[0] or "COPY" in playbook:
+                self.fail("layer is not stacked on the previous one:\n%s" % playbook)
+            if "SYS_ADMIN" not in builds[1][0]:
+                self.fail("root file-system could not be mounted: %s" % builds[1][0])
+        finally:
+            ContainerEngine.run, ContainerEngine.hasImage, ContainerEngine.imageId = saved[:3]
+            if saved[3] is None:
+                os.environ.pop("XDG_CACHE_HOME", None)
+            else:
+                os.environ["XDG_CACHE_HOME"] = saved[3]
+            shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    avocado.main()
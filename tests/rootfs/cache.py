@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import avocado
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+path_to_self    = os.path.realpath(__file__)
+path_to_sources = os.path.join(os.path.dirname(path_to_self), "..", "..")
+sys.path.append(path_to_sources)
+
+from seine.build import BuildCmd
+from seine.cache import Artifacts
+from seine.utils import Cache, CacheUsage, ContainerEngine
+
+class CacheGarbageCollection(avocado.Test):
+    def test(self):
+        workdir = tempfile.mkdtemp()
+        saved = (ContainerEngine.run, ContainerEngine.check_output, os.environ.get("XDG_CACHE_HOME"))
+        try:
+            os.environ["XDG_CACHE_HOME"] = workdir
+            images = [
+                { "Id": "1", "Names": [ "localhost/layers/old:latest" ], "Size": 300, "Created": 1000 },
+                { "Id": "2", "Names": [ "localhost/layers/new:latest" ], "Size": 300, "Created": 1000 },
+                { "Id": "3", "Names": None, "Size": 100, "Created": 1000 },
+            ]
+            removed = []
+            def run(cmd, check=False):
+                if cmd[:2] == ["image", "rm"]:
+                    removed.append(cmd[2])
+                    images[:] = [i for i in images if "localhost/%s" % cmd[2] not in (i["Names"] or [])]
+                return subprocess.CompletedProcess(cmd, 0)
+            ContainerEngine.run = run
+            ContainerEngine.check_output = lambda cmd: json.dumps(images).encode()
+
+            os.makedirs(Cache.path("bootstrap"))
+            tarball = Cache.path("bootstrap", "0123-4567.tar")
+            with open(tarball, "wb") as f:
+                f.write(b"\0" * 200)
+            os.utime(tarball, (2000, 2000))
+
+            # uses and hits are recorded, images named as podman lists them
+            CacheUsage.record(CacheUsage.image("layers/new"))
+            CacheUsage.record(CacheUsage.image("layers/new"), True)
+            CacheUsage.record(CacheUsage.file(tarball), True)
+            artifacts = Artifacts.list()
+            if [a.name for a in artifacts] != ["layers/old:latest", "layers/new:latest", "bootstrap/0123-4567.tar"]:
+                self.fail("unexpected artifacts: %s" % [a.name for a in artifacts])
+            new = Artifacts.find(artifacts, "layers/new:latest")
+            if (new.uses, new.hits) != (2, 1) or new.last_use < time.time() - 60:
+                self.fail("usage of layers/new was not recorded: %d uses, %d hits" % (new.uses, new.hits))
+
+            # least recently used artifacts are evicted first
+            evicted, used = Artifacts.gc(600)
+            if [a.name for a in evicted] != ["layers/old:latest"] or used != 500:
+                self.fail("unexpected eviction: %s (%d bytes used)" % ([a.name for a in evicted], used))
+            evicted, used = Artifacts.gc(0)
+            if removed != ["layers/old:latest", "layers/new:latest"] or os.path.exists(tarball):
+                self.fail("cache was not emptied: %s" % removed)
+            if CacheUsage.load()["items"]:
+                self.fail("usage of evicted artifacts was kept: %s" % CacheUsage.load())
+        finally:
+            ContainerEngine.run, ContainerEngine.check_output = saved[0], saved[1]
+            if saved[2] is None:
+                os.environ.pop("XDG_CACHE_HOME", None)
+            else:
+                os.environ["XDG_CACHE_HOME"] = saved[2]
+            shutil.rmtree(workdir)
+
+class BuildCleanup(avocado.Test):
+    def test(self):
+        workdir = tempfile.mkdtemp()
+        saved = (ContainerEngine.run, ContainerEngine.check_output, os.environ.get("XDG_CACHE_HOME"))
+        try:
+            os.environ["XDG_CACHE_HOME"] = workdir
+            objects = {
+                "container": [
+                    { "Id": "c1", "Labels": { "seine.build": "b1", "seine.stage": "export" } },
+                    { "Id": "c2", "Labels": { "seine.build": "b1", "seine.stage": "imager" } },
+                ],
+                "image": [
+                    { "Id": "i1", "Labels": { "seine.build": "b1", "seine.stage": "layer" } },
+                    { "Id": "i2", "Labels": { "seine.build": "b1", "seine.stage": "finalize" } },
+                    { "Id": "i3", "Labels": { "seine.build": "b1", "seine.stage": "intermediate" } },
+                ],
+            }
+            commands = []
+            def check_output(cmd):
+                if "label=seine.build=b1" not in cmd:
+                    self.fail("objects of other builds were listed: %s" % cmd)
+                return json.dumps(objects[cmd[0]]).encode()
+            def run(cmd, check=False):
+                commands.append(cmd)
+                return subprocess.CompletedProcess(cmd, 0)
+            ContainerEngine.check_output = check_output
+            ContainerEngine.run = run
+
+            ContainerEngine.begin("b1")
+            labels = ContainerEngine.labels("layer")
+            if labels != ["--label", "seine.build=b1", "--label", "seine.stage=layer"]:
+                self.fail("unexpected labels: %s" % labels)
+
+            # layers are kept as cache, temporary objects are removed
+            ContainerEngine.cleanup("b1")
+            if commands != [["container", "rm", "-f", "c1"], ["image", "rm", "-f", "i2"],
+                            ["image", "rm", "-f", "i3"]]:
+                self.fail("unexpected cleanup: %s" % commands)
+
+            # stages of multi-stage builds are labelled as intermediate images
+            dockerfile = ContainerEngine.dockerfile("FROM a AS base\nRUN true\n  FROM base AS clean\n")
+            label = 'LABEL seine.build="b1" seine.stage="intermediate"'
+            if dockerfile != "FROM a AS base\n%s\nRUN true\n  FROM base AS clean\n  %s\n" % (label, label):
+                self.fail("unexpected dockerfile:\n%s" % dockerfile)
+
+            # images of other builds (or anything else) are not pruned
+            del commands[:]
+            BuildCmd()._collect()
+            if commands:
+                self.fail("images were pruned: %s" % commands)
+        finally:
+            ContainerEngine.run, ContainerEngine.check_output = saved[0], saved[1]
+            if saved[2] is None:
+                os.environ.pop("XDG_CACHE_HOME", None)
+            else:
+                os.environ["XDG_CACHE_HOME"] = saved[2]
+            shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    avocado.main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import avocado
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+path_to_self    = os.path.realpath(__file__)
+path_to_sources = os.path.join(os.path.dirname(path_to_self), "..", "..")
+sys.path.append(path_to_sources)
+
+from seine.build    import BuildCmd
+from seine.estimate import Estimator
+from seine.manifest import Manifest
+
+def populate(top):
+    # directories of small, medium and large files with a few links
+    for d in range(40):
+        dir = os.path.join(top, "dir%02d" % d, "sub")
+        os.makedirs(dir)
+        for f in range(50):
+            with open(os.path.join(dir, "file-with-a-long-name-%03d" % f), "wb") as out:
+                out.write(os.urandom((f * 1237 * (d + 1)) % 300000))
+        os.symlink("sub/file-with-a-long-name-001", os.path.join(top, "dir%02d" % d, "link"))
+        os.link(os.path.join(dir, "file-with-a-long-name-002"), os.path.join(top, "dir%02d" % d, "hard"))
+    with open(os.path.join(top, "big"), "wb") as out:
+        out.write(os.urandom(32 * 1024 * 1024))
+
+class EstimateFitsExt4(avocado.Test):
+    def test(self):
+        mke2fs = shutil.which("mke2fs") or shutil.which("mke2fs", path="/sbin:/usr/sbin")
+        if mke2fs is None:
+            self.cancel("mke2fs is not available")
+        workdir = tempfile.mkdtemp()
+        try:
+            top = os.path.join(workdir, "rootfs")
+            populate(top)
+            tarball = os.path.join(workdir, "rootfs.tar")
+            with tarfile.open(tarball, "w") as tar:
+                for name in sorted(os.listdir(top)):
+                    tar.add(os.path.join(top, name), name)
+
+            build = BuildCmd()
+            build.loads("""
+                image:
+                    filename: simple-test.img
+                    partitions:
+                        - label: rootfs
+                          where: /
+                          type: ext4
+                          extra: 0MiB
+            """)
+            build.parse()
+            handler = build.partitionHandler
+            manifest = Manifest.build(tarball)
+            handler.distribute_many(manifest.paths(), manifest.sizes, manifest.types, manifest.linklens())
+            handler.compute_sizes()
+            mount = handler.mounts[0]
+
+            image = os.path.join(workdir, "rootfs.img")
+            with open(image, "wb") as f:
+                f.truncate(mount["_size"])
+            options = Estimator.get("ext4").options(mount).split()
+            result = subprocess.run([mke2fs, "-q", "-F", "-t", "ext4", *options, "-d", top, image],
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            if result.returncode != 0:
+                self.fail("estimated size (%d bytes) is too small: %s" % (mount["_size"], result.stdout))
+
+            # the estimate should not be more than 5% too large
+            data = 0
+            for f in manifest:
+                data = data + f.size
+            if mount["_size"] > data * 1.05 + 20 * 1024 * 1024:
+                self.fail("estimated size (%d bytes) is too large for %d bytes" % (mount["_size"], data))
+        finally:
+            shutil.rmtree(workdir)
+
+class EstimateExtraInodes(avocado.Test):
+    def test(self):
+        mke2fs = shutil.which("mke2fs") or shutil.which("mke2fs", path="/sbin:/usr/sbin")
+        dumpe2fs = shutil.which("dumpe2fs") or shutil.which("dumpe2fs", path="/sbin:/usr/sbin")
+        if mke2fs is None or dumpe2fs is None:
+            self.cancel("mke2fs is not available")
+        workdir = tempfile.mkdtemp()
+        try:
+            top = os.path.join(workdir, "rootfs")
+            os.makedirs(top)
+            for f in range(100):
+                with open(os.path.join(top, "file-%03d" % f), "wb") as out:
+                    out.write(os.urandom(1000))
+            tarball = os.path.join(workdir, "rootfs.tar")
+            with tarfile.open(tarball, "w") as tar:
+                for name in sorted(os.listdir(top)):
+                    tar.add(os.path.join(top, name), name)
+
+            build = BuildCmd()
+            build.loads("""
+                image:
+                    filename: simple-test.img
+                    partitions:
+                        - label: rootfs
+                          where: /
+                          type: ext4
+                          extra: 256MiB
+            """)
+            build.parse()
+            handler = build.partitionHandler
+            manifest = Manifest.build(tarball)
+            handler.distribute_many(manifest.paths(), manifest.sizes, manifest.types, manifest.linklens())
+            handler.compute_sizes()
+            mount = handler.mounts[0]
+
+            image = os.path.join(workdir, "rootfs.img")
+            with open(image, "wb") as f:
+                f.truncate(mount["_size"])
+            options = Estimator.get("ext4").options(mount).split()
+            subprocess.run([mke2fs, "-q", "-F", "-t", "ext4", *options, "-d", top, image], check=True)
+            header = subprocess.run([dumpe2fs, "-h", image], stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL, text=True, check=True).stdout
+            fields = dict([line.split(":", 1) for line in header.splitlines() if ":" in line])
+
+            # the extra space comes with as many inodes as mke2fs would give it
+            free = int(fields["Free inodes"])
+            if free < mount["_size"] // 16384 - 200:
+                self.fail("%d free inodes for %d bytes" % (free, mount["_size"]))
+        finally:
+            shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    avocado.main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import avocado
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+path_to_self    = os.path.realpath(__file__)
+path_to_sources = os.path.join(os.path.dirname(path_to_self), "..", "..")
+sys.path.append(path_to_sources)
+
+from seine.build    import BuildCmd
+from seine.imager   import Imager
+from seine.manifest import Manifest
+from seine.utils    import ContainerEngine
+
+class Source:
+    def __init__(self):
+        self.options = { "debug": False, "keep": False, "verbose": False }
+        self.spec = { "distribution": { "source": "debian", "release": "buster" } }
+
+class ImagerArtifactsCached(avocado.Test):
+    def test(self):
+        workdir = tempfile.mkdtemp()
+        saved = (ContainerEngine.Popen, ContainerEngine.imageId, os.environ.get("XDG_CACHE_HOME"))
+        try:
+            container = os.path.join(workdir, "container.tar")
+            with tarfile.open(container, "w") as tar:
+                for name in ["vmlinuz", "initrd.img", "rootfs", "etc/hostname"]:
+                    info = tarfile.TarInfo(name)
+                    info.size = len(name)
+                    tar.addfile(info, io.BytesIO(name.encode()))
+
+            # pretend to be podman: count exports of the imager container
+            exports = []
+            digest = [ "sha256:1111" ]
+            def popen(cmd, stdin=None, stdout=None, stderr=None):
+                exports.append(cmd)
+                return subprocess.Popen(["cat", container], stdout=stdout)
+            ContainerEngine.Popen = popen
+            ContainerEngine.imageId = lambda name: digest[0]
+            os.environ["XDG_CACHE_HOME"] = workdir
+
+            imager = Imager(Source())
+            first = imager.get_artifacts()
+            second = imager.get_artifacts()
+            if first != second or len(exports) != 1:
+                self.fail("artifacts were exported %d times!" % len(exports))
+            for path, name in zip(first, Imager.ARTIFACTS):
+                with open(path) as f:
+                    if f.read() != name:
+                        self.fail("%s was not extracted!" % name)
+
+            digest[0] = "sha256:2222"
+            pending = tempfile.mkdtemp(prefix="tmp", dir=os.path.dirname(os.path.dirname(first[0])))
+            third = imager.get_artifacts()
+            if len(exports) != 2 or os.path.exists(first[0]) or not os.path.exists(third[0]):
+                self.fail("artifacts of a rebuilt imager were not refreshed!")
+            if os.path.isdir(pending) is False:
+                self.fail("extraction of a concurrent build was removed!")
+        finally:
+            ContainerEngine.Popen, ContainerEngine.imageId = saved[0], saved[1]
+            if saved[2] is None:
+                os.environ.pop("XDG_CACHE_HOME", None)
+            else:
+                os.environ["XDG_CACHE_HOME"] = saved[2]
+            shutil.rmtree(workdir)
+
+class ImagerParallelExtraction(avocado.Test):
+    def test(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            build = BuildCmd()
+            build.loads("""
+                image:
+                    filename: extract-test.img
+                    partitions:
+                        - label: rootfs
+                          where: /
+                        - label: usr
+                          where: /usr
+                        - label: local
+                          where: /usr/local
+                        - label: data
+                          where: /srv/data
+            """)
+            build.parse()
+            tarball = os.path.join(workdir, "rootfs.tar")
+            files = { "/": [ "etc", "etc/hostname", "srv" ],
+                      "/usr/": [ "usr", "usr/bin", "usr/bin/sh", "usr/localtime" ],
+                      "/usr/local/": [ "usr/local", "usr/local/bin", "usr/local/bin/tool" ] }
+            dirs = [ "etc", "srv", "usr", "usr/bin", "usr/local", "usr/local/bin" ]
+            with tarfile.open(tarball, "w") as tar:
+                for name in sorted(sum(files.values(), [])):
+                    info = tarfile.TarInfo(name)
+                    if name in dirs:
+                        info.type = tarfile.DIRTYPE
+                        tar.addfile(info)
+                    else:
+                        info.size = 1024 if name.startswith("usr/bin") else 1
+                        tar.addfile(info, io.BytesIO(b"x" * info.size))
+            manifest = Manifest.open(tarball)
+            handler = build.partitionHandler
+            handler.distribute_many(manifest.paths(), manifest.sizes, manifest.types, manifest.linklens())
+
+            # list what each tar job would extract
+            script = handler.extract_script(tarball, manifest)
+            jobs = [l for l in script.splitlines() if l.startswith("tar ")]
+            if len(jobs) != 3:
+                self.fail("expected one job per non-empty mount: %s" % jobs)
+            if "'usr'" not in jobs[0]:
+                self.fail("largest mount shall be extracted first: %s" % jobs)
+            lists = []
+            for n, job in enumerate(jobs):
+                listing = os.path.join(workdir, "list.%d" % n)
+                lists.append(listing)
+                script = script.replace(job, job.replace("-xf", "-tf").replace(" &", " >%s &" % listing))
+            subprocess.run(["bash", "-e", "-c", "wait_pids() { wait; }\nthrottle() { :; }\n" + script],
+                           check=True, cwd=workdir)
+            extracted = []
+            for listing in lists:
+                with open(listing) as f:
+                    extracted.append(sorted([l.rstrip("/") for l in f.read().splitlines()]))
+            for names in files.values():
+                if sorted(names) not in extracted:
+                    self.fail("unexpected extraction lists: %s" % extracted)
+        finally:
+            shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    avocado.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+import avocado
+import copy
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+path_to_self    = os.path.realpath(__file__)
+path_to_sources = os.path.join(os.path.dirname(path_to_self), "..", "..")
+sys.path.append(path_to_sources)
+
+from seine.image import Image
+from seine.utils import ContainerEngine
+
+PLAYBOOKS = [
+    { "name": "base", "hosts": "localhost", "tasks": [{ "apt": { "name": "ssh" } }] },
+    { "name": "locales", "hosts": "localhost", "tasks": [{ "apt": { "name": "locales" } }] },
+    { "name": "users", "hosts": "localhost", "tasks": [{ "user": { "name": "seine" } }] },
+]
+
+class LayersResume(avocado.Test):
+    def test(self):
+        workdir = tempfile.mkdtemp()
+        saved = (ContainerEngine.run, ContainerEngine.hasImage, ContainerEngine.imageId,
+                 os.environ.get("XDG_CACHE_HOME"))
+        try:
+            os.environ["XDG_CACHE_HOME"] = workdir
+            layers = set()
+            built = []
+            def run(cmd, check=False, lines=None):
+                if "-t" in cmd:
+                    built.append(cmd[cmd.index("-t") + 1])
+                    layers.add(cmd[cmd.index("-t") + 1])
+                return subprocess.CompletedProcess(cmd, 0)
+            ContainerEngine.run = run
+            ContainerEngine.hasImage = lambda name: name == "debian:bookworm" or name in layers
+            ContainerEngine.imageId = lambda name: "sha256:" + name
+
+            def rootfs(playbooks, cache=True):
+                image = Image(None, { "cache": cache, "keep": False, "verbose": False })
+                image.spec = { "playbook": playbooks }
+                image._from = "debian:bookworm"
+                image.hostBootstrap = type("Host", (), { "name": "bootstrap/debian/bookworm/all" })()
+                del built[:]
+                image.rootfs()
+                return ["layers/%s" % key for key in image._layer_keys(playbooks)]
+
+            # layer #0 (Ansible installed) then a layer per playbook
+            first = rootfs(PLAYBOOKS)
+            if built != first:
+                self.fail("unexpected layers: %s" % built)
+            if rootfs(PLAYBOOKS) != first or built:
+                self.fail("cached layers were not reused: %s" % built)
+
+            # a change to playbook #2 keeps layers #0 and #1 and resumes from #2
+            changed = copy.deepcopy(PLAYBOOKS)
+            changed[1]["tasks"][0]["apt"]["name"] = "locales-all"
+            second = rootfs(changed)
+            if second[:2] != first[:2] or second[2] == first[2] or second[3] == first[3]:
+                self.fail("unexpected keys after a change of playbook #2")
+            if built != second[2:]:
+                self.fail("build did not resume from layer #2: %s" % built)
+
+            # --no-cache builds all layers from scratch
+            if rootfs(PLAYBOOKS, cache=False) != first or built != first:
+                self.fail("layers were reused without cache: %s" % built)
+        finally:
+            ContainerEngine.run, ContainerEngine.hasImage, ContainerEngine.imageId = saved[:3]
+            if saved[3] is None:
+                os.environ.pop("XDG_CACHE_HOME", None)
+            else:
+                os.environ["XDG_CACHE_HOME"] = saved[3]
+            shutil.rmtree(workdir)
+
+class LayersLocalFiles(avocado.Test):
+    def test(self):
+        workdir = tempfile.mkdtemp()
+        saved = (ContainerEngine.imageId, Image.HOST_TMP)
+        try:
+            ContainerEngine.imageId = lambda name: "sha256:" + name
+            Image.HOST_TMP = workdir
+            os.makedirs(os.path.join(workdir, "files"))
+            os.makedirs(os.path.join(workdir, "roles", "web", "tasks"))
+            def write(path, content):
+                with open(os.path.join(workdir, path), "w") as f:
+                    f.write(content)
+            write("files/motd", "welcome\n")
+            write("roles/web/tasks/main.yml", "- apt: { name: nginx }\n")
+
+            image = Image(None, { "cache": True, "keep": False, "verbose": False })
+            image._from = "debian:bookworm"
+            image.hostBootstrap = type("Host", (), { "name": "bootstrap/debian/bookworm/all" })()
+            playbooks = copy.deepcopy(PLAYBOOKS)
+            playbooks[1]["tasks"].append({ "copy": { "src": "motd", "dest": "/etc/motd" } })
+            playbooks[2]["roles"] = [{ "role": "web" }]
+            first = image._layer_keys(playbooks)
+
+            # a change to a file copied by playbook #2 invalidates layers #2 and #3
+            write("files/motd", "hello\n")
+            second = image._layer_keys(playbooks)
+            if second[:2] != first[:2] or second[2] == first[2] or second[3] == first[3]:
+                self.fail("unexpected keys after a change of a copied file")
+
+            # a change to a role used by playbook #3 only invalidates layer #3
+            write("roles/web/tasks/main.yml", "- apt: { name: apache2 }\n")
+            third = image._layer_keys(playbooks)
+            if third[:3] != second[:3] or third[3] == second[3]:
+                self.fail("unexpected keys after a change of a role")
+        finally:
+            ContainerEngine.imageId, Image.HOST_TMP = saved
+            shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    avocado.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import avocado
+import io
+import os
+import sys
+import tarfile
+import tempfile
+
+path_to_self    = os.path.realpath(__file__)
+path_to_sources = os.path.join(os.path.dirname(path_to_self), "..", "..")
+sys.path.append(path_to_sources)
+
+from seine.manifest import Manifest
+
+def make_tarball():
+    tarball = tempfile.NamedTemporaryFile(delete=False, suffix=".tar")
+    with tarfile.open(fileobj=tarball, mode="w") as tar:
+        for name in [ "etc", "usr", "usr/bin" ]:
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.DIRTYPE
+            tar.addfile(info)
+        for name, data in [ ("etc/hostname", b"seine\n"), ("rootfs.xattr", b"# file: etc/hostname\n") ]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        info = tarfile.TarInfo("usr/bin/sh")
+        info.type = tarfile.SYMTYPE
+        info.linkname = "dash"
+        tar.addfile(info)
+    tarball.close()
+    return tarball.name
+
+def cleanup(tarball):
+    os.unlink(tarball)
+    if os.path.exists(Manifest.sidecar(tarball)):
+        os.unlink(Manifest.sidecar(tarball))
+
+class ManifestColumns(avocado.Test):
+    def test(self):
+        tarball = make_tarball()
+        try:
+            manifest = Manifest.build(tarball)
+            names = [f.name for f in manifest]
+            if names != [ "etc", "usr", "usr/bin", "etc/hostname", "rootfs.xattr", "usr/bin/sh" ]:
+                self.fail("unexpected members: %s" % names)
+            f = manifest.entry(manifest.find("usr/bin/sh"))
+            if f.issym() is False or f.linkname != "dash":
+                self.fail("'usr/bin/sh' should be a symbolic link to 'dash'!")
+            if manifest.read(tarball, "etc/hostname") != b"seine\n":
+                self.fail("unexpected content for 'etc/hostname'!")
+        finally:
+            cleanup(tarball)
+
+class ManifestSidecar(avocado.Test):
+    def test(self):
+        tarball = make_tarball()
+        try:
+            Manifest.open(tarball).close()
+            if os.path.exists(Manifest.sidecar(tarball)) is False:
+                self.fail("sidecar file was not created!")
+            manifest = Manifest.open(tarball)
+            if manifest.find("etc/hostname") != 3 or manifest.sizes[3] != 6:
+                self.fail("memory-mapped manifest does not match the tarball!")
+            if manifest.find("hostname") is not None:
+                self.fail("partial names shall not be found!")
+            manifest.close()
+        finally:
+            cleanup(tarball)
+
+class ManifestDotSlash(avocado.Test):
+    def test(self):
+        tarball = tempfile.NamedTemporaryFile(delete=False, suffix=".tar")
+        with tarfile.open(fileobj=tarball, mode="w") as tar:
+            for name, data in [ ("./etc/hostname", b"seine\n"), ("./rootfs.xattr", b"") ]:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        tarball.close()
+        plain = make_tarball()
+        try:
+            # members are found whether named with a leading "./" or not
+            manifest = Manifest.open(tarball.name)
+            for name in [ "rootfs.xattr", "./rootfs.xattr", "/rootfs.xattr" ]:
+                if manifest.find(name) != 1:
+                    self.fail("'%s' not found!" % name)
+            if manifest.read(tarball.name, "etc/hostname") != b"seine\n":
+                self.fail("unexpected content for 'etc/hostname'!")
+            manifest.close()
+            if Manifest.build(plain).find("./etc/hostname") != 3:
+                self.fail("'./etc/hostname' not found without its prefix!")
+        finally:
+            cleanup(tarball.name)
+            cleanup(plain)
+
+if __name__ == "__main__":
+    avocado.main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import avocado
+import lzma
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+
+path_to_self    = os.path.realpath(__file__)
+path_to_sources = os.path.join(os.path.dirname(path_to_self), "..", "..")
+sys.path.append(path_to_sources)
+
+from seine.output import OutputFormat, ZstdFormat
+
+def make_sparse_image():
+    image = tempfile.NamedTemporaryFile(delete=False, suffix=".img")
+    image.truncate(3 * OutputFormat.get("xz").FRAME_SIZE + 4096)
+    image.seek(OutputFormat.get("xz").FRAME_SIZE + 512)
+    image.write(os.urandom(8192))
+    image.close()
+    with open(image.name, "rb") as f:
+        return image.name, f.read()
+
+class XzOutput(avocado.Test):
+    def test(self):
+        image, content = make_sparse_image()
+        output = image + ".xz"
+        try:
+            OutputFormat.get("xz").write(image, output)
+            if os.path.exists(image):
+                self.fail("raw image was not removed!")
+            with lzma.open(output) as f:
+                if f.read() != content:
+                    self.fail("decompressed image differs from the raw image!")
+        finally:
+            for f in [ image, output ]:
+                if os.path.exists(f):
+                    os.unlink(f)
+
+class ZstdSeekableOutput(avocado.Test):
+    def test(self):
+        if shutil.which("zstd") is None:
+            self.cancel("zstd is not available")
+        image, content = make_sparse_image()
+        output = image + ".zst"
+        try:
+            OutputFormat.get("zstd").write(image, output)
+            result = subprocess.run(["zstd", "-dc", output], stdout=subprocess.PIPE, check=True)
+            if result.stdout != content:
+                self.fail("decompressed image differs from the raw image!")
+            with open(output, "rb") as f:
+                f.seek(-9, os.SEEK_END)
+                frames, descriptor, magic = struct.unpack("<IBI", f.read(9))
+            if magic != ZstdFormat.SEEKABLE_MAGIC or frames != 4:
+                self.fail("seek table not found or invalid (%d frames)!" % frames)
+        finally:
+            for f in [ image, output ]:
+                if os.path.exists(f):
+                    os.unlink(f)
+
+if __name__ == "__main__":
+    avocado.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import asyncio
+import avocado
+import os
+import sys
+import threading
+import time
+
+path_to_self    = os.path.realpath(__file__)
+path_to_sources = os.path.join(os.path.dirname(path_to_self), "..", "..")
+sys.path.append(path_to_sources)
+
+from seine.pipeline import Pipeline, Stage
+from seine.utils    import ContainerEngine
+
+class PipelineConcurrentStages(avocado.Test):
+    def test(self):
+        lock = threading.Lock()
+        events = []
+        def stage(name, duration=0.2):
+            def run():
+                with lock:
+                    events.append(("start", name))
+                time.sleep(duration)
+                with lock:
+                    events.append(("end", name))
+            return run
+        async def sbom():
+            events.append(("start", "sbom"))
+            await asyncio.sleep(0.2)
+            events.append(("end", "sbom"))
+
+        labels = []
+        ContainerEngine.begin("b1")
+        stages = [
+            Stage("write", stage("write"), ["assemble"]),
+            Stage("sbom", sbom, ["assemble"]),
+            Stage("assemble", lambda: labels.append(ContainerEngine._labels("assemble")),
+                  ["rootfs", "imager", "qemu"]),
+            Stage("rootfs", stage("rootfs")),
+            Stage("imager", stage("imager")),
+            Stage("qemu", stage("qemu"), needed=False),
+        ]
+        start = time.monotonic()
+        Pipeline(stages).run()
+        elapsed = time.monotonic() - start
+
+        # independent stages overlap: the critical path takes 0.4s
+        if elapsed > 0.7:
+            self.fail("stages did not run concurrently (%.2fs)" % elapsed)
+        for name in ["rootfs", "imager"]:
+            if events.index(("end", name)) > events.index(("start", "write")):
+                self.fail("write started before %s completed: %s" % (name, events))
+        if ("start", "qemu") in events:
+            self.fail("stage that was not needed was run")
+        if labels != [{ "seine.build": "b1", "seine.stage": "assemble" }]:
+            self.fail("build of stages run in threads is unknown: %s" % labels)
+
+class PipelineFailure(avocado.Test):
+    def test(self):
+        ran = []
+        def fail():
+            raise ValueError("rootfs failed")
+        stages = [
+            Stage("rootfs", fail),
+            Stage("imager", lambda: ran.append("imager")),
+            Stage("assemble", lambda: ran.append("assemble"), ["rootfs", "imager"]),
+        ]
+        try:
+            Pipeline(stages).run()
+            self.fail("failure of a stage was not reported")
+        except ValueError as e:
+            if str(e) != "rootfs failed":
+                self.fail("unexpected error: %s" % e)
+        if ran != ["imager"]:
+            self.fail("unexpected stages were run: %s" % ran)
+
+        try:
+            Pipeline([Stage("a", None, ["b"]), Stage("b", None, ["a"])])
+            self.fail("circular stages were not detected")
+        except ValueError:
+            pass
+
+if __name__ == "__main__":
+    avocado.main()
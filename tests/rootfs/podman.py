@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+import avocado
+import http.server
+import io
+import json
+import os
+import shutil
+import socketserver
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import urllib.parse
+
+path_to_self    = os.path.realpath(__file__)
+path_to_sources = os.path.join(os.path.dirname(path_to_self), "..", "..")
+sys.path.append(path_to_sources)
+
+from seine.manifest import Manifest
+from seine.podman   import PodmanClient, PodmanError
+from seine.utils    import ContainerEngine
+
+# podman service answering a few requests of the libpod API
+class MockPodman(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def address_string(self):
+        return "mock"
+
+    def _reply(self, status, body=None, content_type="application/json"):
+        data = b"" if body is None else (body if isinstance(body, bytes) else json.dumps(body).encode())
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def setup(self):
+        super().setup()
+        self.server.connections = self.server.connections + 1
+
+    def _handle(self):
+        if self.server.stopped:
+            self.close_connection = True
+            return
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        path = url.path[len("/v4.0.0/libpod"):]
+        self.server.requests.append((self.command, path, query))
+        images = self.server.images
+        if url.path == "/_ping":
+            return self._reply(200, b"OK", "text/plain")
+        if self.command == "GET" and path.endswith("/exists"):
+            return self._reply(204 if path[len("/images/"):-len("/exists")] in images else 404)
+        if self.command == "GET" and path == "/images/json":
+            return self._reply(200, [{ "Id": images[n], "Names": [ "localhost/" + n ] } for n in images])
+        if self.command == "DELETE" and path.startswith("/images/"):
+            if path[len("/images/"):] in images:
+                del images[path[len("/images/"):]]
+                return self._reply(200, [])
+            return self._reply(404, { "message": "image not known" })
+        if self.command == "POST" and path == "/containers/create":
+            length = int(self.headers["Content-Length"])
+            self.server.created.append(json.loads(self.rfile.read(length)))
+            return self._reply(201, { "Id": "c%d" % len(self.server.created) })
+        if self.command == "GET" and path.endswith("/export"):
+            return self._reply(200, self.server.tarball, "application/x-tar")
+        self._reply(404, { "message": "unexpected request" })
+
+    do_GET = _handle
+    do_POST = _handle
+    do_DELETE = _handle
+
+class MockServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class PodmanApi(avocado.Test):
+    def test(self):
+        workdir = tempfile.mkdtemp()
+        saved = (ContainerEngine.api, ContainerEngine.run)
+        server = None
+        client = None
+        try:
+            path = os.path.join(workdir, "podman.sock")
+            server = MockServer(path, MockPodman)
+            server.images = { "bootstrap/debian/bookworm/all:latest": "sha256:1" }
+            server.requests, server.created, server.connections = [], [], 0
+            server.stopped = False
+            data = io.BytesIO()
+            with tarfile.open(fileobj=data, mode="w") as tar:
+                for name in ["etc/hostname", "usr/bin/true"]:
+                    info = tarfile.TarInfo(name)
+                    info.size = len(name)
+                    tar.addfile(info, io.BytesIO(name.encode()))
+            server.tarball = data.getvalue()
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+            client = PodmanClient(path)
+            if client.ping() is False:
+                self.fail("service could not be pinged")
+            server.connections = 0
+            ContainerEngine.api = client
+            commands = []
+            def run(cmd, check=False):
+                commands.append(cmd)
+                return subprocess.CompletedProcess(cmd, 1)
+            ContainerEngine.run = run
+
+            # typed requests over a connection kept open
+            if ContainerEngine.hasImage("bootstrap/debian/bookworm/all:latest") is False:
+                self.fail("existing image was not found")
+            if ContainerEngine.hasImage("layers/missing") is True:
+                self.fail("missing image was found")
+            if [i["Id"] for i in ContainerEngine.images()] != ["sha256:1"]:
+                self.fail("unexpected images: %s" % ContainerEngine.images())
+            ContainerEngine.begin("b1")
+            cid = ContainerEngine.createContainer("sha256:1", "export")
+            if cid != "c1" or server.created[0]["labels"] != { "seine.build": "b1", "seine.stage": "export" }:
+                self.fail("unexpected container: %s %s" % (cid, server.created))
+            if ContainerEngine.removeImage("layers/missing") is True:
+                self.fail("removal of a missing image succeeded")
+            try:
+                client.image_remove("layers/missing")
+                self.fail("error of the service was not reported")
+            except PodmanError as e:
+                if e.returncode != 404 or "image not known" not in str(e):
+                    self.fail("unexpected error: %s" % e)
+            if server.connections != 1 or commands:
+                self.fail("connection was not reused: %s" % server.connections)
+
+            # exports are streamed to the manifest reader
+            tarball = os.path.join(workdir, "rootfs.tar")
+            with ContainerEngine.export(cid) as stream:
+                manifest = Manifest.receive(stream, tarball)
+            with open(tarball, "rb") as f:
+                if f.read() != server.tarball or len(manifest) != 2:
+                    self.fail("export was not received")
+            if manifest.read(tarball, "usr/bin/true") != b"usr/bin/true":
+                self.fail("unexpected offsets in the manifest")
+
+            # the podman command is used once the service is gone
+            server.stopped = True
+            server.shutdown()
+            server.server_close()
+            server = None
+            os.unlink(path)
+            if ContainerEngine.hasImage("bootstrap/debian/bookworm/all:latest") is True \
+                    or ContainerEngine.api is not None or commands[0][:2] != ["image", "exists"]:
+                self.fail("podman command was not used: %s" % commands)
+        finally:
+            if client is not None:
+                client.close()
+            ContainerEngine.api, ContainerEngine.run = saved
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+            shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    avocado.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import avocado
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+
+path_to_self    = os.path.realpath(__file__)
+path_to_sources = os.path.join(os.path.dirname(path_to_self), "..", "..")
+sys.path.append(path_to_sources)
+
+from seine.pool import WarmImager
+
+def serve(path, handler):
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    def accept():
+        conn, addr = server.accept()
+        with conn, conn.makefile("rw") as f:
+            handler(f, conn)
+        server.close()
+    thread = threading.Thread(target=accept, daemon=True)
+    thread.start()
+    return thread
+
+# stand-in for qemu: accept QMP commands (and passed descriptors)
+def fake_qmp(commands):
+    def handler(f, conn):
+        f.write(json.dumps({ "QMP": { "version": {} } }) + "\n")
+        f.flush()
+        while True:
+            msg, fds, flags, addr = socket.recv_fds(conn, 4096, 4)
+            if not msg:
+                break
+            for fd in fds:
+                os.close(fd)
+            for line in msg.decode().splitlines():
+                request = json.loads(line)
+                commands.append(request["execute"])
+                reply = { "return": {} }
+                if request["execute"] == "add-fd":
+                    reply = { "return": { "fdset-id": 1, "fd": 10 } }
+                conn.sendall((json.dumps(reply) + "\n").encode())
+                if request["execute"] == "device_del":
+                    # another disk is unplugged first
+                    for device in ["other", request["arguments"]["id"]]:
+                        event = { "event": "DEVICE_DELETED", "data": { "device": device } }
+                        conn.sendall((json.dumps(event) + "\n").encode())
+    return handler
+
+# stand-in for the imager script of a warm VM
+def fake_guest(jobs):
+    def handler(f, conn):
+        for line in f:
+            verb, _, args = line.strip().partition(" ")
+            if verb == "HELLO":
+                f.write("READY\n")
+            elif verb == "JOB":
+                jobs.append(dict([arg.split("=", 1) for arg in args.split()]))
+                f.write("LOG # Extracting rootfs\nEXIT 0\n")
+            f.flush()
+    return handler
+
+class WarmImagerJob(avocado.Test):
+    def test(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            vm = WarmImager(os.path.join(workdir, "0"))
+            if vm.lock() is False:
+                self.fail("could not lock a new slot!")
+            commands = []
+            jobs = []
+            threads = [ serve(vm.qmp_socket(), fake_qmp(commands)),
+                        serve(vm.control_socket(), fake_guest(jobs)) ]
+            vm.connect()
+            image = os.path.join(workdir, "disk.img")
+            open(image, "w").close()
+            disk = vm.attach(image)
+            logs = list(vm.run(disk, script="/tmp/script", tarball="/tmp/root.tar"))
+            vm.detach(disk)
+            events = list(vm._qmp.events)
+            vm.unlock()
+            for thread in threads:
+                thread.join(5)
+
+            if logs != [ "LOG # Extracting rootfs", "EXIT 0" ]:
+                self.fail("unexpected job output: %s" % logs)
+            if jobs != [ { "serial": disk[0], "script": "/tmp/script", "tarball": "/tmp/root.tar" } ]:
+                self.fail("unexpected job request: %s" % jobs)
+            expected = [ "qmp_capabilities", "add-fd", "blockdev-add", "device_add",
+                         "device_del", "blockdev-del", "remove-fd" ]
+            if commands != expected:
+                self.fail("unexpected QMP commands: %s" % commands)
+            if events != [ { "event": "DEVICE_DELETED", "data": { "device": "other" } } ]:
+                self.fail("removal of another disk was taken for this one: %s" % events)
+        finally:
+            shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    avocado.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import avocado
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+
+path_to_self    = os.path.realpath(__file__)
+path_to_sources = os.path.join(os.path.dirname(path_to_self), "..", "..")
+sys.path.append(path_to_sources)
+
+from seine.ansible_callback import CallbackModule
+from seine.profile          import Profile
+
+class Named:
+    def __init__(self, name):
+        self.name = name
+
+    def get_name(self):
+        return self.name
+
+class Result:
+    def __init__(self, changed):
+        self._result = { "changed": changed }
+
+class ProfileReport(avocado.Test):
+    def _playbook(self, wall):
+        # output of "podman build" applying a playbook with two tasks
+        output = io.StringIO()
+        callback = CallbackModule(output)
+        callback.v2_playbook_on_play_start(Named("install packages"))
+        callback.v2_playbook_on_task_start(Named("apt"), False)
+        callback.v2_runner_on_ok(Result(True))
+        callback.v2_playbook_on_task_start(Named("debconf"), False)
+        callback.v2_runner_on_skipped(Result(False))
+        callback.v2_playbook_on_stats(None)
+        lines = ["PLAY [install packages] ****"] + output.getvalue().splitlines()
+        profile = Profile("demo.img")
+        printed = [line for line in lines if profile.feed(line) == False]
+        for record in profile.playbooks + profile.tasks:
+            record["wall"] = wall
+        return profile, printed
+
+    def test(self):
+        workdir = tempfile.mkdtemp()
+        saved = os.environ.get("XDG_CACHE_HOME")
+        try:
+            os.environ["XDG_CACHE_HOME"] = workdir
+            profile, printed = self._playbook(10.0)
+            if printed != ["PLAY [install packages] ****"]:
+                self.fail("unexpected output: %s" % printed)
+            if [p["name"] for p in profile.playbooks] != ["install packages"] \
+                    or profile.playbooks[0]["changed"] is False:
+                self.fail("unexpected playbooks: %s" % profile.playbooks)
+            tasks = [(t["playbook"], t["name"], t["status"], t["changed"]) for t in profile.tasks]
+            if tasks != [("install packages", "apt", "ok", True),
+                         ("install packages", "debconf", "skipped", False)]:
+                self.fail("unexpected tasks: %s" % tasks)
+            profile.save()
+
+            # builds are compared with previous ones
+            profile, printed = self._playbook(25.0)
+            report = io.StringIO()
+            with contextlib.redirect_stdout(report):
+                profile.report()
+            if "+15.0s" not in report.getvalue() or "install packages / apt" not in report.getvalue():
+                self.fail("unexpected report:\n%s" % report.getvalue())
+
+            # only the most recent profiles are kept
+            for index in range(Profile.HISTORY + 5):
+                self._playbook(1.0)[0].save()
+            if len(Profile("demo.img").history()) != Profile.HISTORY:
+                self.fail("history was not trimmed: %d" % len(Profile("demo.img").history()))
+        finally:
+            if saved is None:
+                os.environ.pop("XDG_CACHE_HOME", None)
+            else:
+                os.environ["XDG_CACHE_HOME"] = saved
+            shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    avocado.main()
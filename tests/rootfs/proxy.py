@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import avocado
+import functools
+import http.server
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+path_to_self    = os.path.realpath(__file__)
+path_to_sources = os.path.join(os.path.dirname(path_to_self), "..", "..")
+sys.path.append(path_to_sources)
+
+from seine.proxy import AptProxy
+
+# stand-in for a Debian mirror: files of a directory, requests are counted
+class Mirror(http.server.SimpleHTTPRequestHandler):
+    requests = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        Mirror.requests.append(self.path)
+        super().do_GET()
+
+def start(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+class AptProxyCaches(avocado.Test):
+    def test(self):
+        workdir = tempfile.mkdtemp()
+        mirror = proxy = None
+        try:
+            root = os.path.join(workdir, "mirror")
+            os.makedirs(os.path.join(root, "dists", "stable"))
+            os.makedirs(os.path.join(root, "pool", "main"))
+            with open(os.path.join(root, "dists", "stable", "InRelease"), "w") as f:
+                f.write("Suite: stable\n")
+            for name in ["a", "b", "c"]:
+                with open(os.path.join(root, "pool", "main", "%s.deb" % name), "wb") as f:
+                    f.write(name.encode() * 1000)
+
+            handler = functools.partial(Mirror, directory=root)
+            mirror = start(http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler))
+            base = "http://127.0.0.1:%d" % mirror.server_address[1]
+            proxy = start(AptProxy(2500, os.path.join(workdir, "cache")).server(0))
+            opener = urllib.request.build_opener(urllib.request.ProxyHandler(
+                { "http": "http://127.0.0.1:%d" % proxy.server_address[1] }))
+            def get(path):
+                with opener.open(base + path) as response:
+                    return response.read()
+
+            # packages are downloaded once
+            Mirror.requests = []
+            if get("/pool/main/a.deb") != b"a" * 1000 or get("/pool/main/a.deb") != b"a" * 1000:
+                self.fail("unexpected package contents!")
+            if Mirror.requests != ["/pool/main/a.deb"]:
+                self.fail("package was downloaded more than once: %s" % Mirror.requests)
+
+            # indexes are revalidated (and served from the cache if unchanged)
+            get("/dists/stable/InRelease")
+            if get("/dists/stable/InRelease") != b"Suite: stable\n":
+                self.fail("unexpected index contents!")
+            if Mirror.requests.count("/dists/stable/InRelease") != 2:
+                self.fail("index was not revalidated: %s" % Mirror.requests)
+
+            # least recently used packages are evicted
+            get("/pool/main/b.deb")
+            get("/pool/main/a.deb")
+            get("/pool/main/c.deb")
+            Mirror.requests = []
+            get("/pool/main/a.deb")
+            get("/pool/main/b.deb")
+            if Mirror.requests != ["/pool/main/b.deb"]:
+                self.fail("unexpected downloads after eviction: %s" % Mirror.requests)
+            if proxy.cache.used > 2500:
+                self.fail("cache is larger than its bound: %d" % proxy.cache.used)
+
+            # cached files are used when the mirror is unreachable
+            get("/dists/stable/InRelease")
+            mirror.shutdown()
+            mirror.server_close()
+            mirror = None
+            if get("/dists/stable/InRelease") != b"Suite: stable\n":
+                self.fail("cached index was not used while offline!")
+        finally:
+            for server in [mirror, proxy]:
+                if server is not None:
+                    server.shutdown()
+                    server.server_close()
+            shutil.rmtree(workdir)
+
+class AptProxyLifetime(avocado.Test):
+    def test(self):
+        workdir = tempfile.mkdtemp()
+        client = None
+        try:
+            path = os.path.join(workdir, "cache")
+            proxy = AptProxy(2500, path)
+            thread = threading.Thread(target=proxy.serve, args=(proxy.server(0), 0.2), daemon=True)
+            thread.start()
+            while proxy.url() is None:
+                time.sleep(0.05)
+
+            # the proxy outlives its idle timeout while used by a build
+            client = AptProxy(2500, path)
+            if client.start() != proxy.url():
+                self.fail("running proxy was not reused")
+            thread.join(1)
+            if thread.is_alive() is False or proxy.url() is None:
+                self.fail("proxy exited while used by a build")
+
+            client.release()
+            client = None
+            thread.join(5)
+            if thread.is_alive() or proxy.url() is not None:
+                self.fail("idle proxy did not exit")
+        finally:
+            if client is not None:
+                client.release()
+            shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    avocado.main()
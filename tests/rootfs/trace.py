@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+import avocado
+import json
+import os
+import sys
+import tempfile
+
+path_to_self    = os.path.realpath(__file__)
+path_to_sources = os.path.join(os.path.dirname(path_to_self), "..", "..")
+sys.path.append(path_to_sources)
+
+from seine.imager import Imager
+from seine.trace  import Trace
+
+class Source:
+    def __init__(self):
+        self.options = { "debug": False, "keep": False, "verbose": False }
+        self.spec = { "distribution": { "source": "debian", "release": "buster" } }
+
+class TraceImagerSections(avocado.Test):
+    def test(self):
+        Trace.enable()
+        try:
+            @Trace.stage("assemble")
+            def assemble():
+                imager = Imager(Source())
+                imager._section = ("boot", Trace.now())
+                for log in [ "LOG # Creating partitions", "LOG mke2fs 1.47.0",
+                             "LOG # Extracting rootfs", "EXIT 0" ]:
+                    imager._log(log, [])
+            assemble()
+            path = tempfile.mktemp(suffix=".json")
+            Trace.save(path)
+            with open(path) as f:
+                events = json.load(f)["traceEvents"]
+            os.unlink(path)
+        finally:
+            Trace._events = None
+
+        spans = [e for e in events if e["ph"] == "X"]
+        names = [e["name"] for e in spans]
+        if names != [ "boot", "Creating partitions", "Extracting rootfs", "assemble" ]:
+            self.fail("unexpected spans: %s" % names)
+        outer = spans[-1]
+        for span in spans[:-1]:
+            if span["ts"] < outer["ts"] or span["ts"] + span["dur"] > outer["ts"] + outer["dur"] + 1:
+                self.fail("%s is not within its stage!" % span["name"])
+        if not [e for e in events if e["ph"] == "M" and e["name"] == "thread_name"]:
+            self.fail("thread of the spans was not named!")
+
+if __name__ == "__main__":
+    avocado.main()
@@ -45,6 +45,28 @@ class MissingImageFilename(avocado.Test):
         except Exception as e:
             self.fail("parsing caused an unknown error: %s" % str(type(e)))
 
+class UnsupportedImageFormat(avocado.Test):
+    def test(self):
+        try:
+            build = BuildCmd()
+            build.loads("""
+                image:
+                    filename: simple-test.img
+                    format: zip
+                    partitions:
+                        - label: rootfs
+                          where: /
+            """)
+            build.parse()
+            self.fail("parsing succeeded when it should have failed (unsupported 'format')!")
+        except ValueError as e:
+            if str(e) != "'zip' is not a supported image format!":
+                self.fail("parsing did not return the error we expected!")
+        except avocado.core.exceptions.TestFail:
+            raise
+        except Exception as e:
+            self.fail("parsing caused an unknown error: %s" % str(type(e)))
+
 class PlaybookNotAList(avocado.Test):
     def test(self):
         try:
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import avocado
+import os
+import shutil
+import sys
+import tempfile
+
+path_to_self    = os.path.realpath(__file__)
+path_to_sources = os.path.join(os.path.dirname(path_to_self), "..", "..")
+sys.path.append(path_to_sources)
+
+from seine.build import BuildCmd
+from seine.specs import SpecCache
+
+MAIN_SPEC = """
+requires: [ common ]
+image:
+    filename: cached.img
+    partitions:
+        - label: rootfs
+          where: /
+"""
+
+class SpecCacheHit(avocado.Test):
+    def test(self):
+        workdir = tempfile.mkdtemp()
+        saved = os.environ.get("XDG_CACHE_HOME")
+        try:
+            os.environ["XDG_CACHE_HOME"] = workdir
+            main = os.path.join(workdir, "main.yaml")
+            common = os.path.join(workdir, "common.yaml")
+            with open(main, "w") as f:
+                f.write(MAIN_SPEC)
+            with open(common, "w") as f:
+                f.write("distribution:\n    release: bookworm\n")
+            first = BuildCmd().compile([main])
+
+            # unchanged files: nothing shall be parsed
+            build = BuildCmd()
+            build._parse_yaml = lambda content: self.fail("%s was parsed again!" % content)
+            second = build.compile([main])
+            if second["distribution"] != first["distribution"] or build.image._output != "cached.img":
+                self.fail("cached specification differs: %s" % second)
+            if build.image.partitionHandler is not build.partitionHandler:
+                self.fail("partition handler of the image was not restored!")
+
+            # a required file changed
+            with open(common, "w") as f:
+                f.write("distribution:\n    release: trixie\n")
+            third = BuildCmd().compile([main])
+            if third["distribution"]["release"] != "trixie":
+                self.fail("stale specification was used: %s" % third["distribution"])
+
+            # seine changed: specifications are parsed again
+            SpecCache._sources = "0" * 64
+            parsed = []
+            build = BuildCmd()
+            parse = build._parse_yaml
+            build._parse_yaml = lambda content: parsed.append(content) or parse(content)
+            build.compile([main])
+            if not parsed:
+                self.fail("specification cached by another seine was used!")
+        finally:
+            SpecCache._sources = None
+            if saved is None:
+                os.environ.pop("XDG_CACHE_HOME", None)
+            else:
+                os.environ["XDG_CACHE_HOME"] = saved
+            shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    avocado.main()
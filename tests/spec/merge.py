@@ -2,7 +2,9 @@
 
 import avocado
 import os
+import shutil
 import sys
+import tempfile
 
 path_to_self    = os.path.realpath(__file__)
 path_to_sources = os.path.join(os.path.dirname(path_to_self), "..", "..")
@@ -264,5 +266,46 @@ class MergeVolumeAttributes(avocado.Test):
         if vol["size"] != 750 * 1024 * 1024:
             self.fail("expected size of 750MiB: got %s" % vol["size"])
 
+def write_specs(specs):
+    workdir = tempfile.mkdtemp()
+    for name, content in specs.items():
+        with open(os.path.join(workdir, "%s.yaml" % name), "w") as f:
+            f.write(content)
+    return workdir
+
+class RequiresDiamondMergedOnce(avocado.Test):
+    def test(self):
+        workdir = write_specs({
+            "main": "requires: [ a, b ]\nimage:\n  filename: test.img\n  partitions:\n    - label: rootfs\n      where: /\n",
+            "a": "requires: [ common ]\nplaybook:\n  - name: a\n",
+            "b": "requires: [ common ]\nplaybook:\n  - name: b\n",
+            "common": "distribution:\n  source: debian\n  release: bookworm\nplaybook:\n  - name: common\n",
+        })
+        try:
+            build = BuildCmd()
+            spec = build.load(os.path.join(workdir, "main.yaml"))
+        finally:
+            shutil.rmtree(workdir)
+        names = [p["name"] for p in spec["playbook"]]
+        if names != [ "a", "common", "b" ]:
+            self.fail("expected playbooks 'a', 'common' and 'b' (got %s)" % names)
+
+class RequiresCycle(avocado.Test):
+    def test(self):
+        workdir = write_specs({
+            "main": "requires: [ a ]\n",
+            "a": "requires: [ b ]\n",
+            "b": "requires: [ a ]\n",
+        })
+        try:
+            build = BuildCmd()
+            build.load(os.path.join(workdir, "main.yaml"))
+            self.fail("loading should have failed (circular requirements)!")
+        except ValueError as e:
+            if "circular requirements" not in str(e):
+                self.fail("unexpected error: %s" % e)
+        finally:
+            shutil.rmtree(workdir)
+
 if __name__ == "__main__":
     avocado.main()
@@ -84,5 +84,58 @@ class PartitionMissingLabel(avocado.Test):
         except Exception as e:
             self.fail("parsing caused an unknown error: %s" % str(type(e)))
 
+class DistributeToLongestPrefix(avocado.Test):
+    def test(self):
+        build = BuildCmd()
+        build.loads("""
+            image:
+                filename: simple-test.img
+                partitions:
+                    - label: rootfs
+                      where: /
+                    - label: usr
+                      where: /usr
+                    - label: local
+                      where: /usr/local
+        """)
+        build.parse()
+        handler = build.partitionHandler
+        names = [ "usr/local/bin/tool", "usr/bin/ls", "usrmerge", "etc/hostname", "usr/local" ]
+        totals = handler.distribute_many(names, [ 1, 4096, 4097, 0, 0 ])
+        expected = { "/usr/local": (4096, 1), "/usr": (4096, 2), "/": (8192, 2) }
+        for mount, total in zip(handler.mounts, totals):
+            size, files = expected[mount["where"]]
+            if total != size:
+                self.fail("%s: expected %d bytes, got %d" % (mount["where"], size, total))
+            if mount["_usage"].files != files:
+                self.fail("%s: expected %d files, got %d" % (mount["where"], files, mount["_usage"].files))
+
+class DefaultExtraSpace(avocado.Test):
+    def test(self):
+        build = BuildCmd()
+        build.loads("""
+            image:
+                filename: simple-test.img
+                partitions:
+                    - label: rootfs
+                      where: /
+                      type: ext4
+                    - label: data
+                      where: /data
+                      type: ext4
+                      extra: 0MiB
+        """)
+        build.parse()
+        handler = build.partitionHandler
+        handler.distribute_many([ "etc/hostname", "data/hostname" ], [ 4096, 4096 ])
+        handler.compute_sizes()
+        rootfs, data = handler.mounts[0], handler.mounts[1]
+        if rootfs["where"] != "/":
+            rootfs, data = data, rootfs
+        # estimated file-systems get some free space unless told otherwise
+        extra = rootfs["_size"] - data["_size"]
+        if extra != 16 * 1024 * 1024:
+            self.fail("expected 16 MiB of extra space, got %d bytes" % extra)
+
 if __name__ == "__main__":
     avocado.main()